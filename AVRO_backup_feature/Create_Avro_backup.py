@@ -1,102 +1,126 @@
 import boto3
-import psycopg2
-import avro.schema
-import json
-import io
-from avro.datafile import DataFileWriter
-from avro.io import DatumWriter
+from connection_cache import get_database_config, get_connection, new_connection
+from s3_multipart_writer import S3MultipartWriter
+from stage_metrics import StageMetrics
+from backup_catalog import load_backup_catalog, save_backup_catalog, add_backup, count_latest_deltas
+import os
+from avro_codec import write_records
+from parquet_export import is_parquet_available, get_parquet_schema, export_parquet_to_s3, parquet_table_name, parquet_query, parquet_delta_query
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from io import BytesIO
 
 
 
-def extract_parameters_from_response(parameters):
-    
-    for parameter in parameters:
-        if parameter['Name'].split('/')[-1]=='databasename':
-            databasename=parameter['Value']
-        elif parameter['Name'].split('/')[-1]=='user':
-            user=parameter['Value']
-        elif parameter['Name'].split('/')[-1]=='password':
-            password=parameter['Value']
-        elif parameter['Name'].split('/')[-1]=='port':
-            port=parameter['Value']
-        elif parameter['Name'].split('/')[-1]=='database_identifier':
-            database_identifier=parameter['Value']
-        elif parameter['Name'].split('/')[-1]=='bucketname':
-            bucketname=parameter['Value']
-    
-    parameters_dict={'databasename':databasename,'user':user,'password':password,'port':port,'database_identifier':database_identifier,'bucketname':bucketname}
-    return parameters_dict
-
-
-def serialize_avro_data(schema, data):
-    avro_schema = avro.schema.Parse(schema)
-    bytes_writer = BytesIO()
-    datum_writer = DatumWriter(avro_schema)
-
-    data_file_writer = DataFileWriter(bytes_writer, datum_writer, avro_schema)
-    for record in data:
-        data_file_writer.append(record)
-
-    data_file_writer.flush()
-
-    serialized_data = bytes_writer.getvalue()
-
-    return serialized_data
+# Rows read from the server-side cursor on each round trip
+fetch_size = int(os.environ.get('BACKUP_FETCH_SIZE', 10000))
+# Tables that are backed up at the same time, each one with its own connection (1 backs them up one after another)
+backup_parallelism = int(os.environ.get('BACKUP_PARALLELISM', 3))
+# incremental: only the rows added since the last backup are written (a delta), full: all the rows every time
+backup_mode = os.environ.get('BACKUP_MODE', 'incremental')
+# Deltas after which a new full backup is written, so the restore doesn't replay too many files
+max_deltas = int(os.environ.get('BACKUP_MAX_DELTAS', 7))
+# Write the columnar export for BI (hired_employees_bi.parquet) next to the AVRO files, it is not written without pyarrow
+export_parquet = os.environ.get('BACKUP_PARQUET', 'false').lower() == 'true' and is_parquet_available()
+
+
+#This function read the rows of a server-side cursor as AVRO records, fetch_size rows on each round trip
+#The round trips are measured in the fetch stage of the metrics
+def iter_cursor_records(cursor, metrics):
+    with metrics.stage('fetch') as counts:
+        rows = cursor.fetchmany(fetch_size)
+        counts['rows'] = len(rows)
+    columns = [col[0] for col in cursor.description]
+    while rows:
+        for row in rows:
+            yield dict(zip(columns, row))
+        with metrics.stage('fetch') as counts:
+            rows = cursor.fetchmany(fetch_size)
+            counts['rows'] = len(rows)
+
+#This function stream a table from the database to an AVRO file in S3
+#The rows are read with a server-side cursor, the AVRO blocks are written as they are filled and uploaded as parts
+#of a multipart upload, so the memory doesn't depend on the size of the table
+#The fetch, encode and upload stages of the file are logged and added to the metrics of the backup
+#It returns the key, rows, bytes and checksum of the file for the catalog
+def backup_table_to_s3(conn, query, schema, s3_bucket, file_key, cursor_name, query_parameters=None, metrics=None, s3_client=None):
+    file_metrics = StageMetrics('backup', file=file_key)
+    with S3MultipartWriter(s3_bucket, file_key, s3_client, metrics=file_metrics) as s3_writer:
+        # Named cursors are server-side cursors, the rows stay in the database until they are fetched
+        cursor = conn.cursor(name=cursor_name)
+        cursor.execute(query, query_parameters)
+        # The AVRO blocks are compressed with the codec of BACKUP_CODEC
+        # The time of the fetch and upload stages is not counted in the encode stage
+        with file_metrics.stage('encode') as counts:
+            rows_written = write_records(s3_writer, schema, iter_cursor_records(cursor, file_metrics))
+            counts['rows'], counts['bytes'] = rows_written, s3_writer.position
+        cursor.close()
+        # The last part is uploaded and the upload is completed when the writer is closed
+    file_metrics.log(rows=rows_written, bytes=s3_writer.position)
+    if metrics is not None:
+        metrics.merge(file_metrics.summary())
+    return {'key': file_key, 'rows': rows_written, 'bytes': s3_writer.position, 'sha256': s3_writer.sha256.hexdigest()}
+
+#This function back up one table in a new connection that uses the snapshot exported by the main connection
+#So all the tables are read from the same point in time, even if they are read by different connections
+#The S3 client is created by the handler, the clients of boto3 can't be created by several threads at the same time
+def backup_table_with_snapshot(snapshot_id, write_file, query, schema, s3_bucket, file_key, cursor_name, query_parameters=None, metrics=None, s3_client=None):
+    conn = new_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ")
+        cursor.execute("SET TRANSACTION SNAPSHOT %s", (snapshot_id,))
+        cursor.close()
+        backup_file = write_file(conn, query, schema, s3_bucket, file_key, cursor_name, query_parameters, metrics, s3_client)
+        conn.commit()
+        return backup_file
+    finally:
+        conn.close()
+
+#This function read the state of a table in the backup transaction: the max id, the rows and the rows until the
+#high-water mark of the last backup
+def get_table_state(cursor, table_name, high_water_mark):
+    cursor.execute(f"SELECT coalesce(max(id), 0), count(*), count(*) FILTER (WHERE id <= %s) FROM migration.{table_name}",
+                   (high_water_mark,))
+    max_id, row_count, rows_until_mark = cursor.fetchone()
+    return {'high_water_mark': max_id, 'row_count': row_count, 'rows_until_mark': rows_until_mark}
+
+#This function help us to know if a delta is not enough and all the rows must be written again
+def needs_full_backup(catalog, table_states):
+    if backup_mode == 'full' or catalog is None or count_latest_deltas(catalog) >= max_deltas:
+        return True
+    # The Parquet deltas need a full backup with the Parquet export (e.g. the export was enabled after the last full backup)
+    full_backup_files = catalog['backups'][catalog['backups'][catalog['latest']]['restore_chain'][0]]['files']
+    if export_parquet and parquet_table_name not in full_backup_files:
+        return True
+    # A delta only has the rows after the high-water mark, if rows were deleted or inserted with a lower id
+    # (e.g. a restore or a file with the ids out of order) the count until the mark changes
+    return any(table_name not in catalog['tables'] or state['rows_until_mark'] != catalog['tables'][table_name]['row_count']
+               for table_name, state in table_states.items())
     
 def lambda_handler(event, context):
     timestamp=datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
-    # Create S3 Client
-    s3_client = boto3.client('s3')
-    key=f'backups_tables/avro_tables_backup_{timestamp}/'
-    # Create an SSM client
-    ssm_client = boto3.client('ssm')
-    # Specify the SSM parameter names to retrieve
-    path = '/RDS/test-migration-db/'
+    # Time, rows and bytes of each stage of all the files of the backup
+    metrics = StageMetrics('backup', timestamp=timestamp)
+    # The database configuration and the connection are cached by the layer while the lambda is warm
+    config = get_database_config()
     
-    # Create an RDS client
-    rds_client = boto3.client('rds')
-    
-    # Retrieve parameters by path from SSM Parameter Store
-    response = ssm_client.get_parameters_by_path(Path=path,Recursive=True, WithDecryption=True)
-    
-    # Extract the parameters values from the response
-    parameters_to_extract = response['Parameters']
-    parameters = extract_parameters_from_response(parameters_to_extract)
-    
-    #Set all the required parameters for the RDS database
-    #Describe the RDS instance to extract the endpoint using the database_identifier parameter stored in SSM 
-    response_describe_db = rds_client.describe_db_instances(DBInstanceIdentifier=parameters['database_identifier'])
-    endpoint = response_describe_db['DBInstances'][0]['Endpoint']['Address']
-    port=parameters['port']
-    master_username = parameters['user']
-    master_password = parameters['password']
-    database_name = parameters['databasename']
-
     # S3 bucket configuration
-    s3_bucket = parameters['bucketname']
+    s3_bucket = config['parameters']['bucketname']
+    # A single S3 client is shared by the threads that write the files, the clients are thread-safe once created
+    s3 = boto3.client('s3')
 
     # Connect to RDS database
-    conn = psycopg2.connect(
-        host=endpoint,
-        database=database_name,
-        user=master_username,
-        password=master_password
-    )
+    conn = get_connection()
     
-    # Let's create the cursor
-    cursor = conn.cursor()
-
     # Serialize data to AVRO format
-    # AVRO schema for tables
+    # AVRO schema for tables, datetime is a timestamptz and it is written as a timestamp in UTC
     hired_employees_schema = '''{
             "type": "record",
             "name": "hired_employees",
             "fields": [
                 { "name": "id", "type": "int" },
                 { "name": "name", "type": "string" },
-                { "name": "datetime", "type": "string" },
+                { "name": "datetime", "type": ["null", { "type": "long", "logicalType": "timestamp-millis" }] },
                 { "name": "department_id", "type": "int" },
                 { "name": "job_id", "type": "int" }
             ]
@@ -120,51 +144,85 @@ def lambda_handler(event, context):
             ]
         }'''
         
-    # Fetch data from table 1
+    # Table, query, schema and cursor name of each table
+    tables = [
+        ('hired_employees', "SELECT he.id,he.name,he.datetime,he.department_id,he.job_id FROM migration.hired_employees he",
+         hired_employees_schema, 'backup_hired_employees'),
+        ('departments', "SELECT d.id,d.department FROM migration.departments d",
+         departments_schema, 'backup_departments'),
+        ('jobs', "SELECT j.id,j.job FROM migration.jobs j",
+         jobs_schema, 'backup_jobs')
+    ]
+    
+    # The backup is read in a REPEATABLE READ transaction, so the three tables come from the same point in time
     cursor = conn.cursor()
-    cursor.execute("SELECT he.id,he.name,he.datetime,he.department_id,he.job_id FROM migration.hired_employees he")
-    hired_employees_data = cursor.fetchall()
-    hired_employees_data = [dict(zip([col[0] for col in cursor.description], row)) for row in hired_employees_data]
-
-
-    # Fetch data from table 2
-    cursor.execute("SELECT d.id,d.department FROM migration.departments d")
-    departments_data = cursor.fetchall()
-    departments_data = [dict(zip([col[0] for col in cursor.description], row)) for row in departments_data]
-
-
-    # Fetch data from table 3
-    cursor.execute("SELECT j.id,j.job FROM migration.jobs j")
-    jobs_data = cursor.fetchall()
-    jobs_data = [dict(zip([col[0] for col in cursor.description], row)) for row in jobs_data]
-
-
-    # Close the database connection
-    conn.close()
-
-    # Serialize data into AVRO format
-    serialized_table2 = serialize_avro_data(departments_schema, departments_data)
-    serialized_table1 = serialize_avro_data(hired_employees_schema, hired_employees_data)
-    serialized_table3 = serialize_avro_data(jobs_schema, jobs_data)
-
-    #Write AVRO files to S3
-    s3_client.put_object(
-        Bucket=s3_bucket,
-        Key=key + 'hired_employees.avro',
-        Body=serialized_table1
-    )
-    s3_client.put_object(
-        Bucket=s3_bucket,
-        Key=key + 'departments.avro',
-        Body=serialized_table2
-    )
-    s3_client.put_object(
-        Bucket=s3_bucket,
-        Key=key + 'jobs.avro',
-        Body=serialized_table3
-    )
+    cursor.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ")
+    if backup_parallelism > 1:
+        # The snapshot of the transaction is exported, and each table is streamed to S3 by its own connection
+        cursor.execute("SELECT pg_export_snapshot()")
+        snapshot_id = cursor.fetchone()[0]
+    
+    # The high-water marks are read in the same snapshot of the backup
+    catalog = load_backup_catalog(s3_bucket, s3)
+    table_states = {}
+    for table_name, _, _, _ in tables:
+        high_water_mark = catalog['tables'][table_name]['high_water_mark'] if catalog and table_name in catalog['tables'] else 0
+        table_states[table_name] = get_table_state(cursor, table_name, high_water_mark)
+    
+    full_backup = needs_full_backup(catalog, table_states)
+    if full_backup:
+        key = f'backups_tables/avro_tables_backup_{timestamp}/'
+        table_files = {table_name: (query, None) for table_name, query, _, _ in tables}
+    else:
+        key = f'backups_tables/avro_tables_delta_{timestamp}/'
+        # Only the tables with new rows are written, with the rows after the high-water mark
+        table_files = {table_name: (query + " WHERE id > %s", (catalog['tables'][table_name]['high_water_mark'],))
+                       for table_name, query, _, _ in tables
+                       if table_states[table_name]['row_count'] > table_states[table_name]['rows_until_mark']}
+    
+    # Table, function that writes the file, query, query parameters, schema, file and cursor name of the files of this backup
+    backup_files = [(table_name, backup_table_to_s3, table_files[table_name][0], table_files[table_name][1], schema, key + f'{table_name}.avro', cursor_name)
+                    for table_name, _, schema, cursor_name in tables if table_name in table_files]
+    if export_parquet and 'hired_employees' in table_files:
+        query_parameters = None if full_backup else (catalog['tables']['hired_employees']['high_water_mark'],)
+        backup_files.append((parquet_table_name, export_parquet_to_s3, parquet_query if full_backup else parquet_delta_query,
+                             query_parameters, get_parquet_schema(), key + f'{parquet_table_name}.parquet', 'backup_hired_employees_bi'))
+    
+    written_files = {}
+    if backup_parallelism > 1 and backup_files:
+        with ThreadPoolExecutor(max_workers=backup_parallelism) as executor:
+            futures = {table_name: executor.submit(backup_table_with_snapshot, snapshot_id, write_file, query, schema, s3_bucket, file_key, cursor_name, query_parameters, metrics, s3)
+                       for table_name, write_file, query, query_parameters, schema, file_key, cursor_name in backup_files}
+            # The snapshot must live until all the tables were read
+            for table_name, future in futures.items():
+                written_files[table_name] = future.result()
+    else:
+        # Stream each table to its file in S3
+        for table_name, write_file, query, query_parameters, schema, file_key, cursor_name in backup_files:
+            written_files[table_name] = write_file(conn, query, schema, s3_bucket, file_key, cursor_name, query_parameters, metrics, s3)
+    cursor.close()
+
+    # End the read transaction, the connection is kept open for the next invocations
+    conn.commit()
+    
+    if not backup_files:
+        return {
+            'statusCode': 200,
+            'body': 'There are no new rows since the last AVRO backup'
+        }
+    
+    # The catalog is written after all the files, a failed backup doesn't change the state of the last one
+    tables_state = {table_name: {'high_water_mark': state['high_water_mark'], 'row_count': state['row_count']}
+                    for table_name, state in table_states.items()}
+    catalog = add_backup(catalog, timestamp, 'full' if full_backup else 'delta', key, written_files, tables_state)
+    with metrics.stage('catalog_upload'):
+        save_backup_catalog(s3_bucket, catalog, s3)
+    metrics.log(type='full' if full_backup else 'delta', files=len(written_files))
 
     return {
         'statusCode': 200,
-        'body': 'AVRO tables backup successfully written to S3'
-    }
\ No newline at end of file
+        'body': f"AVRO tables {'backup' if full_backup else 'delta backup'} successfully written to S3",
+        'timestamp': timestamp,
+        'rows_written': {table_name: backup_file['rows'] for table_name, backup_file in written_files.items()},
+        'metrics': metrics.summary()
+    }
@@ -1,199 +1,252 @@
 import boto3
-import psycopg2
-import avro.schema
-import json
-import io
-from avro.datafile import DataFileReader
-from avro.io import DatumReader
-from datetime import datetime
+from psycopg2 import sql
+from psycopg2.extras import execute_values
+from connection_cache import get_database_config, get_connection
+from data_version import bump_data_version_after_commit
+from stage_metrics import StageMetrics
+from backup_catalog import load_backup_catalog, find_backup, get_table_files
+import os
+import hashlib
+import itertools
+from avro_codec import read_records
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor
 from io import BytesIO
 
-def extract_parameters_from_response(parameters):
-    
-    for parameter in parameters:
-        if parameter['Name'].split('/')[-1]=='databasename':
-            databasename=parameter['Value']
-        elif parameter['Name'].split('/')[-1]=='user':
-            user=parameter['Value']
-        elif parameter['Name'].split('/')[-1]=='password':
-            password=parameter['Value']
-        elif parameter['Name'].split('/')[-1]=='port':
-            port=parameter['Value']
-        elif parameter['Name'].split('/')[-1]=='database_identifier':
-            database_identifier=parameter['Value']
-        elif parameter['Name'].split('/')[-1]=='bucketname':
-            bucketname=parameter['Value']
-    
-    parameters_dict={'databasename':databasename,'user':user,'password':password,'port':port,'database_identifier':database_identifier,'bucketname':bucketname}
-    return parameters_dict
 
-def get_last_created_folder(bucket_name, parent_folder_prefix):
-    s3 = boto3.client('s3')
-    response = s3.list_objects_v2(Bucket=bucket_name, Prefix=parent_folder_prefix, Delimiter='/')
+# Load mode of the restore: copy (COPY FROM STDIN) or execute_values (batched INSERTs)
+restore_mode = os.environ.get('RESTORE_MODE', 'copy')
+# Rows of each INSERT in the execute_values mode
+restore_page_size = int(os.environ.get('RESTORE_PAGE_SIZE', 1000))
+# What to do with the foreign keys and indexes during the load:
+# keep, drop (they are dropped before the load and created again after it) or defer (SET CONSTRAINTS ALL DEFERRED,
+# it only has effect on the constraints created as DEFERRABLE)
+restore_constraints = os.environ.get('RESTORE_CONSTRAINTS', 'keep')
+# AVRO files downloaded at the same time
+restore_download_workers = int(os.environ.get('RESTORE_DOWNLOAD_WORKERS', 8))
 
-    folders = response.get('CommonPrefixes', [])
+#This function return the last full backup folder (or the last one before a timestamp), it is used when there is no catalog
+def get_last_created_folder(bucket_name, parent_folder_prefix, timestamp=None, s3_client=None):
+    s3 = s3_client or boto3.client('s3')
+    # The delta folders are not complete backups, so only the full backup folders are listed
+    # The response has 1000 folders at most, so all the pages are read
+    full_backup_prefix = parent_folder_prefix + 'avro_tables_backup_'
+    paginator = s3.get_paginator('list_objects_v2')
+    last_folder = None
+    for page in paginator.paginate(Bucket=bucket_name, Prefix=full_backup_prefix, Delimiter='/'):
+        for folder in page.get('CommonPrefixes', []):
+            folder_timestamp = folder['Prefix'][len(full_backup_prefix):].rstrip('/')
+            if timestamp is not None and folder_timestamp > timestamp:
+                continue
+            if last_folder is None or folder['Prefix'] > last_folder:
+                last_folder = folder['Prefix']
 
-    if folders:
-        # Sort the folders in descending order based on the folder names
-        sorted_folders = sorted(folders, key=lambda x: x['Prefix'], reverse=True)
-        last_folder = sorted_folders[0]['Prefix']
+    if last_folder:
         # Remove the parent folder prefix from the last folder
         last_folder = last_folder.replace(parent_folder_prefix, '', 1)
         return last_folder.rstrip('/')
     else:
         return None
 
-def read_avro_from_s3(bucket, key):
-    s3 = boto3.client('s3')
-    response = s3.get_object(Bucket=bucket, Key=key)
-    avro_data = response['Body'].read()
+#This function download an AVRO file, if the catalog has its checksum the file is checked before it is restored
+#The files are downloaded by several threads, so they use the S3 client of the handler instead of creating their own
+def read_avro_from_s3(bucket, key, sha256=None, metrics=None, s3_client=None):
+    s3 = s3_client or boto3.client('s3')
+    with metrics.stage('fetch') if metrics is not None else nullcontext() as counts:
+        response = s3.get_object(Bucket=bucket, Key=key)
+        avro_data = response['Body'].read()
+        if counts is not None:
+            counts['bytes'] = len(avro_data)
+    if sha256 is not None and hashlib.sha256(avro_data).hexdigest() != sha256:
+        raise ValueError(f"Checksum error: the backup file {key} is not the file written by the backup")
     return avro_data
 
-def deserialize_avro_data(avro_data, avro_schema):
-    schema = avro.schema.Parse(avro_schema)
-    bytes_reader = BytesIO(avro_data)
-    datum_reader = DatumReader(schema)
-    data_file_reader = DataFileReader(bytes_reader, datum_reader)
-    records = [record for record in data_file_reader]
-    data_file_reader.close()
+#This function deserialize the AVRO data lazily, the records are decoded while they are loaded into the database
+#With metrics the time of the decode is measured apart from the time of the load (decode stage)
+def deserialize_avro_data(avro_data, avro_schema=None, metrics=None):
+    records = read_records(BytesIO(avro_data), avro_schema)
+    if metrics is not None:
+        records = metrics.timed_iter('decode', records)
     return records
 
+#This function download the AVRO file of a table, the records are deserialized when they are read
+def read_table_backup(bucket, backup_file, avro_schema=None, metrics=None, s3_client=None):
+    avro_data = read_avro_from_s3(bucket, backup_file['key'], backup_file.get('sha256'), metrics, s3_client)
+    return deserialize_avro_data(avro_data, avro_schema, metrics)
 
-def lambda_handler(event, context):
+#This function format a value for COPY csv: strings are always quoted, so any value is safe (quotes, commas,
+#line breaks or $$) and empty strings are not NULLs, the NULLs are the only values without anything
+def format_csv_value(value):
+    if value is None:
+        return ''
+    if isinstance(value, str):
+        return '"' + value.replace('"', '""') + '"'
+    return str(value)
+
+#This class is a file-like object that gives the records as CSV to COPY FROM STDIN, without keeping all of them in memory
+class RecordsCsvStream:
+    def __init__(self, records, columns, rows_per_chunk=1000):
+        self.records = iter(records)
+        self.columns = columns
+        self.rows_per_chunk = rows_per_chunk
+        self.pending = ''
+        self.finished = False
     
-    # Create an SSM client
-    ssm_client = boto3.client('ssm')
-    # Specify the SSM parameter names to retrieve
-    path = '/RDS/test-migration-db/'
+    def read(self, size=-1):
+        while not self.finished and (size < 0 or len(self.pending) < size):
+            records = list(itertools.islice(self.records, self.rows_per_chunk))
+            if not records:
+                self.finished = True
+                break
+            self.pending += ''.join(','.join(format_csv_value(record[column]) for column in self.columns) + '\n'
+                                    for record in records)
+        if size < 0:
+            data, self.pending = self.pending, ''
+        else:
+            data, self.pending = self.pending[:size], self.pending[size:]
+        return data
     
-    # Create an RDS client
-    rds_client = boto3.client('rds')
+    readline = read
+
+#This function load the records of a table with COPY FROM STDIN
+def copy_records(cursor, table_name, columns, records):
+    copy_query = sql.SQL("COPY {} ({}) FROM STDIN WITH (FORMAT csv)").format(
+        sql.Identifier('migration', table_name), sql.SQL(', ').join(map(sql.Identifier, columns)))
+    cursor.copy_expert(copy_query, RecordsCsvStream(records, columns))
+    return cursor.rowcount
+
+#This function load the records of a table with INSERTs of restore_page_size rows, the values are sent as parameters
+def insert_records(cursor, table_name, columns, records):
+    insert_query = sql.SQL("INSERT INTO {} ({}) VALUES %s").format(
+        sql.Identifier('migration', table_name), sql.SQL(', ').join(map(sql.Identifier, columns)))
+    rows_inserted = 0
+    values = ([record[column] for column in columns] for record in records)
+    while True:
+        page = list(itertools.islice(values, restore_page_size))
+        if not page:
+            return rows_inserted
+        execute_values(cursor, insert_query, page, page_size=restore_page_size)
+        rows_inserted += len(page)
+
+#This function drop the foreign keys and the indexes (except the primary keys) of the migration schema
+#It returns their definitions, so they can be created again after the load
+def drop_constraints_and_indexes(cursor):
+    cursor.execute("""
+        SELECT c.conrelid::regclass::text, c.conname, pg_get_constraintdef(c.oid)
+        FROM pg_constraint c
+        WHERE c.contype = 'f' AND c.connamespace = 'migration'::regnamespace
+    """)
+    foreign_keys = cursor.fetchall()
+    cursor.execute("""
+        SELECT i.indexname, i.indexdef
+        FROM pg_indexes i
+        WHERE i.schemaname = 'migration'
+          AND NOT EXISTS (SELECT 1 FROM pg_constraint c
+                          WHERE c.conname = i.indexname AND c.connamespace = 'migration'::regnamespace)
+    """)
+    indexes = cursor.fetchall()
     
-    # Retrieve parameters by path from SSM Parameter Store
-    response = ssm_client.get_parameters_by_path(Path=path,Recursive=True, WithDecryption=True)
+    for table_name, constraint_name, _ in foreign_keys:
+        cursor.execute(sql.SQL("ALTER TABLE {} DROP CONSTRAINT {}").format(sql.SQL(table_name), sql.Identifier(constraint_name)))
+    for index_name, _ in indexes:
+        cursor.execute(sql.SQL("DROP INDEX {}").format(sql.Identifier('migration', index_name)))
+    return foreign_keys, indexes
+
+#This function create again the foreign keys and indexes dropped before the load
+def create_constraints_and_indexes(cursor, foreign_keys, indexes):
+    for _, index_definition in indexes:
+        cursor.execute(index_definition)
+    for table_name, constraint_name, constraint_definition in foreign_keys:
+        cursor.execute(sql.SQL("ALTER TABLE {} ADD CONSTRAINT {} {}").format(
+            sql.SQL(table_name), sql.Identifier(constraint_name), sql.SQL(constraint_definition)))
+
+def lambda_handler(event, context):
     
-    # Extract the parameters values from the response
-    parameters_to_extract = response['Parameters']
-    parameters = extract_parameters_from_response(parameters_to_extract)
+    # The database configuration and the connection are cached by the layer while the lambda is warm
+    config = get_database_config()
     
-    #Set all the required parameters for the RDS database
-    #Describe the RDS instance to extract the endpoint using the database_identifier parameter stored in SSM 
-    response_describe_db = rds_client.describe_db_instances(DBInstanceIdentifier=parameters['database_identifier'])
-    endpoint = response_describe_db['DBInstances'][0]['Endpoint']['Address']
-    port=parameters['port']
-    master_username = parameters['user']
-    master_password = parameters['password']
-    database_name = parameters['databasename']
-
     # S3 bucket configuration
-    s3_bucket = parameters['bucketname']
+    s3_bucket = config['parameters']['bucketname']
+    # A single S3 client is shared by the download threads, the clients of boto3 can't be created by several threads at the same time
+    s3 = boto3.client('s3')
 
     # Connect to RDS database
-    conn = psycopg2.connect(
-        host=endpoint,
-        database=database_name,
-        user=master_username,
-        password=master_password
-    )
+    conn = get_connection()
     
     # Let's create the cursor
     cursor = conn.cursor()
     
-    # Get the last created folder
-    parent_folder_prefix='backups_tables/'
-    last_folder = get_last_created_folder(s3_bucket, parent_folder_prefix)
+    # The event can have the timestamp of the backup to restore (%Y-%m-%d_%H-%M-%S), by default the latest one
+    # If there is no backup with that timestamp, the last backup before it is restored
+    target_timestamp = event.get('timestamp', 'latest') if isinstance(event, dict) else 'latest'
+    table_names = ('hired_employees', 'departments', 'jobs')
     
-    if last_folder:
-        avro_table1 = f'backups_tables/{last_folder}/hired_employees.avro'
-        avro_table2 = f'backups_tables/{last_folder}/departments.avro'
-        avro_table3 = f'backups_tables/{last_folder}/jobs.avro'
-
-        # AVRO schema for tables
-        hired_employees_schema = '''{
-                "type": "record",
-                "name": "hired_employees",
-                "fields": [
-                    { "name": "id", "type": "int" },
-                    { "name": "name", "type": "string" },
-                    { "name": "datetime", "type": "string" },
-                    { "name": "department_id", "type": "int" },
-                    { "name": "job_id", "type": "int" }
-                ]
-            }'''
-            
-        departments_schema = '''{
-                "type": "record",
-                "name": "departments",
-                "fields": [
-                    { "name": "id", "type": "int" },
-                    { "name": "department", "type": "string" }
-                ]
-            }'''
-            
-        jobs_schema = '''{
-                "type": "record",
-                "name": "jobs",
-                "fields": [
-                    { "name": "id", "type": "int" },
-                    { "name": "job", "type": "string" }
-                ]
-            }'''
-
-        # Read AVRO data from S3
-        avro_data1 = read_avro_from_s3(s3_bucket, avro_table1)
-        avro_data2 = read_avro_from_s3(s3_bucket, avro_table2)
-        avro_data3 = read_avro_from_s3(s3_bucket, avro_table3)
-
-        # Deserialize AVRO data
-        hired_employees_records = deserialize_avro_data(avro_data1, hired_employees_schema)
-        departments_records = deserialize_avro_data(avro_data2, departments_schema)
-        jobs_records = deserialize_avro_data(avro_data3, jobs_schema)
+    # The state of the tables is a full backup plus its deltas, in the order they were written
+    catalog = load_backup_catalog(s3_bucket, s3)
+    backup_timestamp = find_backup(catalog, target_timestamp) if catalog else None
+    if backup_timestamp:
+        backup_files = {table_name: get_table_files(catalog, backup_timestamp, table_name) for table_name in table_names}
+    else:
+        # Backups written before the catalog only have full backup folders
+        parent_folder_prefix='backups_tables/'
+        last_folder = get_last_created_folder(s3_bucket, parent_folder_prefix, None if target_timestamp == 'latest' else target_timestamp, s3)
+        backup_files = {table_name: [{'key': f'backups_tables/{last_folder}/{table_name}.avro'}] for table_name in table_names} if last_folder else None
+        backup_timestamp = last_folder.replace('avro_tables_backup_', '', 1) if last_folder else None
+    
+    if backup_files:
+        # Time, rows and bytes of each stage of the restore: fetch, decode, load, constraints and commit
+        metrics = StageMetrics('restore', backup_timestamp=backup_timestamp)
+
+        # The files are read with the schema they were written with: the backups written before hired_employees.datetime
+        # was a timestamptz have the dates as strings in ISO format, and the database converts both of them
+        # Download the AVRO files from S3 at the same time (the three tables, the full backup and the deltas)
+        # The records are deserialized while they are loaded, so they are never all in memory
+        with ThreadPoolExecutor(max_workers=restore_download_workers) as executor:
+            futures = {table_name: [executor.submit(read_table_backup, s3_bucket, backup_file, None, metrics, s3) for backup_file in files]
+                       for table_name, files in backup_files.items()}
+            # The records of the deltas are loaded after the records of the full backup
+            records = {table_name: itertools.chain.from_iterable([future.result() for future in table_futures])
+                       for table_name, table_futures in futures.items()}
         
         # First we need to clean the database - to roll back into the last backup
-        delete_query='DELETE FROM migration.hired_employees;\
-                      DELETE FROM migration.departments;\
-                      DELETE FROM migration.jobs;'
-        cursor.execute(delete_query)
+        # TRUNCATE is transactional, if the restore fails the tables keep their data
+        with metrics.stage('truncate'):
+            cursor.execute('TRUNCATE migration.hired_employees, migration.departments, migration.jobs;')
+        
+        with metrics.stage('constraints'):
+            if restore_constraints == 'drop':
+                foreign_keys, indexes = drop_constraints_and_indexes(cursor)
+            elif restore_constraints == 'defer':
+                cursor.execute('SET CONSTRAINTS ALL DEFERRED;')
+        
+        # The tables are inserted in the order of the foreign keys: departments and jobs before hired_employees
+        # The records are decoded while they are loaded, the decode stage is not counted in the load stage
+        load_records = copy_records if restore_mode == 'copy' else insert_records
+        table_columns = [('departments', ['id', 'department']), ('jobs', ['id', 'job']),
+                         ('hired_employees', ['id', 'name', 'datetime', 'department_id', 'job_id'])]
+        restored_rows = {}
+        for table_name, columns in table_columns:
+            with metrics.stage('load') as counts:
+                restored_rows[table_name] = load_records(cursor, table_name, columns, records[table_name])
+                counts['rows'] = restored_rows[table_name]
         
-        sql_statements = []
-        for row in departments_records:
-            column1 = row['id']
-            column2 = row['department']
-            sql = f"""INSERT INTO migration.departments (id, department) VALUES ({column1}, $${column2}$$);"""
-            sql_statements.append(sql)
-
-        for sql in  sql_statements:
-            cursor.execute(sql)
+        with metrics.stage('constraints'):
+            if restore_constraints == 'drop':
+                # The foreign keys are validated once over the whole tables
+                create_constraints_and_indexes(cursor, foreign_keys, indexes)
         
-        sql_statements = []
-        for row in jobs_records:
-            column1 = row['id']
-            column2 = row['job']
-            sql = f"""INSERT INTO migration.jobs (id, job) VALUES ({column1}, $${column2}$$);"""
-            sql_statements.append(sql)
-            
-        for sql in  sql_statements:
-            cursor.execute(sql)
-            
-        sql_statements = []
-        for row in hired_employees_records:
-            column1 = row['id']
-            column2 = row['name']
-            column3 = row['datetime']
-            column4 = row['department_id']
-            column5 = row['job_id']
-            sql = f"""INSERT INTO migration.hired_employees (id, name, datetime, department_id, job_id) VALUES ({column1}, $${column2}$$, $${column3}$$, {column4}, {column5});"""
-            sql_statements.append(sql)
-            
-        for sql in  sql_statements:
-            cursor.execute(sql)
-
-        conn.commit()
+        with metrics.stage('commit', rows=sum(restored_rows.values())):
+            conn.commit()
+            # The cached reports are refreshed when the version of the data changes
+            bump_data_version_after_commit(conn)
         cursor.close()
-        conn.close()
+        metrics.log(restored_rows=restored_rows)
         return {
         'statusCode': 200,
-        'body': 'AVRO tables backup successfully restored into RDS database'
+        'body': 'AVRO tables backup successfully restored into RDS database',
+        'backup_timestamp': backup_timestamp,
+        'restored_rows': restored_rows,
+        'metrics': metrics.summary()
         }
         
     else:
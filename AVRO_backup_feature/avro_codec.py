@@ -0,0 +1,78 @@
+#This module writes and reads the AVRO files of the backups, it is deployed with the backup and restore lambdas
+#It uses fastavro (compiled, much faster per record) when it is installed and the avro package when it is not,
+#both write the same AVRO container files, so a backup written by one of them is restored by the other
+import os
+import json
+
+try:
+    import fastavro
+except ImportError:
+    fastavro = None
+import avro.schema
+import avro.datafile
+from avro.datafile import DataFileReader, DataFileWriter
+from avro.io import DatumReader, DatumWriter
+
+
+# Implementation of AVRO: auto (fastavro if it is installed), fastavro or avro
+avro_backend = os.environ.get('AVRO_BACKEND', 'auto')
+# Compression of the blocks: null, deflate, snappy or zstandard (snappy and zstandard need their python packages)
+backup_codec = os.environ.get('BACKUP_CODEC', 'deflate')
+# Approximate size in bytes of each block, a block is the unit of compression
+sync_interval = int(os.environ.get('BACKUP_SYNC_INTERVAL', 64*1024))
+
+codecs = ('null', 'deflate', 'snappy', 'zstandard')
+# The avro package renamed Parse to parse in the version 1.10
+parse_avro_schema = getattr(avro.schema, 'parse', None) or avro.schema.Parse
+
+
+#This function help us to know which implementation is used
+def get_backend(backend=None):
+    backend = backend or avro_backend
+    if backend == 'auto':
+        return 'fastavro' if fastavro is not None else 'avro'
+    if backend == 'fastavro' and fastavro is None:
+        raise ImportError("AVRO_BACKEND is fastavro but the fastavro package is not installed")
+    return backend
+
+#This function write the records in an AVRO file, the file object can be a file or a S3MultipartWriter
+#The records can be a generator, they are written block by block, and it returns the records written
+def write_records(file_object, schema, records, codec=None, sync_interval=sync_interval, backend=None):
+    codec = codec or backup_codec
+    if codec not in codecs:
+        raise ValueError(f"Codec not supported: {codec}")
+    records_written = 0
+
+    def counted_records():
+        nonlocal records_written
+        for record in records:
+            records_written += 1
+            yield record
+
+    if get_backend(backend) == 'fastavro':
+        parsed_schema = fastavro.parse_schema(json.loads(schema))
+        fastavro.writer(file_object, parsed_schema, counted_records(), codec=codec, sync_interval=sync_interval)
+    else:
+        # The avro package reads the size of the blocks from a module constant
+        avro.datafile.SYNC_INTERVAL = sync_interval
+        avro_schema = parse_avro_schema(schema)
+        data_file_writer = DataFileWriter(file_object, DatumWriter(avro_schema), avro_schema, codec=codec)
+        for record in counted_records():
+            data_file_writer.append(record)
+        # Write the last block
+        data_file_writer.flush()
+    return records_written
+
+#This function read the records of an AVRO file, they are decoded while they are read
+#The codec is read from the header of the file, so the files of any codec are read
+#Without a schema the records are read with the schema of the file (the schema used when the file was written)
+def read_records(file_object, schema=None, backend=None):
+    if get_backend(backend) == 'fastavro':
+        reader_schema = fastavro.parse_schema(json.loads(schema)) if schema else None
+        for record in fastavro.reader(file_object, reader_schema=reader_schema):
+            yield record
+    else:
+        data_file_reader = DataFileReader(file_object, DatumReader(parse_avro_schema(schema) if schema else None))
+        for record in data_file_reader:
+            yield record
+        data_file_reader.close()
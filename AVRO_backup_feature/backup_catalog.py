@@ -0,0 +1,78 @@
+#This module reads and writes the catalog of the backups, it is deployed with the backup and restore lambdas
+#The catalog is a single object updated after each backup, so the restore finds any backup without listing S3:
+#{"latest": "<ts>",
+# "tables": {"hired_employees": {"high_water_mark": 1999, "row_count": 1929}},
+# "backups": {"<ts>": {"type": "full" or "delta", "folder": "backups_tables/avro_tables_<backup|delta>_<ts>/",
+#                      "created_at": "<iso datetime>", "restore_chain": ["<ts of the full backup>", ..., "<ts>"],
+#                      "files": {"hired_employees": {"key": "<key>", "rows": 10, "bytes": 512, "sha256": "<hex>"}},
+#                      "table_rows": {"hired_employees": 1929}}}}
+import json
+import bisect
+import boto3
+from datetime import datetime
+from botocore.exceptions import ClientError
+
+
+catalog_key = 'backups_tables/backup_catalog.json'
+
+
+#This function read the catalog, it returns None if there is no backup in the catalog yet
+def load_backup_catalog(s3_bucket, s3_client=None):
+    s3 = s3_client or boto3.client('s3')
+    try:
+        response = s3.get_object(Bucket=s3_bucket, Key=catalog_key)
+    except ClientError as error:
+        if error.response['Error']['Code'] in ('NoSuchKey', '404'):
+            return None
+        raise
+    return json.loads(response['Body'].read())
+
+#This function write the catalog, it must be written after all the files of the backup were uploaded
+def save_backup_catalog(s3_bucket, catalog, s3_client=None):
+    s3 = s3_client or boto3.client('s3')
+    s3.put_object(Bucket=s3_bucket, Key=catalog_key, Body=json.dumps(catalog, indent=1).encode('utf-8'))
+
+#This function add a backup to the catalog and make it the latest one
+#files has the key, rows, bytes and sha256 of each file, tables_state the high-water marks after the backup
+def add_backup(catalog, timestamp, backup_type, folder, files, tables_state):
+    if catalog is None:
+        catalog = {'latest': None, 'tables': {}, 'backups': {}}
+    if backup_type == 'full':
+        restore_chain = [timestamp]
+    else:
+        restore_chain = catalog['backups'][catalog['latest']]['restore_chain'] + [timestamp]
+    catalog['backups'][timestamp] = {
+        'type': backup_type,
+        'folder': folder,
+        'created_at': datetime.now().isoformat(timespec='seconds'),
+        'restore_chain': restore_chain,
+        'files': files,
+        'table_rows': {table_name: state['row_count'] for table_name, state in tables_state.items()}
+    }
+    catalog['latest'] = timestamp
+    catalog['tables'] = tables_state
+    return catalog
+
+#This function return the deltas written after the full backup of the latest backup
+def count_latest_deltas(catalog):
+    return len(catalog['backups'][catalog['latest']]['restore_chain']) - 1
+
+#This function find the timestamp of a backup: the latest one, the one with the same timestamp or
+#the last one before the timestamp (the timestamps have the format %Y-%m-%d_%H-%M-%S, so they are sorted as text)
+def find_backup(catalog, timestamp=None):
+    if timestamp is None or timestamp == 'latest':
+        return catalog['latest']
+    if timestamp in catalog['backups']:
+        return timestamp
+    timestamps = sorted(catalog['backups'])
+    position = bisect.bisect_right(timestamps, timestamp)
+    return timestamps[position-1] if position > 0 else None
+
+#This function return the files that rebuild a table at a backup: the file of the full backup and the files of the deltas
+def get_table_files(catalog, timestamp, table_name):
+    files = []
+    for backup_timestamp in catalog['backups'][timestamp]['restore_chain']:
+        backup_files = catalog['backups'][backup_timestamp]['files']
+        if table_name in backup_files:
+            files.append(backup_files[table_name])
+    return files
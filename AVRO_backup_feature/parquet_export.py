@@ -0,0 +1,140 @@
+#This module writes the columnar export of the backups and computes the BI reports from it without the database
+#Each backup can write hired_employees_bi.parquet next to the AVRO files: the hires with the names of the department and
+#the job (dictionary encoded, there are few distinct names) and the year and quarter of the hire
+#It needs pyarrow, when it is not installed the export is not written
+import os
+from io import BytesIO
+from datetime import timezone
+import boto3
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+from s3_multipart_writer import S3MultipartWriter
+from stage_metrics import StageMetrics
+from backup_catalog import load_backup_catalog, find_backup, get_table_files
+
+
+# Rows of each row group of the Parquet file
+row_group_size = int(os.environ.get('PARQUET_ROW_GROUP_SIZE', 100000))
+# Rows read from the server-side cursor on each round trip
+fetch_size = int(os.environ.get('BACKUP_FETCH_SIZE', 10000))
+
+parquet_table_name = 'hired_employees_bi'
+parquet_query = ("SELECT he.id,he.name,he.datetime,he.department_id,d.department,he.job_id,j.job "
+                 "FROM migration.hired_employees he "
+                 "LEFT JOIN migration.departments d ON d.id = he.department_id "
+                 "LEFT JOIN migration.jobs j ON j.id = he.job_id")
+# The delta export only has the hires after the high-water mark of hired_employees
+parquet_delta_query = parquet_query + " WHERE he.id > %s"
+
+
+#This function help us to know if the Parquet export can be written
+def is_parquet_available():
+    return pa is not None
+
+def get_parquet_schema():
+    return pa.schema([
+        ('id', pa.int32()),
+        ('name', pa.string()),
+        ('datetime', pa.timestamp('ms', tz='UTC')),
+        ('department_id', pa.int32()),
+        ('department', pa.dictionary(pa.int32(), pa.string())),
+        ('job_id', pa.int32()),
+        ('job', pa.dictionary(pa.int32(), pa.string())),
+        ('year', pa.int16()),
+        ('quarter', pa.int8())
+    ])
+
+#This function extract the year and the quarter of the datetime of a hire, in UTC like the BI reports
+def get_year_and_quarter(value):
+    if value is None:
+        return None, None
+    value = value.astimezone(timezone.utc)
+    return value.year, (value.month - 1) // 3 + 1
+
+#This function build a row group with the rows read from the database
+def build_record_batch(rows, schema):
+    columns = list(zip(*rows))
+    years_and_quarters = [get_year_and_quarter(value) for value in columns[2]]
+    columns.append([year for year, _ in years_and_quarters])
+    columns.append([quarter for _, quarter in years_and_quarters])
+    return pa.RecordBatch.from_arrays([pa.array(column, type=field.type) for column, field in zip(columns, schema)], schema=schema)
+
+#This function stream the hires from the database to a Parquet file in S3, with the same arguments of backup_table_to_s3
+#The fetch, encode and upload stages of the file are logged and added to the metrics of the backup
+#It returns the key, rows, bytes and checksum of the file for the catalog
+def export_parquet_to_s3(conn, query, schema, s3_bucket, file_key, cursor_name, query_parameters=None, metrics=None, s3_client=None):
+    file_metrics = StageMetrics('backup', file=file_key)
+    rows_written = 0
+    with S3MultipartWriter(s3_bucket, file_key, s3_client, metrics=file_metrics) as s3_writer:
+        parquet_writer = pq.ParquetWriter(s3_writer, schema, compression='snappy', use_dictionary=['department', 'job'])
+        cursor = conn.cursor(name=cursor_name)
+        cursor.execute(query, query_parameters)
+        rows = []
+        while True:
+            with file_metrics.stage('fetch') as counts:
+                fetched_rows = cursor.fetchmany(fetch_size)
+                counts['rows'] = len(fetched_rows)
+            rows.extend(fetched_rows)
+            # Each row group has row_group_size rows, except the last one
+            while len(rows) >= row_group_size or (not fetched_rows and rows):
+                row_group, rows = rows[:row_group_size], rows[row_group_size:]
+                with file_metrics.stage('encode', rows=len(row_group)):
+                    parquet_writer.write_batch(build_record_batch(row_group, schema))
+                rows_written += len(row_group)
+            if not fetched_rows:
+                break
+        cursor.close()
+        with file_metrics.stage('encode'):
+            parquet_writer.close()
+    file_metrics.log(rows=rows_written, bytes=s3_writer.position)
+    if metrics is not None:
+        metrics.merge(file_metrics.summary())
+    return {'key': file_key, 'rows': rows_written, 'bytes': s3_writer.position, 'sha256': s3_writer.sha256.hexdigest()}
+
+#This function read the Parquet files of a backup (the full backup and its deltas) as a single table
+#Only the columns of the report are read
+def read_parquet_snapshot(s3_bucket, backup_files, columns=('department', 'job', 'year', 'quarter')):
+    s3 = boto3.client('s3')
+    tables = []
+    for backup_file in backup_files:
+        parquet_data = s3.get_object(Bucket=s3_bucket, Key=backup_file['key'])['Body'].read()
+        tables.append(pq.read_table(BytesIO(parquet_data), columns=list(columns)))
+    return pa.concat_tables(tables)
+
+#This function compute the REPORT 1 of BI_dashboard/BI_Queries.sql from the Parquet snapshot: the hires of each
+#department and job by quarter of a year, sorted by department and job
+def quarterly_hires_report(table, year=2021):
+    table = table.filter(pc.and_(pc.equal(table['year'], year),
+                                 pc.and_(pc.is_valid(table['department']), pc.is_valid(table['job']))))
+    # The dictionary columns are decoded to group by the names
+    table = pa.table({
+        'department': table['department'].cast(pa.string()),
+        'job': table['job'].cast(pa.string()),
+        'quarter': table['quarter']
+    })
+    counts = table.group_by(['department', 'job', 'quarter']).aggregate([('quarter', 'count')])
+
+    report = {}
+    for department, job, quarter, hires in zip(counts['department'].to_pylist(), counts['job'].to_pylist(),
+                                               counts['quarter'].to_pylist(), counts['quarter_count'].to_pylist()):
+        row = report.setdefault((department, job), {'department': department, 'job': job, 'q1': 0, 'q2': 0, 'q3': 0, 'q4': 0})
+        row[f'q{quarter}'] = hires
+    return [report[key] for key in sorted(report)]
+
+#This function compute the quarterly hires report from the Parquet export of a backup (the latest one by default),
+#so the report doesn't run any query in the database. It returns None if there is no backup with the export
+def quarterly_report_from_backup(s3_bucket, timestamp='latest', year=2021):
+    catalog = load_backup_catalog(s3_bucket)
+    backup_timestamp = find_backup(catalog, timestamp) if catalog else None
+    if backup_timestamp is None:
+        return None
+    backup_files = get_table_files(catalog, backup_timestamp, parquet_table_name)
+    if not backup_files:
+        return None
+    return quarterly_hires_report(read_parquet_snapshot(s3_bucket, backup_files), year)
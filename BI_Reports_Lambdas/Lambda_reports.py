@@ -0,0 +1,347 @@
+#This lambda serves the BI reports of BI_dashboard/BI_Queries.sql in the /reports/{report} endpoint of the API
+#The reports are read from materialized views that are refreshed only when the version of the data changes
+#(the migration and restore lambdas increase it when they commit), and the responses are cached in the container
+#and have an ETag, so a refresh of the dashboard without new data doesn't run any query on the reports
+#The reports can be filtered by year, quarter and department and they are read in pages (keyset pagination),
+#so a dashboard of several years never builds the whole report in the memory of the lambda or in a single response
+import os
+import json
+import time
+import gzip
+import base64
+import hashlib
+from io import BytesIO
+from collections import OrderedDict
+from psycopg2 import errors
+from connection_cache import get_connection
+from data_version import get_data_version, query_create_data_version
+
+
+# Seconds that the version of the data is used without reading it again from the database
+version_ttl = int(os.environ.get('REPORT_VERSION_TTL', 60))
+# Seconds that the clients can keep a response without asking again (Cache-Control max-age)
+cache_max_age = int(os.environ.get('REPORT_CACHE_MAX_AGE', 60))
+# Year of the reports when the request doesn't have one
+default_year = int(os.environ.get('REPORT_DEFAULT_YEAR', 2021))
+# Rows of a page when the request doesn't have a limit, and the max rows of a page
+default_page_size = int(os.environ.get('REPORT_PAGE_SIZE', 1000))
+max_page_size = int(os.environ.get('REPORT_MAX_PAGE_SIZE', 10000))
+# Pages kept in the memory of the container (the oldest ones are removed first)
+cache_max_entries = int(os.environ.get('REPORT_CACHE_ENTRIES', 256))
+
+# The views have the hires of every year and quarter, the reports filter the ones of the request
+# The year and the quarter are the ones of the date in UTC, like the dates of the files
+# The unique indexes are needed to refresh the views without blocking the reports (REFRESH ... CONCURRENTLY)
+query_create_report_views = """
+    CREATE MATERIALIZED VIEW IF NOT EXISTS migration.report_hires_by_quarter AS
+    SELECT EXTRACT(year FROM (he.datetime AT TIME ZONE 'UTC'))::integer AS year,
+           d.id AS department_id, d.department, j.id AS job_id, j.job,
+           COUNT(*) FILTER (WHERE EXTRACT(quarter FROM (he.datetime AT TIME ZONE 'UTC')) = 1) AS q1,
+           COUNT(*) FILTER (WHERE EXTRACT(quarter FROM (he.datetime AT TIME ZONE 'UTC')) = 2) AS q2,
+           COUNT(*) FILTER (WHERE EXTRACT(quarter FROM (he.datetime AT TIME ZONE 'UTC')) = 3) AS q3,
+           COUNT(*) FILTER (WHERE EXTRACT(quarter FROM (he.datetime AT TIME ZONE 'UTC')) = 4) AS q4
+    FROM migration.hired_employees he
+    INNER JOIN migration.departments d ON d.id = he.department_id
+    INNER JOIN migration.jobs j ON j.id = he.job_id
+    WHERE he.datetime IS NOT NULL
+    GROUP BY 1, d.id, d.department, j.id, j.job;
+    CREATE UNIQUE INDEX IF NOT EXISTS report_hires_by_quarter_key ON migration.report_hires_by_quarter (year, department_id, job_id);
+
+    CREATE MATERIALIZED VIEW IF NOT EXISTS migration.report_department_quarter_hires AS
+    SELECT EXTRACT(year FROM (he.datetime AT TIME ZONE 'UTC'))::integer AS year,
+           EXTRACT(quarter FROM (he.datetime AT TIME ZONE 'UTC'))::integer AS quarter,
+           d.id AS department_id, d.department, COUNT(*) AS hired
+    FROM migration.hired_employees he
+    INNER JOIN migration.departments d ON d.id = he.department_id
+    WHERE he.datetime IS NOT NULL
+    GROUP BY 1, 2, d.id, d.department;
+    CREATE UNIQUE INDEX IF NOT EXISTS report_department_quarter_hires_key ON migration.report_department_quarter_hires (year, quarter, department_id);
+"""
+
+report_views = ['migration.report_hires_by_quarter', 'migration.report_department_quarter_hires']
+
+# REPORT 1: hires of each department and job by quarter
+# REPORT 2: departments that hired more employees than the average of the departments
+# The reports run as prepared statements, the parameters are always the same:
+# $1 year, $2 quarter, $3 department, $4 and $5 key of the last row of the previous page, $6 rows to read
+# A NULL quarter or department means all of them, a NULL key means the first page
+# With a quarter, REPORT 1 only has the hires of that quarter and REPORT 2 uses the hires of that quarter
+# The department is filtered after the average, so REPORT 2 keeps the average of all the departments
+# "key" has the columns of the row that are the key of the next page, in the order of the report
+reports = {
+    'hires_by_quarter': {
+        'parameter_types': ['integer', 'integer', 'text', 'text', 'text', 'integer'],
+        'key': ['department', 'job'],
+        'query': """
+            SELECT department, job,
+                   SUM(CASE WHEN $2 IS NULL OR $2 = 1 THEN q1 ELSE 0 END)::integer AS q1,
+                   SUM(CASE WHEN $2 IS NULL OR $2 = 2 THEN q2 ELSE 0 END)::integer AS q2,
+                   SUM(CASE WHEN $2 IS NULL OR $2 = 3 THEN q3 ELSE 0 END)::integer AS q3,
+                   SUM(CASE WHEN $2 IS NULL OR $2 = 4 THEN q4 ELSE 0 END)::integer AS q4
+            FROM migration.report_hires_by_quarter
+            WHERE year = $1
+              AND ($3 IS NULL OR department = $3)
+              AND ($4 IS NULL OR (department, job) > ($4, $5))
+            GROUP BY department, job
+            HAVING SUM(CASE WHEN $2 IS NULL THEN q1 + q2 + q3 + q4
+                            WHEN $2 = 1 THEN q1 WHEN $2 = 2 THEN q2 WHEN $2 = 3 THEN q3 ELSE q4 END) > 0
+            ORDER BY department asc, job asc
+            LIMIT $6
+        """
+    },
+    'departments_above_average': {
+        'parameter_types': ['integer', 'integer', 'text', 'integer', 'integer', 'integer'],
+        'key': ['hired', 'id'],
+        'query': """
+            WITH department_hires AS (
+                SELECT department_id, department, SUM(hired)::integer AS hired
+                FROM migration.report_department_quarter_hires
+                WHERE year = $1 AND ($2 IS NULL OR quarter = $2)
+                GROUP BY department_id, department
+            )
+            SELECT department_id AS id, department, hired
+            FROM department_hires
+            WHERE hired > (SELECT AVG(hired) FROM department_hires)
+              AND ($3 IS NULL OR department = $3)
+              AND ($4 IS NULL OR hired < $4 OR (hired = $4 AND department_id > $5))
+            ORDER BY hired DESC, department_id asc
+            LIMIT $6
+        """
+    }
+}
+
+# These values live while the lambda container is warm
+_views_created = False
+_views_version = None
+_views_version_read_at = 0.0
+# Connection where the reports were prepared and names of the prepared statements, they only live in that session
+_prepared_connection = None
+_prepared_statements = set()
+# (report, filters, page, format, gzip): (version of the views, body of the response, key of the next page)
+_reports = OrderedDict()
+
+
+#This function create the version table and the materialized views the first time the lambda runs
+def create_report_views(conn):
+    cursor = conn.cursor()
+    cursor.execute(query_create_data_version)
+    cursor.execute(query_create_report_views)
+    cursor.close()
+    conn.commit()
+
+#This function run a function that reads the views, if the views were dropped (e.g. by the schema migration)
+#they are created again before trying again
+def with_report_views(conn, function, *args):
+    try:
+        return function(conn, *args)
+    except errors.UndefinedTable:
+        conn.rollback()
+        create_report_views(conn)
+        return function(conn, *args)
+
+#This function refresh the materialized views with the data of a version, only one lambda refreshes them at a time
+#It returns the version of the data that the views have
+def refresh_report_views(conn, version):
+    cursor = conn.cursor()
+    cursor.execute("SELECT pg_try_advisory_xact_lock(hashtext('migration.report_views'))")
+    if cursor.fetchone()[0]:
+        _, views_version = get_data_version(cursor)
+        # Another lambda could have refreshed them while we were waiting
+        if views_version < version:
+            for view in report_views:
+                cursor.execute(f"REFRESH MATERIALIZED VIEW CONCURRENTLY {view}")
+            cursor.execute("UPDATE migration.data_version SET views_version = %s WHERE id = 1", (version,))
+            views_version = version
+    else:
+        # Another lambda is refreshing them, the reports are served with the views that are already there
+        _, views_version = get_data_version(cursor)
+    cursor.close()
+    conn.commit()
+    return views_version
+
+#This function read the version of the data and the version of the views
+def read_data_version(conn):
+    cursor = conn.cursor()
+    version, views_version = get_data_version(cursor)
+    cursor.close()
+    conn.commit()
+    return version, views_version
+
+#This function return the version of the views, the database is asked only when the TTL expires
+def get_views_version(conn):
+    global _views_version, _views_version_read_at
+    now = time.monotonic()
+    if _views_version is None or now - _views_version_read_at > version_ttl:
+        # The version is created with the views if it doesn't exist yet (e.g. the sequence of a deployed database)
+        version, views_version = with_report_views(conn, read_data_version)
+        if views_version < version:
+            views_version = with_report_views(conn, refresh_report_views, version)
+        _views_version = views_version
+        _views_version_read_at = now
+    return _views_version
+
+#This function prepare the statement of a report the first time it is used in the connection and execute it
+#If the views are created again the database plans the statement again, so it is prepared only once per session
+def execute_prepared_report(cursor, report_name, parameters):
+    global _prepared_connection
+    if _prepared_connection is not cursor.connection:
+        # The layer opened a new connection, the statements of the old session don't exist in it
+        _prepared_connection = cursor.connection
+        _prepared_statements.clear()
+    statement_name = f'report_{report_name}'
+    if statement_name not in _prepared_statements:
+        report = reports[report_name]
+        cursor.execute(f"PREPARE {statement_name} ({', '.join(report['parameter_types'])}) AS {report['query']}")
+        _prepared_statements.add(statement_name)
+    cursor.execute(f"EXECUTE {statement_name} ({', '.join(['%s'] * len(parameters))})", parameters)
+
+#This function read a page of a report from the materialized views as a list of records
+#It reads one more row than the limit to know if there is a next page, it returns the records and the key of the next page
+def read_report(conn, report_name, year, quarter, department, after, limit):
+    after = after or [None, None]
+    cursor = conn.cursor()
+    execute_prepared_report(cursor, report_name, (year, quarter, department, after[0], after[1], limit + 1))
+    columns = [col[0] for col in cursor.description]
+    rows = [dict(zip(columns, row)) for row in cursor.fetchall()]
+    cursor.close()
+    conn.commit()
+
+    next_key = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_key = [rows[-1][column] for column in reports[report_name]['key']]
+    return rows, next_key
+
+#These functions convert the key of the last row of a page to the cursor of the next page and back
+#The cursor is opaque for the clients, they only send the one of the previous response
+#The values of the key must have the types of the parameters $4 and $5 of the report, a cursor of the other report
+#or an edited cursor is rejected before it reaches the database
+def encode_page_cursor(key):
+    return base64.urlsafe_b64encode(json.dumps(key).encode('utf-8')).decode('ascii').rstrip('=')
+
+def decode_page_cursor(cursor, report_name):
+    key = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+    if not isinstance(key, list) or len(key) != 2:
+        raise ValueError('Invalid cursor')
+    for value, parameter_type in zip(key, reports[report_name]['parameter_types'][3:5]):
+        # bool is an int for python, but not for the database
+        if parameter_type == 'integer' and (not isinstance(value, int) or isinstance(value, bool)):
+            raise ValueError('Invalid cursor')
+        if parameter_type == 'text' and not isinstance(value, str):
+            raise ValueError('Invalid cursor')
+    return key
+
+#This function write the records of a page as a JSON array or as JSON lines (one record per line)
+#The records are written one by one, with gzip the body is compressed while it is written
+def encode_report_page(rows, ndjson, compress):
+    buffer = BytesIO()
+    output = gzip.GzipFile(fileobj=buffer, mode='wb', mtime=0) if compress else buffer
+    if ndjson:
+        for row in rows:
+            output.write(json.dumps(row).encode('utf-8') + b'\n')
+    else:
+        output.write(b'[')
+        for position, row in enumerate(rows):
+            output.write((',' if position else '').encode('utf-8') + json.dumps(row).encode('utf-8'))
+        output.write(b']')
+    if compress:
+        output.close()
+        # API Gateway needs binary bodies in base64
+        return base64.b64encode(buffer.getvalue()).decode('ascii')
+    return buffer.getvalue().decode('utf-8')
+
+#This function keep a page in the cache of the container, the oldest pages are removed when it is full
+def cache_report_page(cache_key, page):
+    _reports[cache_key] = page
+    _reports.move_to_end(cache_key)
+    while len(_reports) > cache_max_entries:
+        _reports.popitem(last=False)
+
+#This function read the filters and the page of the request, it raises ValueError with the message for the client
+def parse_report_parameters(query_parameters, report_name):
+    try:
+        year = int(query_parameters.get('year', default_year))
+    except ValueError:
+        raise ValueError('The year should be an integer')
+    quarter = query_parameters.get('quarter')
+    if quarter is not None:
+        if quarter not in ('1', '2', '3', '4'):
+            raise ValueError('The quarter should be 1, 2, 3 or 4')
+        quarter = int(quarter)
+    department = query_parameters.get('department') or None
+    try:
+        limit = int(query_parameters.get('limit', default_page_size))
+    except ValueError:
+        raise ValueError('The limit should be an integer')
+    if not 1 <= limit <= max_page_size:
+        raise ValueError(f'The limit should be between 1 and {max_page_size}')
+    after = query_parameters.get('cursor')
+    if after:
+        try:
+            after = decode_page_cursor(after, report_name)
+        except ValueError:
+            raise ValueError('Invalid cursor, use the X-Next-Cursor header of the previous page')
+    return year, quarter, department, after or None, limit
+
+#This function help us to know if the client already has the response, the header can have several ETags
+def is_not_modified(if_none_match, etag):
+    if not if_none_match:
+        return False
+    etags = [value.strip() for value in if_none_match.split(',')]
+    return '*' in etags or etag in etags or f'W/{etag}' in etags
+
+def build_response(status_code, body, etag=None, content_type='application/json', extra_headers=None):
+    headers = {'Content-Type': content_type, 'Cache-Control': f'max-age={cache_max_age}', 'Vary': 'Accept, Accept-Encoding'}
+    if etag:
+        headers['ETag'] = etag
+    headers.update(extra_headers or {})
+    return {'statusCode': status_code, 'headers': headers, 'body': body}
+
+def lambda_handler(event, context):
+    global _views_created
+
+    # Event of the API Gateway proxy integration: /reports/{report}?year=2021&quarter=1&department=Sales&limit=1000&cursor=...
+    # The format is JSON, or JSON lines with format=ndjson or the header Accept: application/x-ndjson
+    # With the header Accept-Encoding: gzip the body is compressed (the API must have */* as binary media type)
+    path_parameters = event.get('pathParameters') or {}
+    query_parameters = event.get('queryStringParameters') or {}
+    headers = {name.lower(): value for name, value in (event.get('headers') or {}).items()}
+
+    report_name = path_parameters.get('report')
+    if report_name not in reports:
+        return build_response(404, json.dumps({'error': f"Report not found, the reports are: {', '.join(reports)}"}))
+    try:
+        year, quarter, department, after, limit = parse_report_parameters(query_parameters, report_name)
+    except ValueError as error:
+        return build_response(400, json.dumps({'error': str(error)}))
+    ndjson = query_parameters.get('format') == 'ndjson' or 'application/x-ndjson' in headers.get('accept', '')
+    compress = 'gzip' in headers.get('accept-encoding', '')
+
+    # The configuration and the connection are cached by the layer, so they are reused while the lambda is warm
+    conn = get_connection()
+    if not _views_created:
+        create_report_views(conn)
+        _views_created = True
+
+    # The ETag changes only when the views are refreshed with new data, each page of each filter has its own ETag
+    views_version = get_views_version(conn)
+    cache_key = (report_name, year, quarter, department, tuple(after or ()), limit, ndjson, compress)
+    page_hash = hashlib.md5(json.dumps(cache_key, default=str).encode('utf-8')).hexdigest()[:16]
+    etag = f'"{report_name}-{page_hash}-{views_version}"'
+    if is_not_modified(headers.get('if-none-match'), etag):
+        return build_response(304, '', etag)
+
+    cached_report = _reports.get(cache_key)
+    if cached_report is None or cached_report[0] != views_version:
+        rows, next_key = with_report_views(conn, read_report, report_name, year, quarter, department, after, limit)
+        cached_report = (views_version, encode_report_page(rows, ndjson, compress), next_key and encode_page_cursor(next_key))
+    cache_report_page(cache_key, cached_report)
+
+    extra_headers = {}
+    if cached_report[2]:
+        extra_headers['X-Next-Cursor'] = cached_report[2]
+    if compress:
+        extra_headers['Content-Encoding'] = 'gzip'
+    response = build_response(200, cached_report[1], etag, 'application/x-ndjson' if ndjson else 'application/json', extra_headers)
+    response['isBase64Encoded'] = compress
+    return response
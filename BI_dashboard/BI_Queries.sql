@@ -1,14 +1,15 @@
 
+-- hired_employees.datetime is a timestamptz, the year is filtered with a range so the index hired_employees_datetime_idx is used
 -- REPORT 1
 SELECT d.department,j.job,
-        COUNT(CASE WHEN EXTRACT(quarter FROM TO_DATE(he.datetime, 'YYYY-MM-DD')) = 1 THEN 1 END) AS Q1,
-        COUNT(CASE WHEN EXTRACT(quarter FROM TO_DATE(he.datetime, 'YYYY-MM-DD')) = 2 THEN 1 END) AS Q2,
-        COUNT(CASE WHEN EXTRACT(quarter FROM TO_DATE(he.datetime, 'YYYY-MM-DD')) = 3 THEN 1 END) AS Q3,
-        COUNT(CASE WHEN EXTRACT(quarter FROM TO_DATE(he.datetime, 'YYYY-MM-DD')) = 4 THEN 1 END) AS Q4
+        COUNT(CASE WHEN EXTRACT(quarter FROM he.datetime AT TIME ZONE 'UTC') = 1 THEN 1 END) AS Q1,
+        COUNT(CASE WHEN EXTRACT(quarter FROM he.datetime AT TIME ZONE 'UTC') = 2 THEN 1 END) AS Q2,
+        COUNT(CASE WHEN EXTRACT(quarter FROM he.datetime AT TIME ZONE 'UTC') = 3 THEN 1 END) AS Q3,
+        COUNT(CASE WHEN EXTRACT(quarter FROM he.datetime AT TIME ZONE 'UTC') = 4 THEN 1 END) AS Q4
 FROM migration.hired_employees he
 INNER JOIN migration.departments d on (d.id = he.department_id) 
 INNER JOIN migration.jobs j on (j.id = he.job_id) 
-WHERE EXTRACT(year FROM TO_DATE(he.datetime, 'YYYY-MM-DD')) = 2021
+WHERE he.datetime >= '2021-01-01T00:00:00Z' AND he.datetime < '2022-01-01T00:00:00Z'
 GROUP BY d.department, j.job
 ORDER BY d.department asc, j.job asc
 
@@ -16,7 +17,7 @@ ORDER BY d.department asc, j.job asc
 WITH department_hires AS (
   SELECT he.department_id, COUNT(*) AS hire_count
   FROM migration.hired_employees he
-  WHERE EXTRACT(year FROM TO_DATE(he.datetime, 'YYYY-MM-DD')) = 2021
+  WHERE he.datetime >= '2021-01-01T00:00:00Z' AND he.datetime < '2022-01-01T00:00:00Z'
   GROUP BY department_id
 )
 ,department_avg AS (
@@ -0,0 +1,76 @@
+#Benchmark of the AVRO files of the backups
+#It measures the encode and decode throughput and the size of the file for each implementation and codec of avro_codec.py
+#The implementations and codecs that are not installed (fastavro, snappy, zstandard) are skipped
+#Usage: python Benchmarks/benchmark_avro_codecs.py --rows 200000 --sync-interval 65536
+import os
+import sys
+import time
+import random
+import argparse
+from io import BytesIO
+from datetime import datetime, timezone
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'AVRO_backup_feature'))
+from avro_codec import write_records, read_records, codecs, fastavro
+
+
+# Same schema of Create_Avro_backup.py
+hired_employees_schema = '''{
+        "type": "record",
+        "name": "hired_employees",
+        "fields": [
+            { "name": "id", "type": "int" },
+            { "name": "name", "type": "string" },
+            { "name": "datetime", "type": ["null", { "type": "long", "logicalType": "timestamp-millis" }] },
+            { "name": "department_id", "type": "int" },
+            { "name": "job_id", "type": "int" }
+        ]
+    }'''
+
+
+#This function generate synthetic hired_employees records like the ones read from the database
+def generate_hired_employees(rows, seed=7):
+    generator = random.Random(seed)
+    first_names = ['Harold', 'Ty', 'Lyman', 'Lola', 'Marva', 'Ruth', 'Jae', 'Beatriz', 'Emmanuel', 'Yolanda']
+    last_names = ['Vogt', 'Hughes', 'Hopps', 'Wilson', 'Suzuki', 'Lopez', 'Kim', 'Mendoza', 'Smith', 'Nguyen']
+    return [{
+        'id': row_id,
+        'name': f"{generator.choice(first_names)} {generator.choice(last_names)}",
+        'datetime': datetime(2021, generator.randint(1,12), generator.randint(1,28), generator.randint(0,23),
+                             generator.randint(0,59), generator.randint(0,59), tzinfo=timezone.utc),
+        'department_id': generator.randint(1, 12),
+        'job_id': generator.randint(1, 183)
+    } for row_id in range(1, rows+1)]
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark of the AVRO implementations and codecs')
+    parser.add_argument('--rows', type=int, default=200000)
+    parser.add_argument('--sync-interval', type=int, default=64*1024)
+    args = parser.parse_args()
+
+    records = generate_hired_employees(args.rows)
+    backends = ['avro'] + (['fastavro'] if fastavro is not None else [])
+    print(f"{'backend':10} {'codec':10} {'encode rows/s':>14} {'decode rows/s':>14} {'size MB':>9}")
+    for backend in backends:
+        for codec in codecs:
+            buffer = BytesIO()
+            try:
+                started = time.perf_counter()
+                write_records(buffer, hired_employees_schema, iter(records), codec=codec, sync_interval=args.sync_interval, backend=backend)
+                encode_seconds = time.perf_counter() - started
+            except Exception as error:
+                # The python package of the codec is not installed
+                print(f"{backend:10} {codec:10} skipped: {error}")
+                continue
+
+            size = buffer.tell()
+            buffer.seek(0)
+            started = time.perf_counter()
+            decoded = sum(1 for _ in read_records(buffer, hired_employees_schema, backend=backend))
+            decode_seconds = time.perf_counter() - started
+            assert decoded == len(records), (decoded, len(records))
+
+            print(f"{backend:10} {codec:10} {len(records)/encode_seconds:14,.0f} {len(records)/decode_seconds:14,.0f} {size/1024/1024:9.2f}")
+
+if __name__ == '__main__':
+    main()
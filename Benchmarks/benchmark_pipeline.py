@@ -0,0 +1,223 @@
+#End to end benchmark of the pipeline without AWS
+#It generates the source files (synthetic_data.py), creates the tables of Database_Setup_Lambdas/lambda_setup_backup.py
+#in a local PostgreSQL and runs the handlers of the lambdas with the in-memory S3, SSM and RDS of local_aws.py:
+#the generator (lambda_batch_job_test) sending the batches to the migration lambda (Lambda_migration_test) for each file,
+#the AVRO backup (Create_Avro_backup) and the restore of that backup (Restore_Avro_backup)
+#It reports the rows/s, the p50/p99 latency of the batches and the peak RSS of each step, the results can be saved
+#with --output and compared with a previous run with --baseline
+#The tables of the migration schema of the database of the DSN are dropped and created again
+#The configuration of the lambdas is read from the environment as always (e.g. LOAD_MODE, BACKUP_CODEC, RESTORE_MODE)
+#Usage: BENCHMARK_DSN="dbname=benchmark user=postgres" python Benchmarks/benchmark_pipeline.py --rows 100000 --error-rate 0.01 --output results.json
+import os
+import sys
+import json
+import time
+import argparse
+import resource
+import threading
+
+benchmarks_folder = os.path.dirname(os.path.abspath(__file__))
+for folder in ('Database_Setup_Lambdas', 'AVRO_backup_feature', 'Migration_Lambdas', os.path.join('Lambda_Layer', 'python')):
+    sys.path.insert(0, os.path.join(benchmarks_folder, '..', folder))
+from synthetic_data import generate_source_files
+from local_aws import install_local_aws
+
+
+# The files are migrated in the order of the foreign keys
+table_names = ['departments', 'jobs', 'hired_employees']
+
+
+#This function create the tables of the setup lambda again, so each run starts with empty tables
+def create_database(conn, query_create_schema, query_create_indexes, query_create_data_version):
+    with conn.cursor() as cursor:
+        cursor.execute("DROP SCHEMA IF EXISTS migration CASCADE")
+        cursor.execute(query_create_schema)
+        cursor.execute(query_create_indexes)
+        cursor.execute(query_create_data_version)
+    conn.commit()
+
+def count_rows(conn, table_name):
+    with conn.cursor() as cursor:
+        cursor.execute(f"SELECT count(*) FROM migration.{table_name}")
+        rows = cursor.fetchone()[0]
+    conn.commit()
+    return rows
+
+#This function return the value under which are the percent of the values (nearest rank)
+def percentile(values, percent):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[max(0, min(len(values) - 1, int(round(percent / 100 * len(values))) - 1))]
+
+#This function return the peak RSS of the process in MB, it only grows, so each step reports the peak until its end
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux gives KB and macOS bytes
+    return peak / 1024 / 1024 if sys.platform == 'darwin' else peak / 1024
+
+def step_result(name, rows, seconds, latencies=None, **fields):
+    result = {
+        'step': name,
+        'rows': rows,
+        'seconds': round(seconds, 3),
+        'rows_per_second': round(rows / seconds, 1) if seconds > 0 else None,
+        'p50_batch_ms': round(percentile(latencies, 50) * 1000, 2) if latencies else None,
+        'p99_batch_ms': round(percentile(latencies, 99) * 1000, 2) if latencies else None,
+        'peak_rss_mb': round(peak_rss_mb(), 1)
+    }
+    result.update(fields)
+    return result
+
+#This class gives each thread of the generator its own connection, like the containers of the migration lambda
+#(the connection of the layer is a single connection for the process)
+class ContainerConnections:
+    def __init__(self, new_connection):
+        self.new_connection = new_connection
+        self.local = threading.local()
+        self.connections = []
+        self.lock = threading.Lock()
+
+    def get_connection(self):
+        connection = getattr(self.local, 'connection', None)
+        if connection is None or connection.closed:
+            connection = self.local.connection = self.new_connection()
+            with self.lock:
+                self.connections.append(connection)
+        return connection
+
+    def close(self):
+        for connection in self.connections:
+            connection.close()
+        self.connections = []
+
+#This function migrate a source file with the generator lambda, the batches are sent to the migration lambda in the
+#same process (local transport) and the latency of each batch is measured
+def run_migration(local_aws, generator, migration, table_name, content, conn):
+    key = f'files/{table_name}.csv'
+    local_aws.s3.put_object(Bucket=local_aws.bucket, Key=key, Body=content)
+    head = local_aws.s3.head_object(Bucket=local_aws.bucket, Key=key)
+    event = {'Records': [{'s3': {'bucket': {'name': local_aws.bucket},
+                                 'object': {'key': key, 'eTag': head['ETag'], 'size': head['ContentLength']}}}]}
+
+    latencies = []
+    def create_timed_transport(*arguments):
+        send = generator.local_transport(migration.lambda_handler)
+        def timed_send(batch):
+            started = time.perf_counter()
+            response = send(batch)
+            latencies.append(time.perf_counter() - started)
+            return response
+        return timed_send
+    generator.create_transport = create_timed_transport
+
+    started = time.perf_counter()
+    # The generator returns the summary of the run, the last line of its history log (stages of stage_metrics.py included)
+    summary = generator.lambda_handler(event, None)
+    seconds = time.perf_counter() - started
+
+    source_rows = content.count(b'\n')
+    return step_result(f'migration {table_name}', source_rows, seconds, latencies,
+                       batches=len(latencies), migrated_rows=count_rows(conn, table_name), bytes=len(content),
+                       error_rows=summary['error_rows'],
+                       stages={stage: totals['seconds'] for stage, totals in summary['stages'].items()})
+
+def run_backup(local_aws, backup):
+    started = time.perf_counter()
+    response = backup.lambda_handler({}, None)
+    seconds = time.perf_counter() - started
+    backup_bytes = local_aws.s3.folder_size(local_aws.bucket, f"backups_tables/avro_tables_backup_{response['timestamp']}/")
+    return step_result('backup', sum(response['rows_written'].values()), seconds, bytes=backup_bytes,
+                       stages={stage: totals['seconds'] for stage, totals in response['metrics'].items()})
+
+def run_restore(restore):
+    started = time.perf_counter()
+    response = restore.lambda_handler({}, None)
+    seconds = time.perf_counter() - started
+    return step_result('restore', sum(response['restored_rows'].values()), seconds, restored_rows=response['restored_rows'],
+                       stages={stage: totals['seconds'] for stage, totals in response['metrics'].items()})
+
+def print_results(results, baseline=None):
+    baseline_steps = {result['step']: result for result in (baseline or {}).get('results', [])}
+    print(f"{'step':28} {'rows':>10} {'seconds':>9} {'rows/s':>12} {'p50 ms':>9} {'p99 ms':>9} {'peak MB':>8}")
+    for result in results:
+        p50 = '' if result['p50_batch_ms'] is None else f"{result['p50_batch_ms']:.2f}"
+        p99 = '' if result['p99_batch_ms'] is None else f"{result['p99_batch_ms']:.2f}"
+        line = (f"{result['step']:28} {result['rows']:10} {result['seconds']:9.2f} {result['rows_per_second'] or 0:12,.0f}"
+                f" {p50:>9} {p99:>9} {result['peak_rss_mb']:8.1f}")
+        base = baseline_steps.get(result['step'])
+        if base and base.get('rows_per_second') and result['rows_per_second']:
+            line += f"  rows/s x{result['rows_per_second'] / base['rows_per_second']:.2f} vs baseline"
+            if base.get('p99_batch_ms') and result['p99_batch_ms']:
+                line += f", p99 x{result['p99_batch_ms'] / base['p99_batch_ms']:.2f}"
+        print(line)
+        # The slowest stages of the step
+        slowest = sorted(result.get('stages', {}).items(), key=lambda item: item[1], reverse=True)[:3]
+        if slowest:
+            print(f"{'':28} " + ', '.join(f"{stage} {seconds:.2f} s" for stage, seconds in slowest))
+
+def main():
+    parser = argparse.ArgumentParser(description='End to end benchmark of the pipeline with local stand-ins of AWS')
+    parser.add_argument('--rows', type=int, default=100000, help='Rows of hired_employees')
+    parser.add_argument('--error-rate', type=float, default=0.01)
+    parser.add_argument('--batch-size', type=int, default=1000)
+    parser.add_argument('--concurrency', type=int, default=4, help='Batches sent at the same time by the generator')
+    parser.add_argument('--seed', type=int, default=7)
+    parser.add_argument('--skip-backup', action='store_true', help='Only migrate the files')
+    parser.add_argument('--output', help='File where the results are saved as JSON')
+    parser.add_argument('--baseline', help='Results of a previous run to compare with')
+    args = parser.parse_args()
+
+    # The configuration of the lambdas is read when they are imported
+    os.environ['TRANSPORT'] = 'local'
+    os.environ['BATCH_SIZE'] = str(args.batch_size)
+    os.environ['MAX_CONCURRENCY'] = str(args.concurrency)
+    # The files are never split in ranges, the ranges are migrated by other invocations of the lambda
+    os.environ['SPLIT_THRESHOLD_BYTES'] = '0'
+    # With errors in most of the batches the whole batches would be rejected, so by default only the rows with errors are
+    os.environ.setdefault('PARTIAL_ACCEPT', 'true')
+
+    local_aws = install_local_aws(os.environ.get('BENCHMARK_DSN', 'dbname=postgres'))
+    import connection_cache
+    import lambda_batch_job_test as generator
+    import Lambda_migration_test as migration
+    import Create_Avro_backup as backup
+    import Restore_Avro_backup as restore
+    from lambda_setup_backup import query_create_schema, query_create_indexes
+    from data_version import query_create_data_version
+
+    conn = connection_cache.new_connection()
+    create_database(conn, query_create_schema, query_create_indexes, query_create_data_version)
+    containers = ContainerConnections(connection_cache.new_connection)
+    migration.get_connection = containers.get_connection
+
+    started = time.perf_counter()
+    files = generate_source_files(args.rows, args.error_rate, seed=args.seed)
+    print(f"source files generated in {time.perf_counter() - started:.2f} s: "
+          + ', '.join(f"{table_name} {len(content)/1024/1024:.2f} MB" for table_name, content in files.items()))
+
+    results = []
+    for table_name in table_names:
+        results.append(run_migration(local_aws, generator, migration, table_name, files[table_name], conn))
+        containers.close()
+    if not args.skip_backup:
+        results.append(run_backup(local_aws, backup))
+        results.append(run_restore(restore))
+        # The restore must give back the rows that were migrated
+        migrated_rows = {result['step'].split(' ')[1]: result['migrated_rows'] for result in results if 'migrated_rows' in result}
+        assert results[-1]['restored_rows'] == migrated_rows, (results[-1]['restored_rows'], migrated_rows)
+    connection_cache.close_connection()
+    conn.close()
+    local_aws.uninstall()
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+    print_results(results, baseline)
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump({'arguments': vars(args), 'results': results}, output_file, indent=2)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+#Benchmark of the load of the restore lambda
+#It compares the old INSERT row by row against the execute_values and COPY modes of Restore_Avro_backup.py
+#It needs a local PostgreSQL, the schema migration is created in the database of the DSN if it doesn't exist
+#Usage: BENCHMARK_DSN="dbname=benchmark user=postgres" python Benchmarks/benchmark_restore.py --rows 200000
+import os
+import sys
+import time
+import random
+import argparse
+import psycopg2
+
+benchmarks_folder = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(benchmarks_folder, '..', 'AVRO_backup_feature'))
+sys.path.insert(0, os.path.join(benchmarks_folder, '..', 'Lambda_Layer', 'python'))
+sys.path.insert(0, os.path.join(benchmarks_folder, '..', 'Database_Setup_Lambdas'))
+import Restore_Avro_backup
+# Same tables of the setup lambda
+from lambda_setup_backup import query_create_schema, query_create_indexes
+from Restore_Avro_backup import copy_records, insert_records, drop_constraints_and_indexes, create_constraints_and_indexes
+
+
+hired_employees_columns = ['id', 'name', 'datetime', 'department_id', 'job_id']
+
+
+# Old load of Restore_Avro_backup.py, kept here as the baseline of the benchmark
+def legacy_insert_records(cursor, table_name, columns, records):
+    rows_inserted = 0
+    for record in records:
+        values = ', '.join(f'$${record[column]}$$' if isinstance(record[column], str) else str(record[column]) for column in columns)
+        cursor.execute(f"INSERT INTO migration.{table_name} ({', '.join(columns)}) VALUES ({values});")
+        rows_inserted += 1
+    return rows_inserted
+
+
+#This function generate synthetic records like the ones deserialized from the AVRO backup
+#The dates are strings like the backups written before datetime was a timestamptz, the database converts them
+def generate_records(rows, seed=7):
+    generator = random.Random(seed)
+    departments = [{'id': department_id, 'department': f"Department {department_id}"} for department_id in range(1, 13)]
+    jobs = [{'id': job_id, 'job': f"Job {job_id}"} for job_id in range(1, 184)]
+    hired_employees = [{
+        'id': row_id,
+        # Names with quotes and commas, the COPY and execute_values modes must keep them
+        'name': f"Employee \"{row_id}\", O'Neil",
+        'datetime': f"2021-{generator.randint(1,12):02d}-{generator.randint(1,28):02d}T{generator.randint(0,23):02d}:{generator.randint(0,59):02d}:{generator.randint(0,59):02d}Z",
+        'department_id': generator.randint(1, 12),
+        'job_id': generator.randint(1, 183)
+    } for row_id in range(1, rows+1)]
+    return departments, jobs, hired_employees
+
+#This function restore the three tables with a load function and return the seconds of the load
+def run(conn, load_records, departments, jobs, hired_employees, drop_constraints=False):
+    cursor = conn.cursor()
+    cursor.execute('TRUNCATE migration.hired_employees, migration.departments, migration.jobs;')
+    conn.commit()
+
+    started = time.perf_counter()
+    if drop_constraints:
+        foreign_keys, indexes = drop_constraints_and_indexes(cursor)
+    load_records(cursor, 'departments', ['id', 'department'], iter(departments))
+    load_records(cursor, 'jobs', ['id', 'job'], iter(jobs))
+    load_records(cursor, 'hired_employees', hired_employees_columns, iter(hired_employees))
+    if drop_constraints:
+        create_constraints_and_indexes(cursor, foreign_keys, indexes)
+    conn.commit()
+    seconds = time.perf_counter() - started
+
+    cursor.execute('SELECT count(*) FROM migration.hired_employees')
+    restored_rows = cursor.fetchone()[0]
+    cursor.close()
+    return seconds, restored_rows
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark of the load of the restore')
+    parser.add_argument('--rows', type=int, default=200000)
+    parser.add_argument('--legacy-rows', type=int, default=20000, help='The old load is slow, it only loads these rows')
+    args = parser.parse_args()
+
+    conn = psycopg2.connect(os.environ.get('BENCHMARK_DSN', 'dbname=postgres'))
+    with conn.cursor() as cursor:
+        cursor.execute(query_create_schema)
+        cursor.execute(query_create_indexes)
+    conn.commit()
+
+    departments, jobs, hired_employees = generate_records(args.rows)
+    cases = [
+        ('INSERT row by row', legacy_insert_records, hired_employees[:args.legacy_rows], False),
+        ('execute_values', insert_records, hired_employees, False),
+        ('COPY', copy_records, hired_employees, False),
+        ('COPY, drop constraints', copy_records, hired_employees, True)
+    ]
+    print(f"page size of execute_values: {Restore_Avro_backup.restore_page_size}")
+    for name, load_records, records, drop_constraints in cases:
+        seconds, restored_rows = run(conn, load_records, departments, jobs, records, drop_constraints)
+        assert restored_rows == len(records), (restored_rows, len(records))
+        print(f"{name:24} {restored_rows:10} rows  {seconds:8.2f} s  {restored_rows/seconds:12,.0f} rows/s")
+
+    # The names must be restored without changes
+    with conn.cursor() as cursor:
+        cursor.execute('SELECT name FROM migration.hired_employees WHERE id = 1')
+        assert cursor.fetchone()[0] == hired_employees[0]['name']
+    conn.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,159 @@
+#Benchmark of the row validation of the migration lambda
+#It compares the old row by row validation functions against the compiled schemas of row_validation.py
+#Usage: python Benchmarks/benchmark_validation.py --rows 1000000 --batch-size 1000 --error-rate 0.001
+import os
+import sys
+import time
+import random
+import argparse
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Migration_Lambdas'))
+from row_validation import validators
+
+
+# Old validation functions of Lambda_migration_test.py, kept here as the baseline of the benchmark
+#This function help us to check if the payload has the minimum requirements.
+def validation_hired_employees(rows,batch_id):
+    pass_=1
+    logs=[['Batch_Id','Row','Errors']]
+    for row in rows:
+        
+        if len(row) == 5:
+            log=[batch_id,str(row),[]]
+            first_column = row[0]
+            second_column = row[1]
+            third_column = row[2]
+            fourth_column = row[3]
+            fifth_column = row[4]
+            # Validate the first column as an integer
+            try:
+                first_column = int(first_column)
+            except ValueError:
+                log[2].append("Validation Error: First value should be an integer")
+                pass_=0
+
+            # Validate the second column as a string
+            if not isinstance(second_column, str) or second_column=='':
+                log[2].append("Validation Error: Second value should be a string and must not be empty")
+                pass_=0
+                
+            # Validate the third column as a datetime in ISO format
+            try:
+                datetime.strptime(third_column, '%Y-%m-%dT%H:%M:%SZ')
+            except ValueError:
+                log[2].append("Validation Error: Third value should be a datetime in ISO format")
+                pass_=0
+            try:
+                fourth_column = int(fourth_column)
+            except ValueError:
+                log[2].append("Validation Error: Fourth value should be an integer")
+                pass_=0
+            
+            try:
+                fifth_column = int(fifth_column)
+            except ValueError:
+                log[2].append("Validation Error: Fifth value should be an integer")
+                pass_=0
+
+        else:
+            log[2].append("Validation Error: Data malformed, more or less than the fields expected")
+            pass_=0
+        
+        #We append the log for each row
+        logs.append(log)
+        
+        
+    if pass_==1:
+        return pass_
+    else:
+        return logs
+    
+def validation_departments_or_jobs(rows,batch_id):
+    pass_=1
+    logs=[['Batch_Id','Row','Errors']]
+    for row in rows:
+
+        if len(row) == 2:
+            first_column = row[0]
+            second_column = row[1]
+            log=[batch_id,str(row),[]]
+            # Validate the first column as an integer
+            try:
+                first_column = int(first_column)
+            except ValueError:
+                log[2].append("Validation Error: First value should be an integer")
+                pass_=0
+                
+
+            # Validate the second column as a string
+            if not isinstance(second_column, str):
+                log[2].append("Validation Error: Second value should be a string")
+                pass_=0
+        else:
+            log[2].append("Validation Error: Data malformed, more or less than the fields expected")
+            pass_=0
+            
+        #We append the log for each row
+        logs.append(log)
+            
+    if pass_==1:
+        return pass_
+    else:
+        return logs
+
+
+#This function generate synthetic hired_employees rows, some of them with errors
+def generate_hired_employees(rows, error_rate, seed=7):
+    generator = random.Random(seed)
+    data = []
+    for row_id in range(1, rows+1):
+        row = [str(row_id), f"Employee {row_id}",
+               f"2021-{generator.randint(1,12):02d}-{generator.randint(1,28):02d}T{generator.randint(0,23):02d}:{generator.randint(0,59):02d}:{generator.randint(0,59):02d}Z",
+               str(generator.randint(1,12)), str(generator.randint(1,183))]
+        if generator.random() < error_rate:
+            # Missing values, like the rows of the original file
+            row[generator.choice([1,2,3,4])] = ''
+        data.append(row)
+    return data
+
+#This function generate synthetic departments or jobs rows
+def generate_departments_or_jobs(rows, error_rate, seed=7):
+    generator = random.Random(seed)
+    return [[str(row_id) if generator.random() >= error_rate else 'x', f"Name {row_id}"] for row_id in range(1, rows+1)]
+
+#This function run the validation over all the batches and return the seconds and the failed batches
+def run(validate, batches):
+    failed = 0
+    started = time.perf_counter()
+    for batch_id, batch in enumerate(batches, start=1):
+        if not validate(batch, batch_id):
+            failed += 1
+    return time.perf_counter() - started, failed
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark of the row validation')
+    parser.add_argument('--rows', type=int, default=1000000)
+    parser.add_argument('--batch-size', type=int, default=1000)
+    parser.add_argument('--error-rate', type=float, default=0.001)
+    args = parser.parse_args()
+
+    cases = [
+        ('hired_employees', generate_hired_employees, validation_hired_employees),
+        ('departments', generate_departments_or_jobs, validation_departments_or_jobs)
+    ]
+    for table_name, generate, old_validation in cases:
+        rows = generate(args.rows, args.error_rate)
+        batches = [rows[i:i+args.batch_size] for i in range(0, len(rows), args.batch_size)]
+
+        old_seconds, old_failed = run(lambda batch, batch_id: old_validation(batch, batch_id) == 1, batches)
+        new_seconds, new_failed = run(lambda batch, batch_id: validators[table_name](batch).passed, batches)
+        # Both validations must reject the same batches
+        assert old_failed == new_failed, (old_failed, new_failed)
+
+        print(f"{table_name}: {len(rows)} rows, {len(batches)} batches, {old_failed} failed batches")
+        print(f"  old validation:      {old_seconds:8.2f} s  {len(rows)/old_seconds:12,.0f} rows/s")
+        print(f"  compiled validation: {new_seconds:8.2f} s  {len(rows)/new_seconds:12,.0f} rows/s  (x{old_seconds/new_seconds:.1f})")
+
+if __name__ == '__main__':
+    main()
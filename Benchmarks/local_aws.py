@@ -0,0 +1,185 @@
+#In-memory stand-ins of the AWS services used by the lambdas (S3, SSM and RDS), so the handlers run without AWS
+#install_local_aws replaces boto3.client, the lambdas create their clients as always and get these objects
+#SSM has the parameters of the database of a local PostgreSQL and RDS gives its host, so connection_cache.py
+#connects to the local database, the objects of S3 are kept in memory
+import hashlib
+import threading
+from datetime import datetime, timezone
+from io import BytesIO
+import boto3
+from botocore.exceptions import ClientError
+from psycopg2.extensions import parse_dsn
+
+
+#This function build the same ClientError that boto3 raises for an error of the service
+def client_error(code, status, operation):
+    return ClientError({'Error': {'Code': code, 'Message': code}, 'ResponseMetadata': {'HTTPStatusCode': status}}, operation)
+
+#This class is the body of a S3 object, with the methods of botocore's StreamingBody used by the lambdas
+class LocalStreamingBody:
+    def __init__(self, data):
+        self.stream = BytesIO(data)
+
+    def read(self, size=-1):
+        return self.stream.read(size)
+
+    def iter_chunks(self, chunk_size=1024):
+        chunk = self.stream.read(chunk_size)
+        while chunk:
+            yield chunk
+            chunk = self.stream.read(chunk_size)
+
+    def close(self):
+        pass
+
+#This class is a paginator that returns all the results in a single page
+class LocalPaginator:
+    def __init__(self, operation):
+        self.operation = operation
+
+    def paginate(self, **arguments):
+        yield self.operation(**arguments)
+
+#This class keeps the objects of the buckets in memory, multipart uploads included
+class LocalS3:
+    def __init__(self):
+        # (bucket, key): (data, ETag)
+        self.objects = {}
+        # (bucket, key): time of the last put
+        self.last_modified = {}
+        # upload id: (bucket, key, {part number: data})
+        self.uploads = {}
+        self.uploads_created = 0
+        self.lock = threading.Lock()
+
+    def _put(self, bucket, key, data):
+        with self.lock:
+            self.objects[(bucket, key)] = (bytes(data), '"' + hashlib.md5(data).hexdigest() + '"')
+            self.last_modified[(bucket, key)] = datetime.now(timezone.utc)
+
+    def _get(self, bucket, key, operation):
+        with self.lock:
+            s3_object = self.objects.get((bucket, key))
+        if s3_object is None:
+            raise client_error('NoSuchKey', 404, operation)
+        return s3_object
+
+    def put_object(self, Bucket, Key, Body=b'', **arguments):
+        self._put(Bucket, Key, Body.encode('utf-8') if isinstance(Body, str) else Body)
+        return {'ETag': self.objects[(Bucket, Key)][1]}
+
+    def upload_file(self, Filename, Bucket, Key, **arguments):
+        with open(Filename, 'rb') as file_object:
+            self._put(Bucket, Key, file_object.read())
+
+    def get_object(self, Bucket, Key, Range=None, IfMatch=None, **arguments):
+        data, etag = self._get(Bucket, Key, 'GetObject')
+        if IfMatch is not None and IfMatch != etag:
+            raise client_error('PreconditionFailed', 412, 'GetObject')
+        if Range is not None:
+            # Only the ranges used by the lambdas: bytes=start-end and bytes=start-
+            start, end = Range[len('bytes='):].split('-')
+            data = data[int(start):int(end)+1] if end else data[int(start):]
+        return {'Body': LocalStreamingBody(data), 'ContentLength': len(data), 'ETag': etag}
+
+    def head_object(self, Bucket, Key, **arguments):
+        data, etag = self._get(Bucket, Key, 'HeadObject')
+        return {'ContentLength': len(data), 'ETag': etag, 'LastModified': self.last_modified[(Bucket, Key)]}
+
+    def list_objects_v2(self, Bucket, Prefix='', Delimiter=None, **arguments):
+        with self.lock:
+            keys = sorted(key for bucket, key in self.objects if bucket == Bucket and key.startswith(Prefix))
+        contents = []
+        common_prefixes = []
+        for key in keys:
+            if Delimiter and Delimiter in key[len(Prefix):]:
+                common_prefix = key[:len(Prefix) + key[len(Prefix):].index(Delimiter) + len(Delimiter)]
+                if not common_prefixes or common_prefixes[-1]['Prefix'] != common_prefix:
+                    common_prefixes.append({'Prefix': common_prefix})
+            else:
+                contents.append({'Key': key, 'Size': len(self.objects[(Bucket, key)][0])})
+        return {'Contents': contents, 'CommonPrefixes': common_prefixes, 'KeyCount': len(contents) + len(common_prefixes)}
+
+    def get_paginator(self, operation_name):
+        return LocalPaginator(getattr(self, operation_name))
+
+    def create_multipart_upload(self, Bucket, Key, **arguments):
+        with self.lock:
+            self.uploads_created += 1
+            upload_id = f'upload-{self.uploads_created}'
+            self.uploads[upload_id] = (Bucket, Key, {})
+        return {'UploadId': upload_id}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body, **arguments):
+        self.uploads[UploadId][2][PartNumber] = bytes(Body)
+        return {'ETag': '"' + hashlib.md5(Body).hexdigest() + '"'}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload, **arguments):
+        _, _, parts = self.uploads.pop(UploadId)
+        self._put(Bucket, Key, b''.join(parts[part['PartNumber']] for part in MultipartUpload['Parts']))
+        return {'ETag': self.objects[(Bucket, Key)][1]}
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId, **arguments):
+        self.uploads.pop(UploadId, None)
+
+    #This function help us to know the size of the objects of a folder (e.g. the files of a backup)
+    def folder_size(self, bucket, prefix):
+        with self.lock:
+            return sum(len(data) for (object_bucket, key), (data, _) in self.objects.items()
+                       if object_bucket == bucket and key.startswith(prefix))
+
+#This class has the parameters of the database in the same path that the lambdas read
+class LocalSSM:
+    def __init__(self, parameters):
+        self.parameters = parameters
+
+    def get_parameters_by_path(self, Path, **arguments):
+        return {'Parameters': [{'Name': Path.rstrip('/') + '/' + name, 'Value': value}
+                               for name, value in self.parameters.items()]}
+
+    def get_paginator(self, operation_name):
+        return LocalPaginator(getattr(self, operation_name))
+
+#This class describes the local database as the RDS instance of the parameters
+class LocalRDS:
+    def __init__(self, host):
+        self.host = host
+
+    def describe_db_instances(self, DBInstanceIdentifier, **arguments):
+        return {'DBInstances': [{'DBInstanceIdentifier': DBInstanceIdentifier, 'Endpoint': {'Address': self.host}}]}
+
+#This class has the local stand-ins, the lambdas get them from boto3.client
+class LocalAWS:
+    def __init__(self, dsn, bucket):
+        self.bucket = bucket
+        database = parse_dsn(dsn)
+        # The parameters of the database in SSM, like /RDS/test-migration-db/ (the values are strings)
+        self.ssm = LocalSSM({
+            'database_identifier': 'local-migration-db',
+            'databasename': database.get('dbname', 'postgres'),
+            'user': database.get('user', ''),
+            'password': database.get('password', ''),
+            'port': database.get('port', '5432'),
+            'bucketname': bucket
+        })
+        self.rds = LocalRDS(database.get('host', ''))
+        self.s3 = LocalS3()
+        self.clients = {'s3': self.s3, 'ssm': self.ssm, 'rds': self.rds}
+        self.original_client = None
+
+    def client(self, service_name, *arguments, **keyword_arguments):
+        if service_name not in self.clients:
+            raise ValueError(f"There is no local stand-in of {service_name}")
+        return self.clients[service_name]
+
+    def uninstall(self):
+        if self.original_client is not None:
+            boto3.client = self.original_client
+            self.original_client = None
+
+#This function replace boto3.client with the local stand-ins, it must be called before the handlers run
+def install_local_aws(dsn, bucket='local-migration-bucket'):
+    local_aws = LocalAWS(dsn, bucket)
+    local_aws.original_client = boto3.client
+    boto3.client = local_aws.client
+    return local_aws
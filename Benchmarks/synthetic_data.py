@@ -0,0 +1,99 @@
+#Synthetic source files of the migration: hired_employees, departments and jobs CSVs like the ones uploaded to S3
+#The size of hired_employees and the rate of rows with errors are configurable, the same seed gives the same files
+#The rows with errors have the errors of the original files: missing values, values of another type, dates that
+#are not ISO and rows with more or less columns, and some hires have a department or job that doesn't exist
+#Usage: python Benchmarks/synthetic_data.py --rows 1000000 --error-rate 0.01 --output-folder /tmp/migration_files
+import os
+import io
+import csv
+import random
+import argparse
+
+
+first_names = ['Harold', 'Ty', 'Lyman', 'Lola', 'Marva', 'Ruth', 'Jae', 'Beatriz', 'Emmanuel', 'Yolanda']
+last_names = ['Vogt', 'Hughes', 'Hopps', 'Wilson', 'Suzuki', 'Lopez', 'Kim', 'Mendoza', 'Smith', "O'Neil"]
+
+
+#This function generate the departments or jobs rows, some of them with errors
+def generate_departments_or_jobs(rows, error_rate, name_prefix, seed=7):
+    generator = random.Random(seed)
+    data = []
+    for row_id in range(1, rows+1):
+        row = [str(row_id), f"{name_prefix} {row_id}"]
+        if generator.random() < error_rate:
+            # An id that is not an integer or a row without the name column
+            row = generator.choice([['x' + str(row_id), row[1]], [row[0]]])
+        data.append(row)
+    return data
+
+#This function generate an error in a valid hired_employees row, like the errors of the original files
+def add_hired_employee_error(generator, row):
+    error = generator.randrange(5)
+    if error == 0:
+        # Missing values
+        row[generator.choice([1, 2, 3, 4])] = ''
+    elif error == 1:
+        # A date that is not in ISO format
+        row[2] = row[2][:10].replace('-', '/')
+    elif error == 2:
+        # An id that is not an integer
+        row[generator.choice([0, 3, 4])] = 'n/a'
+    elif error == 3:
+        # More or less columns than the table
+        row = row[:4] if generator.random() < 0.5 else row + ['extra']
+    else:
+        # A department or job that doesn't exist, the row is valid but the migration skips it
+        row[generator.choice([3, 4])] = str(10**6 + generator.randrange(1000))
+    return row
+
+#This function generate the hired_employees rows lazily, so big files don't need all the rows in memory
+def iter_hired_employees(rows, error_rate, departments, jobs, seed=7):
+    generator = random.Random(seed)
+    for row_id in range(1, rows+1):
+        row = [str(row_id),
+               f"{generator.choice(first_names)} {generator.choice(last_names)}",
+               f"{generator.randint(2020,2022)}-{generator.randint(1,12):02d}-{generator.randint(1,28):02d}T"
+               f"{generator.randint(0,23):02d}:{generator.randint(0,59):02d}:{generator.randint(0,59):02d}Z",
+               str(generator.randint(1, departments)),
+               str(generator.randint(1, jobs))]
+        if generator.random() < error_rate:
+            row = add_hired_employee_error(generator, row)
+        yield row
+
+#This function write the rows as CSV without header, like the source files
+def rows_to_csv(rows):
+    buffer = io.StringIO()
+    csv.writer(buffer, lineterminator='\n').writerows(rows)
+    return buffer.getvalue().encode('utf-8')
+
+#This function generate the three source files, it returns table name: content of the file
+#The departments and jobs only have errors if dimension_errors is True, so all the hires can be migrated by default
+def generate_source_files(rows, error_rate, departments=12, jobs=183, dimension_errors=False, seed=7):
+    dimension_error_rate = error_rate if dimension_errors else 0.0
+    return {
+        'departments': rows_to_csv(generate_departments_or_jobs(departments, dimension_error_rate, 'Department', seed)),
+        'jobs': rows_to_csv(generate_departments_or_jobs(jobs, dimension_error_rate, 'Job', seed)),
+        'hired_employees': rows_to_csv(iter_hired_employees(rows, error_rate, departments, jobs, seed))
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description='Synthetic source files of the migration')
+    parser.add_argument('--rows', type=int, default=100000, help='Rows of hired_employees')
+    parser.add_argument('--error-rate', type=float, default=0.01)
+    parser.add_argument('--departments', type=int, default=12)
+    parser.add_argument('--jobs', type=int, default=183)
+    parser.add_argument('--dimension-errors', action='store_true', help='Add errors to departments and jobs too')
+    parser.add_argument('--seed', type=int, default=7)
+    parser.add_argument('--output-folder', default='.')
+    args = parser.parse_args()
+
+    os.makedirs(args.output_folder, exist_ok=True)
+    files = generate_source_files(args.rows, args.error_rate, args.departments, args.jobs, args.dimension_errors, args.seed)
+    for table_name, content in files.items():
+        file_path = os.path.join(args.output_folder, f'{table_name}.csv')
+        with open(file_path, 'wb') as csv_file:
+            csv_file.write(content)
+        print(f"{file_path}: {len(content)/1024/1024:.2f} MB")
+
+if __name__ == '__main__':
+    main()
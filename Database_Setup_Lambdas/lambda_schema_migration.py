@@ -0,0 +1,51 @@
+#This lambda migrates the schema of a database created before hired_employees.datetime was a timestamptz
+#It can run more than once, each step is only done if it is needed, and all the steps are done in a single transaction
+#ALTER TABLE rewrites hired_employees with an exclusive lock, so the migrations must not be running meanwhile
+from connection_cache import get_connection
+from data_version import query_create_data_version, bump_data_version_after_commit
+from lambda_setup_backup import query_create_indexes
+
+
+# The materialized views of the reports use the column, they are created again by the report lambda
+query_drop_report_views = """
+    DROP MATERIALIZED VIEW IF EXISTS migration.report_hires_by_quarter;
+    DROP MATERIALIZED VIEW IF EXISTS migration.report_department_quarter_hires;
+"""
+
+# Backfill of the existing rows: the text in ISO format (e.g. 2021-11-07T02:48:42Z) is converted to timestamptz
+query_convert_datetime = """
+    ALTER TABLE migration.hired_employees
+        ALTER COLUMN datetime TYPE timestamptz USING cast(NULLIF(datetime, '') as timestamptz);
+"""
+
+
+#This function help us to know the type of the datetime column
+def get_datetime_type(cursor):
+    cursor.execute("""
+        SELECT data_type FROM information_schema.columns
+        WHERE table_schema = 'migration' AND table_name = 'hired_employees' AND column_name = 'datetime'
+    """)
+    return cursor.fetchone()[0]
+
+def lambda_handler(event, context):
+    conn = get_connection()
+    cursor = conn.cursor()
+
+    steps = []
+    if get_datetime_type(cursor) != 'timestamp with time zone':
+        cursor.execute(query_drop_report_views)
+        cursor.execute(query_convert_datetime)
+        steps.append('datetime converted to timestamptz')
+    cursor.execute(query_create_indexes)
+    steps.append('indexes created')
+
+    # The new type changes the reports, so the cached reports are refreshed
+    cursor.execute(query_create_data_version)
+    conn.commit()
+    cursor.close()
+    bump_data_version_after_commit(conn)
+
+    return {
+        'statusCode': 200,
+        'body': f"Schema migrated: {', '.join(steps)}"
+    }
@@ -1,6 +1,32 @@
 import psycopg2
 import json
 import boto3
+# The layer has the table with the version of the data used by the cached reports
+from data_version import query_create_data_version
+
+# Schema and tables of the migration, the benchmarks (Benchmarks/benchmark_pipeline.py) create the same tables
+query_create_schema = """
+    CREATE SCHEMA IF NOT EXISTS migration;
+    CREATE TABLE IF NOT EXISTS migration.jobs (id integer PRIMARY KEY,
+                                               job varchar);
+    CREATE TABLE IF NOT EXISTS migration.departments (id integer PRIMARY KEY,
+                                                      department varchar);
+    CREATE TABLE IF NOT EXISTS migration.hired_employees (id integer PRIMARY KEY,
+                                                          name varchar,
+                                                          datetime timestamptz,
+                                                          department_id integer,
+                                                          job_id integer,
+                                                          FOREIGN KEY (department_id) REFERENCES migration.departments(id),
+                                                          FOREIGN KEY (job_id) REFERENCES migration.jobs(id));
+"""
+
+# Indexes of the BI reports: the hires of a range of dates (with the department and the job, so the reports only read
+# the index) and the foreign keys
+query_create_indexes = """
+    CREATE INDEX IF NOT EXISTS hired_employees_datetime_idx ON migration.hired_employees (datetime) INCLUDE (department_id, job_id);
+    CREATE INDEX IF NOT EXISTS hired_employees_department_id_idx ON migration.hired_employees (department_id);
+    CREATE INDEX IF NOT EXISTS hired_employees_job_id_idx ON migration.hired_employees (job_id);
+"""
 
 def lambda_handler(event, context):
     
@@ -22,26 +48,10 @@ def lambda_handler(event, context):
 
     cursor = conn.cursor()
     
-    #CREATE TABLES 
-    query_create_schema = "   CREATE SCHEMA migration;\
-                                \
-                              CREATE TABLE migration.jobs (id integer PRIMARY KEY,\
-                                 job varchar);\
-                                \
-                              CREATE TABLE migration.departments (id integer PRIMARY KEY, \
-                                                        department varchar);\
-                                \
-                              CREATE TABLE migration.hired_employees (id integer PRIMARY KEY, \
-                                                            name varchar, \
-                                                            datetime varchar, \
-                                                            department_id integer, \
-                                                            job_id integer,\
-                                                            FOREIGN KEY (department_id) REFERENCES departments(id),\
-                                                            FOREIGN KEY (job_id) REFERENCES jobs(id));   "
-    
-
     try:
         cursor.execute(query_create_schema)
+        cursor.execute(query_create_indexes)
+        cursor.execute(query_create_data_version)
         cursor.close()
         conn.commit()
         return (f'The database and the schema were created')
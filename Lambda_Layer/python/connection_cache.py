@@ -0,0 +1,130 @@
+#This module keeps the database configuration and the connection between warm invocations of the lambdas
+#It is deployed as a lambda layer, so the migration, backup and restore lambdas use the same code
+import os
+import time
+import boto3
+import psycopg2
+from psycopg2 import extensions
+
+
+# Path of the SSM parameters of the database
+parameters_path = os.environ.get('DB_PARAMETERS_PATH', '/RDS/test-migration-db/')
+# Seconds that the SSM parameters and the RDS endpoint are kept before reading them again
+config_ttl = int(os.environ.get('DB_CONFIG_TTL', 300))
+# Seconds without using the connection after which it is checked before being used again
+health_check_interval = int(os.environ.get('DB_HEALTH_CHECK_INTERVAL', 30))
+# Optional endpoint of a connection pooler (e.g. RDS Proxy or PgBouncer), it is used instead of the RDS endpoint
+pooler_endpoint = os.environ.get('DB_POOLER_ENDPOINT')
+pooler_port = os.environ.get('DB_POOLER_PORT')
+
+# These values live while the lambda container is warm
+_config = None
+_config_loaded_at = 0.0
+_connection = None
+_connection_used_at = 0.0
+
+
+#This function help us to extract the parameters values from the SSM response, the key is the last part of the name
+def extract_parameters_from_response(parameters):
+    return {parameter['Name'].split('/')[-1]: parameter['Value'] for parameter in parameters}
+
+#This function read the database parameters from SSM and the endpoint from RDS
+def load_database_config():
+    ssm_client = boto3.client('ssm')
+
+    # Retrieve parameters by path from SSM Parameter Store (the response is paginated)
+    parameters_to_extract = []
+    paginator = ssm_client.get_paginator('get_parameters_by_path')
+    for page in paginator.paginate(Path=parameters_path, Recursive=True, WithDecryption=True):
+        parameters_to_extract.extend(page['Parameters'])
+    parameters = extract_parameters_from_response(parameters_to_extract)
+
+    if pooler_endpoint:
+        # The pooler is in front of the database, so there is no need to describe the RDS instance
+        endpoint = pooler_endpoint
+        port = pooler_port or parameters['port']
+    else:
+        #Describe the RDS instance to extract the endpoint using the database_identifier parameter stored in SSM
+        rds_client = boto3.client('rds')
+        response_describe_db = rds_client.describe_db_instances(DBInstanceIdentifier=parameters['database_identifier'])
+        endpoint = response_describe_db['DBInstances'][0]['Endpoint']['Address']
+        port = parameters['port']
+
+    return {
+        'host': endpoint,
+        'port': port,
+        'database': parameters['databasename'],
+        'user': parameters['user'],
+        'password': parameters['password'],
+        'parameters': parameters
+    }
+
+#This function return the database configuration, it is read again only when the TTL expires
+def get_database_config(force_refresh=False):
+    global _config, _config_loaded_at
+    now = time.monotonic()
+    if force_refresh or _config is None or now - _config_loaded_at > config_ttl:
+        _config = load_database_config()
+        _config_loaded_at = now
+    return _config
+
+#This function open a new connection that is not cached (e.g. for threads that need their own connection)
+def new_connection(config=None):
+    if config is None:
+        config = get_database_config()
+    return psycopg2.connect(
+        host=config['host'],
+        port=config['port'],
+        database=config['database'],
+        user=config['user'],
+        password=config['password']
+    )
+
+#This function help us to know if the connection still works
+def is_connection_healthy(connection):
+    if connection.closed:
+        return False
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT 1')
+        connection.rollback()
+        return True
+    except psycopg2.Error:
+        return False
+
+#This function close the cached connection, the next call to get_connection opens a new one
+def close_connection():
+    global _connection
+    if _connection is not None:
+        try:
+            _connection.close()
+        except psycopg2.Error:
+            pass
+        _connection = None
+
+#This function return the cached connection, it is checked if it was not used recently and opened again if it failed
+def get_connection():
+    global _connection, _connection_used_at
+    now = time.monotonic()
+
+    if _connection is not None:
+        if _connection.closed:
+            close_connection()
+        elif _connection.get_transaction_status() != extensions.TRANSACTION_STATUS_IDLE:
+            # A previous invocation failed in the middle of a transaction
+            try:
+                _connection.rollback()
+            except psycopg2.Error:
+                close_connection()
+        elif now - _connection_used_at > health_check_interval and not is_connection_healthy(_connection):
+            close_connection()
+
+    if _connection is None:
+        try:
+            _connection = new_connection()
+        except psycopg2.OperationalError:
+            # The endpoint or the credentials could have changed, so they are read again before retrying
+            _connection = new_connection(get_database_config(force_refresh=True))
+
+    _connection_used_at = now
+    return _connection
@@ -0,0 +1,46 @@
+#This module keeps the version of the data of the migration schema, it is deployed in the lambda layer
+#The migration and restore lambdas increase the version just after they commit the tables,
+#so the report lambda knows when its cached reports and materialized views are old by reading a single row
+from psycopg2.errors import UndefinedTable
+
+
+# The version of the data is a sequence, so increasing it doesn't lock a row and doesn't leave a dead tuple per batch
+# The table has a single row with the version of the data used by the materialized views of the reports
+# (the column version is the version of the data before the sequence, the sequence starts from it)
+query_create_data_version = """
+    CREATE TABLE IF NOT EXISTS migration.data_version (id integer PRIMARY KEY CHECK (id = 1),
+                                                       version bigint NOT NULL,
+                                                       views_version bigint NOT NULL,
+                                                       updated_at timestamptz NOT NULL DEFAULT now());
+    INSERT INTO migration.data_version (id, version, views_version) VALUES (1, 1, 0) ON CONFLICT (id) DO NOTHING;
+    CREATE SEQUENCE IF NOT EXISTS migration.data_version_seq;
+    SELECT setval('migration.data_version_seq', GREATEST(s.last_value, d.version))
+    FROM migration.data_version_seq s, migration.data_version d WHERE d.id = 1;
+"""
+
+
+#This function increase the version of the data
+#The sequence is not transactional, so it must be called after the commit of the data: a report that reads the
+#new version before the commit would refresh its views without the new rows
+def bump_data_version(cursor):
+    cursor.execute("SELECT nextval('migration.data_version_seq')")
+
+#This function increase the version of the data after the commit of the tables
+#The data is already committed, so if the sequence doesn't exist yet (the layer was deployed before the setup lambda
+#created it) the migration goes on and the version is increased by the next batch after the setup
+def bump_data_version_after_commit(conn):
+    cursor = conn.cursor()
+    try:
+        bump_data_version(cursor)
+        conn.commit()
+    except UndefinedTable:
+        conn.rollback()
+        print('migration.data_version_seq does not exist, run the setup lambda to refresh the cached reports')
+    finally:
+        cursor.close()
+
+#This function return the version of the data and the version of the materialized views
+def get_data_version(cursor):
+    cursor.execute("""SELECT s.last_value, d.views_version FROM migration.data_version_seq s, migration.data_version d
+                      WHERE d.id = 1""")
+    return cursor.fetchone()
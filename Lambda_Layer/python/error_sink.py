@@ -0,0 +1,190 @@
+#This module writes the error logs of the migration (the rows rejected by the validations) without temporary files
+#The errors of many batches are kept in memory, compressed, and written to S3 in a few parts of a bounded size
+#Each batch is a gzip member of the part, the concatenated members are a valid gzip file, so a part can be downloaded
+#and read as a single CSV, and the index of the run says where the errors of each batch are (part, offset and length),
+#so the errors of a batch are read with a single range request
+#The rows kept apart in the quarantine (rows with errors in the partial accept mode and orphan rows) are written
+#in the same way, in a few parts per run with the format of the source file
+import os
+import io
+import csv
+import gzip
+import json
+import threading
+from contextlib import nullcontext
+import boto3
+
+
+# Compressed bytes of each part of the error logs, a part is written to S3 when it reaches this size
+error_part_bytes = int(os.environ.get('ERROR_PART_BYTES', 8*1024*1024))
+# Folder of the error logs, each run has its own folder: logs/errors/<table>_<run_id>/
+error_log_prefix = 'logs/errors/'
+error_log_header = ['Batch_Id', 'Row', 'Errors']
+quarantine_prefix = 'quarantine/'
+
+
+#This function help us to get the folder of the error logs of a migration run
+def get_error_log_folder(table_name, run_id):
+    return f"{error_log_prefix}{table_name}_{run_id}/"
+
+#This function compress rows as a CSV gzip member
+def compress_csv_rows(rows):
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(rows)
+    return gzip.compress(buffer.getvalue().encode('utf-8'), mtime=0)
+
+#This function write the errors of a single batch as a compressed CSV, it is used when the errors can't be returned
+#to the generator (e.g. the batch was sent with the Event invocation type)
+def write_batch_errors(bucket, folder, batch_id, rows, s3_client=None):
+    s3 = s3_client or boto3.client('s3')
+    file_key = f"{folder}batch-{batch_id:012d}.csv.gz"
+    s3.put_object(Bucket=bucket, Key=file_key, Body=compress_csv_rows([error_log_header] + rows), ContentType='application/gzip')
+    return file_key
+
+#This class keeps the errors of the batches of a run and writes them in parts
+#session is a number that is unique in the run (e.g. the first batch id sent by the invocation), so the parts and
+#the index of an invocation that resumes the run don't replace the ones of the previous invocations
+class ErrorSink:
+    def __init__(self, bucket, folder, session, s3_client=None, part_bytes=error_part_bytes, metrics=None):
+        self.bucket = bucket
+        self.folder = folder
+        self.session = session
+        self.s3 = s3_client or boto3.client('s3')
+        self.part_bytes = part_bytes
+        self.metrics = metrics
+        self.part_buffer = io.BytesIO()
+        self.part_number = 0
+        self.parts = []
+        # batch_id -> part, offset and length of its gzip member and rows
+        self.index = {}
+        self.rows = 0
+        self.lock = threading.Lock()
+
+    def part_key(self, part_number):
+        return f"{self.folder}part-{self.session:012d}-{part_number:04d}.csv.gz"
+
+    def index_key(self):
+        return f"{self.folder}index-{self.session:012d}.json"
+
+    def _measure_upload(self, size=0):
+        return self.metrics.stage('error_log_upload', bytes=size) if self.metrics is not None else nullcontext()
+
+    #This function add the errors of a batch, the rows are the log of row_validation.py without the header
+    def add(self, batch_id, rows):
+        if not rows:
+            return
+        # The batch is compressed before taking the lock, the batches of several threads are compressed at the same time
+        member = compress_csv_rows(rows)
+        with self.lock:
+            if self.part_buffer.tell() == 0:
+                # The header is its own member, so the whole part is a CSV with header
+                self.part_buffer.write(compress_csv_rows([error_log_header]))
+            offset = self.part_buffer.tell()
+            self.part_buffer.write(member)
+            self.index[batch_id] = {'key': self.part_key(self.part_number), 'offset': offset, 'length': len(member), 'rows': len(rows)}
+            self.rows += len(rows)
+            if self.part_buffer.tell() >= self.part_bytes:
+                self._upload_part()
+
+    def _upload_part(self):
+        data = self.part_buffer.getvalue()
+        with self._measure_upload(len(data)):
+            self.s3.put_object(Bucket=self.bucket, Key=self.part_key(self.part_number), Body=data, ContentType='application/gzip')
+        self.parts.append(self.part_key(self.part_number))
+        self.part_number += 1
+        self.part_buffer = io.BytesIO()
+
+    def _flush(self):
+        if self.part_buffer.tell():
+            self._upload_part()
+        if self.index:
+            index = {'batches': {str(batch_id): location for batch_id, location in sorted(self.index.items())}, 'parts': self.parts}
+            with self._measure_upload():
+                self.s3.put_object(Bucket=self.bucket, Key=self.index_key(), Body=json.dumps(index).encode('utf-8'),
+                                   ContentType='application/json')
+
+    #This function write the part that is being filled and the index, it is called before the checkpoint is saved,
+    #so a batch is never done in the checkpoint while its errors are only in memory
+    def flush(self):
+        with self.lock:
+            self._flush()
+
+    #This function write the last part and the index, it returns the summary of the errors of the run
+    def close(self):
+        with self.lock:
+            self._flush()
+            return {'folder': self.folder, 'batches': len(self.index), 'rows': self.rows, 'parts': len(self.parts)}
+
+#This class keeps the quarantine rows of the batches of a run and writes them in parts of CSV without header
+#The name of a part starts with the table name, so after fixing the rows the part can be uploaded and migrated again
+class QuarantineSink:
+    def __init__(self, bucket, table_name, run_id, session, s3_client=None, part_bytes=error_part_bytes, metrics=None):
+        self.bucket = bucket
+        self.prefix = f"{quarantine_prefix}{table_name}.run-{run_id}_part-{session:012d}-"
+        self.s3 = s3_client or boto3.client('s3')
+        self.part_bytes = part_bytes
+        self.metrics = metrics
+        self.part_buffer = io.StringIO()
+        self.part_number = 0
+        self.part_rows = 0
+        self.parts = []
+        self.rows = 0
+        self.lock = threading.Lock()
+
+    def _measure_upload(self, rows, size):
+        return self.metrics.stage('quarantine_upload', rows=rows, bytes=size) if self.metrics is not None else nullcontext()
+
+    #This function add the quarantine rows of a batch, the rows have the columns of the source file
+    def add(self, rows):
+        if not rows:
+            return
+        with self.lock:
+            csv.writer(self.part_buffer).writerows(rows)
+            self.part_rows += len(rows)
+            self.rows += len(rows)
+            if self.part_buffer.tell() >= self.part_bytes:
+                self._upload_part()
+
+    def _upload_part(self):
+        data = self.part_buffer.getvalue().encode('utf-8')
+        file_key = f"{self.prefix}{self.part_number:04d}.csv"
+        with self._measure_upload(self.part_rows, len(data)):
+            self.s3.put_object(Bucket=self.bucket, Key=file_key, Body=data)
+        self.parts.append(file_key)
+        self.part_number += 1
+        self.part_rows = 0
+        self.part_buffer = io.StringIO()
+
+    #This function write the part that is being filled, it is called before the checkpoint is saved
+    def flush(self):
+        with self.lock:
+            if self.part_buffer.tell():
+                self._upload_part()
+
+    #This function write the last part, it returns the summary of the quarantine of the run
+    def close(self):
+        with self.lock:
+            if self.part_buffer.tell():
+                self._upload_part()
+            return {'rows': self.rows, 'parts': self.parts}
+
+#This function read the errors of a batch of a run with the indexes of the run, it returns the rows with the header
+#The errors written by the migration lambda (a file per batch) are read too
+def read_batch_errors(bucket, folder, batch_id, s3_client=None):
+    s3 = s3_client or boto3.client('s3')
+    paginator = s3.get_paginator('list_objects_v2')
+    batch_file_key = f"{folder}batch-{batch_id:012d}.csv.gz"
+    for page in paginator.paginate(Bucket=bucket, Prefix=folder):
+        for s3_object in page.get('Contents', []):
+            if s3_object['Key'] == batch_file_key:
+                data = s3.get_object(Bucket=bucket, Key=batch_file_key)['Body'].read()
+                return list(csv.reader(io.StringIO(gzip.decompress(data).decode('utf-8'))))
+            if not s3_object['Key'].startswith(folder + 'index-'):
+                continue
+            index = json.loads(s3.get_object(Bucket=bucket, Key=s3_object['Key'])['Body'].read())
+            location = index['batches'].get(str(batch_id))
+            if location is not None:
+                member = s3.get_object(Bucket=bucket, Key=location['key'],
+                                       Range=f"bytes={location['offset']}-{location['offset'] + location['length'] - 1}")['Body'].read()
+                return [error_log_header] + list(csv.reader(io.StringIO(gzip.decompress(member).decode('utf-8'))))
+    return None
@@ -0,0 +1,104 @@
+#This module has a file-like writer that uploads to S3 with a multipart upload while the data is being written
+#Only one part is kept in memory, so big files can be written from a lambda with constant memory
+#With a StageMetrics the time and bytes of the requests to S3 are measured (upload stage)
+import os
+import hashlib
+from contextlib import nullcontext
+import boto3
+
+
+# Size of each part of the multipart upload, S3 needs at least 5 MB for all the parts except the last one
+part_size = int(os.environ.get('S3_PART_SIZE', 8*1024*1024))
+
+
+class S3MultipartWriter:
+    def __init__(self, bucket, key, s3_client=None, part_size=part_size, metrics=None):
+        self.bucket = bucket
+        self.key = key
+        self.s3 = s3_client or boto3.client('s3')
+        self.part_size = part_size
+        self.part_buffer = bytearray()
+        self.upload_id = None
+        self.parts = []
+        # Bytes written to the file, the AVRO writer asks for it with tell()
+        self.position = 0
+        # Checksum of the whole file, S3 only gives the checksums of the parts of a multipart upload
+        self.sha256 = hashlib.sha256()
+        self.metrics = metrics
+        self.closed = False
+
+    def write(self, data):
+        self.part_buffer += data
+        self.position += len(data)
+        self.sha256.update(data)
+        if len(self.part_buffer) >= self.part_size:
+            self._upload_part()
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def seekable(self):
+        # The parts that were uploaded can't be changed, fastavro asks for it before writing
+        return False
+
+    def flush(self):
+        # The parts are uploaded when they are complete, a flush can't upload a part smaller than the minimum size
+        pass
+
+    def _measure_upload(self, size=0):
+        return self.metrics.stage('upload', bytes=size) if self.metrics is not None else nullcontext()
+
+    def _upload_part(self):
+        with self._measure_upload(len(self.part_buffer)):
+            if self.upload_id is None:
+                self.upload_id = self.s3.create_multipart_upload(Bucket=self.bucket, Key=self.key)['UploadId']
+            part_number = len(self.parts) + 1
+            response = self.s3.upload_part(
+                Bucket=self.bucket,
+                Key=self.key,
+                UploadId=self.upload_id,
+                PartNumber=part_number,
+                Body=bytes(self.part_buffer)
+            )
+        self.parts.append({'ETag': response['ETag'], 'PartNumber': part_number})
+        self.part_buffer = bytearray()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        if self.upload_id is None:
+            # Small files are written with a single put_object
+            with self._measure_upload(len(self.part_buffer)):
+                self.s3.put_object(Bucket=self.bucket, Key=self.key, Body=bytes(self.part_buffer))
+        else:
+            if self.part_buffer:
+                self._upload_part()
+            with self._measure_upload():
+                self.s3.complete_multipart_upload(
+                    Bucket=self.bucket,
+                    Key=self.key,
+                    UploadId=self.upload_id,
+                    MultipartUpload={'Parts': self.parts}
+                )
+        self.part_buffer = bytearray()
+
+    #This function cancel the upload, the parts that were already uploaded are deleted by S3
+    def abort(self):
+        if self.closed:
+            return
+        self.closed = True
+        if self.upload_id is not None:
+            self.s3.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id)
+        self.part_buffer = bytearray()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+        return False
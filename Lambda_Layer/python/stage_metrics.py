@@ -0,0 +1,115 @@
+#This module measures where the time of a lambda goes: the seconds, calls, rows and bytes of each stage
+#(e.g. S3 read, validation, database execute, upload), it is deployed in the lambda layer
+#The stages are written as a single JSON line in the logs with rows/s and bytes/s, so they can be queried with
+#CloudWatch Logs Insights, and they can be returned in the response so the caller adds them to its own metrics
+#The stages can be nested: the time of a stage doesn't include the time of the stages measured inside it,
+#so the stages of a thread add up to the time of the lambda
+import json
+import time
+import threading
+from contextlib import contextmanager
+
+
+class StageMetrics:
+    def __init__(self, component, **fields):
+        self.component = component
+        # Fields added to the log line (e.g. table, batch_id)
+        self.fields = fields
+        # stage -> {'seconds', 'calls', 'rows', 'bytes'}
+        self.stages = {}
+        self.started = time.perf_counter()
+        self.lock = threading.Lock()
+        # Time of the nested stages that are running in each thread
+        self.nested = threading.local()
+
+    def _nested_stack(self):
+        stack = getattr(self.nested, 'stack', None)
+        if stack is None:
+            stack = self.nested.stack = []
+        return stack
+
+    def add(self, stage, seconds=0.0, rows=0, bytes=0, calls=1):
+        with self.lock:
+            totals = self.stages.get(stage)
+            if totals is None:
+                totals = self.stages[stage] = {'seconds': 0.0, 'calls': 0, 'rows': 0, 'bytes': 0}
+            totals['seconds'] += seconds
+            totals['calls'] += calls
+            totals['rows'] += rows
+            totals['bytes'] += bytes
+
+    #This function measure the code inside the with, the rows and bytes can be set in the counts that it gives
+    #e.g. with metrics.stage('db_execute') as counts: counts['rows'] = cursor.rowcount
+    @contextmanager
+    def stage(self, stage, rows=0, bytes=0):
+        counts = {'rows': rows, 'bytes': bytes}
+        stack = self._nested_stack()
+        stack.append(0.0)
+        started = time.perf_counter()
+        try:
+            yield counts
+        finally:
+            seconds = time.perf_counter() - started
+            nested_seconds = stack.pop()
+            if stack:
+                stack[-1] += seconds
+            self.add(stage, seconds - nested_seconds, counts['rows'], counts['bytes'])
+
+    #This function measure the time spent reading each item of an iterable (e.g. the chunks of a S3 body or
+    #the rows of a csv reader), each item is a row, or bytes of the item when bytes_of is given (e.g. len)
+    #The totals are added when the iterable ends, so the hot loop doesn't take the lock on each item
+    def timed_iter(self, stage, iterable, bytes_of=None):
+        iterator = iter(iterable)
+        stack = self._nested_stack()
+        seconds = 0.0
+        items = 0
+        rows = 0
+        total_bytes = 0
+        try:
+            while True:
+                stack.append(0.0)
+                started = time.perf_counter()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+                finally:
+                    elapsed = time.perf_counter() - started
+                    nested_seconds = stack.pop()
+                    if stack:
+                        stack[-1] += elapsed
+                    seconds += elapsed - nested_seconds
+                items += 1
+                if bytes_of is None:
+                    rows += 1
+                else:
+                    total_bytes += bytes_of(item)
+                yield item
+        finally:
+            self.add(stage, seconds, rows, total_bytes, calls=items)
+
+    #This function add the stages measured by another lambda or thread (the result of summary)
+    def merge(self, stages):
+        for stage, totals in (stages or {}).items():
+            self.add(stage, totals.get('seconds', 0.0), totals.get('rows', 0), totals.get('bytes', 0), totals.get('calls', 0))
+
+    #This function return the stages with their throughput, it can be serialized as JSON
+    def summary(self):
+        with self.lock:
+            stages = {stage: dict(totals) for stage, totals in self.stages.items()}
+        for totals in stages.values():
+            seconds = totals['seconds']
+            totals['seconds'] = round(seconds, 6)
+            totals['rows_per_second'] = round(totals['rows'] / seconds, 1) if seconds > 0 and totals['rows'] else None
+            totals['bytes_per_second'] = round(totals['bytes'] / seconds, 1) if seconds > 0 and totals['bytes'] else None
+        return stages
+
+    #This function write the stages as a JSON line in the logs of the lambda
+    def log(self, **fields):
+        line = {'metric': 'stage_metrics', 'component': self.component}
+        line.update(self.fields)
+        line.update(fields)
+        line['elapsed_seconds'] = round(time.perf_counter() - self.started, 6)
+        line['stages'] = self.summary()
+        print(json.dumps(line, default=str))
+        return line
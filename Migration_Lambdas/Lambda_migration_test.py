@@ -1,11 +1,29 @@
 import csv
-import json
-import tempfile
+import io
+import os
+import time
 from datetime import datetime
 import boto3
-import psycopg2
+from psycopg2.errors import ForeignKeyViolation
+from connection_cache import get_connection
+from data_version import bump_data_version_after_commit
+from stage_metrics import StageMetrics
+from error_sink import get_error_log_folder, write_batch_errors
+from row_validation import validators
 
 
+# Load mode of the validated batches: insert (INSERT ... VALUES) or copy (COPY into a temporary table and INSERT ... SELECT)
+# It can be changed per table with LOAD_MODE_<TABLE> (e.g. LOAD_MODE_HIRED_EMPLOYEES=copy)
+default_load_mode = os.environ.get('LOAD_MODE', 'insert')
+# Partial accept mode: the valid rows of a batch are loaded and only the rows with errors are rejected (quarantined)
+partial_accept = os.environ.get('PARTIAL_ACCEPT', 'false').lower() == 'true'
+# Seconds the ids of departments and jobs are kept by the warm container before they are loaded again
+reference_cache_ttl = float(os.environ.get('REFERENCE_CACHE_TTL', 300))
+# Columns of hired_employees that reference other tables: position in the row, column name and referenced table
+hired_employees_references = [(3, 'department_id', 'departments'), (4, 'job_id', 'jobs')]
+# Ids of each referenced table known by this container and when they were loaded: table -> (ids, loaded_at)
+reference_ids = {}
+
 #This function help us to read the csv file from s3
 def read_csv_from_s3(s3_bucket_name,key):
     # Create an S3 client
@@ -16,162 +34,172 @@ def read_csv_from_s3(s3_bucket_name,key):
     csv_content = s3_object['Body'].read().decode('utf-8-sig').replace('\r','').split('\n')
     return csv_content
 
-#This function help us to check if the payload has the minimum requirements.
-def validation_hired_employees(rows,batch_id):
-    pass_=1
-    logs=[['Batch_Id','Row','Errors']]
-    for row in rows:
-        
-        if len(row) == 5:
-            log=[batch_id,str(row),[]]
-            first_column = row[0]
-            second_column = row[1]
-            third_column = row[2]
-            fourth_column = row[3]
-            fifth_column = row[4]
-            # Validate the first column as an integer
-            try:
-                first_column = int(first_column)
-            except ValueError:
-                log[2].append("Validation Error: First value should be an integer")
-                pass_=0
-
-            # Validate the second column as a string
-            if not isinstance(second_column, str) or second_column=='':
-                log[2].append("Validation Error: Second value should be a string and must not be empty")
-                pass_=0
-                
-            # Validate the third column as a datetime in ISO format
-            try:
-                datetime.strptime(third_column, '%Y-%m-%dT%H:%M:%SZ')
-            except ValueError:
-                log[2].append("Validation Error: Third value should be a datetime in ISO format")
-                pass_=0
-            try:
-                fourth_column = int(fourth_column)
-            except ValueError:
-                log[2].append("Validation Error: Fourth value should be an integer")
-                pass_=0
-            
-            try:
-                fifth_column = int(fifth_column)
-            except ValueError:
-                log[2].append("Validation Error: Fifth value should be an integer")
-                pass_=0
-
-        else:
-            log[2].append("Validation Error: Data malformed, more or less than the fields expected")
-            pass_=0
-        
-        #We append the log for each row
-        logs.append(log)
-        
-        
-    if pass_==1:
-        return pass_
-    else:
-        return logs
+#This function write the rows with errors of the batch in the quarantine folder
+#The file has the same format of the source file and its name starts with the table name, so it can be migrated again after fixing it
+def write_quarantine_to_s3(bucket_name,table_name,batch_id,timestamp,invalid_rows):
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(row for row, errors in invalid_rows)
+    s3 = boto3.client('s3')
+    file_key = f"quarantine/{table_name}.batch-{batch_id}_{timestamp}.csv"
+    s3.put_object(Bucket=bucket_name, Key=file_key, Body=buffer.getvalue().encode('utf-8'))
     
-def validation_departments_or_jobs(rows,batch_id):
-    pass_=1
-    logs=[['Batch_Id','Row','Errors']]
-    for row in rows:
+#This function help us to get the ids of a referenced table (departments or jobs), they are cached while the lambda is warm
+#The ids that are not in the cache are looked up, so the ids loaded by other containers are found without waiting for the TTL
+def get_reference_ids(cursor,table_name,ids):
+    cached = reference_ids.get(table_name)
+    if cached is None or time.monotonic() - cached[1] > reference_cache_ttl:
+        cursor.execute(f"SELECT id FROM migration.{table_name}")
+        cached = reference_ids[table_name] = (set(row[0] for row in cursor.fetchall()), time.monotonic())
+        return cached[0]
+    missing_ids = ids - cached[0]
+    if missing_ids:
+        cursor.execute(f"SELECT id FROM migration.{table_name} WHERE id = ANY(%s)", (list(missing_ids),))
+        cached[0].update(row[0] for row in cursor.fetchall())
+    return cached[0]
 
-        if len(row) == 2:
-            first_column = row[0]
-            second_column = row[1]
-            log=[batch_id,str(row),[]]
-            # Validate the first column as an integer
-            try:
-                first_column = int(first_column)
-            except ValueError:
-                log[2].append("Validation Error: First value should be an integer")
-                pass_=0
-                
+#This function add the ids committed by this container to the cache of the referenced table
+def remember_reference_ids(table_name,batch):
+    cached = reference_ids.get(table_name)
+    if cached is not None:
+        cached[0].update(int(row[0]) for row in batch)
 
-            # Validate the second column as a string
-            if not isinstance(second_column, str):
-                log[2].append("Validation Error: Second value should be a string")
-                pass_=0
+#This function split the validated hired_employees rows in the rows whose department and job exist and the orphan rows
+#The orphan rows are returned as (row, errors), like the rows that failed the validations
+def split_orphan_rows(cursor,batch):
+    known_ids = {}
+    for position, column, table_name in hired_employees_references:
+        known_ids[position] = get_reference_ids(cursor, table_name, set(int(row[position]) for row in batch))
+    rows = []
+    orphan_rows = []
+    for row in batch:
+        errors = [f"Reference Error: {column} {int(row[position])} doesn't exist in {table_name}"
+                  for position, column, table_name in hired_employees_references if int(row[position]) not in known_ids[position]]
+        if errors:
+            orphan_rows.append((row, errors))
         else:
-            log[2].append("Validation Error: Data malformed, more or less than the fields expected")
-            pass_=0
-            
-        #We append the log for each row
-        logs.append(log)
-            
-    if pass_==1:
-        return pass_
-    else:
-        return logs
-        
-def write_csv_to_s3(bucket_name, file_key, file_path):
-    s3 = boto3.client('s3')
-    s3.upload_file(file_path, bucket_name, file_key)
+            rows.append(row)
+    return rows, orphan_rows
 
-def transform_list_to_csv(list_of_lists):
-    # Create a temporary file to store the CSV data
-    temp_file = tempfile.NamedTemporaryFile(mode='w', delete=False)
-    
-    # Write the CSV data to the temporary file
-    with open(temp_file.name, 'w', newline='') as csvfile:
-        writer = csv.writer(csvfile)
-        writer.writerows(list_of_lists)
+#This function load the validated rows of the batch with the mode configured for the table, it returns the affected rows
+def load_batch(cursor,table_name,validation,column,rows,metrics):
+    if validation==1:
+        if get_load_mode(table_name)=='copy':
+            return copy_hired_employees(cursor,rows,metrics)
+        return insert_hired_employees(cursor,rows,metrics)
+    if get_load_mode(table_name)=='copy':
+        return copy_departments_or_jobs(cursor,rows,table_name,column,metrics)
+    return insert_departments_or_jobs(cursor,rows,table_name,column,metrics)
 
-    return temp_file.name
-    
-def extract_parameters_from_response(parameters):
+#This function insert the hired_employees batch building a single INSERT with all the rows
+#The orphan rows were removed with the ids of the cache, so the rows are inserted without joining departments and jobs
+def insert_hired_employees(cursor,batch,metrics):
+    # Prepare the INSERT statement with ON CONFLICT DO NOTHING
+    # This will allow me to don't have any error when migration happens
+    insert_query =  """
+                        INSERT INTO migration.hired_employees (id, name, datetime, department_id, job_id)
+                        SELECT cast(q.id as INT) as id, q.name, cast(q.datetime as timestamptz) as datetime, cast(q.department_id as INT) as department_id, cast(q.job_id as INT) as job_id FROM (
+                          VALUES %s
+                        ) AS q (id, name, datetime, department_id, job_id)
+                        ON CONFLICT (id) DO NOTHING;
+                    """
     
-    for parameter in parameters:
-        if parameter['Name'].split('/')[-1]=='databasename':
-            databasename=parameter['Value']
-        elif parameter['Name'].split('/')[-1]=='user':
-            user=parameter['Value']
-        elif parameter['Name'].split('/')[-1]=='password':
-            password=parameter['Value']
-        elif parameter['Name'].split('/')[-1]=='port':
-            port=parameter['Value']
-        elif parameter['Name'].split('/')[-1]=='database_identifier':
-            database_identifier=parameter['Value']
+    # SINGLE INSERT
+    # Convert list of lists to values inside the query
+    with metrics.stage('statement_build', rows=len(batch)) as counts:
+        values = ','.join(cursor.mogrify("(%s,%s,%s,%s,%s)", row).decode() for row in batch)
+        # Format the insert statement with the values
+        formatted_statement = insert_query % values
+        counts['bytes'] = len(formatted_statement)
+    with metrics.stage('db_execute', rows=len(batch), bytes=len(formatted_statement)):
+        cursor.execute(formatted_statement)
+    # Get the number of rows affected
+    status_message = cursor.statusmessage
+    affected_rows = int(status_message.split(" ")[-1])
     
-    parameters_dict={'databasename':databasename,'user':user,'password':password,'port':port,'database_identifier':database_identifier}
-    return parameters_dict
+    # MULTIPLE INSERTS
+    #cursor.executemany(formatted_statement, batch)
     
-    
-def lambda_handler(event, context):
-    
-    # Create an RDS client
-    rds_client = boto3.client('rds')
-    # Create an SSM client
-    ssm_client = boto3.client('ssm')
-    # Specify the SSM parameter names to retrieve
-    path = '/RDS/test-migration-db/'
-    
-    # Retrieve parameters by path from SSM Parameter Store
-    response = ssm_client.get_parameters_by_path(Path=path,Recursive=True, WithDecryption=True)
-    
-    # Extract the parameters values from the response
-    parameters_to_extract = response['Parameters']
-    parameters = extract_parameters_from_response(parameters_to_extract)
-    
-    #Set all the required parameters for the RDS database
-    #Describe the RDS instance to extract the endpoint using the database_identifier parameter stored in SSM 
-    response_describe_db = rds_client.describe_db_instances(DBInstanceIdentifier=parameters['database_identifier'])
-    endpoint = response_describe_db['DBInstances'][0]['Endpoint']['Address']
-    port=parameters['port']
-    master_username = parameters['user']
-    master_password = parameters['password']
-    database_name = parameters['databasename']
+    # Execute the single insert statement
+    # As we know that we have a maximum batch size of 1000, we can execute each query in a single query
+    # If the batch size increases, we could use executemany function, creating batches inside each batch to perform smaller queries
+    return affected_rows
+
+#This function insert the departments or jobs batch building a single INSERT with all the rows
+def insert_departments_or_jobs(cursor,batch,table_name,column,metrics):
+    insert_query =  """
+                        INSERT INTO migration.{} (id, {})
+                        SELECT cast(q.id as INT) as id, q.name FROM (
+                          VALUES %s
+                        ) AS q (id,name)
+                        ON CONFLICT (id) DO NOTHING;
+                    """.format(table_name,column)
+                    
+    # Convert list of lists to values inside the query
+    with metrics.stage('statement_build', rows=len(batch)) as counts:
+        values = ','.join(cursor.mogrify("(%s,%s)", row).decode() for row in batch)
+        # Format the insert statement with the values
+        formatted_statement = insert_query % values
+        counts['bytes'] = len(formatted_statement)
+    with metrics.stage('db_execute', rows=len(batch), bytes=len(formatted_statement)):
+        cursor.execute(formatted_statement)
+    # Get the number of rows affected
+    status_message = cursor.statusmessage
+    affected_rows = int(status_message.split(" ")[-1])
+    return affected_rows
+
+#This function help us to write the batch in a temporary table with COPY
+#The table is dropped with the commit, so it is created again in every transaction
+def copy_batch_to_staging_table(cursor,batch,staging_table,columns,metrics):
+    # The rows are written as CSV in memory, FORCE_NOT_NULL keeps the empty values as empty strings like the INSERT mode
+    with metrics.stage('statement_build', rows=len(batch)) as counts:
+        buffer = io.StringIO()
+        csv.writer(buffer).writerows(batch)
+        counts['bytes'] = buffer.tell()
+        buffer.seek(0)
+    columns_definition = ', '.join(f"{column} text" for column in columns)
+    columns_list = ', '.join(columns)
+    with metrics.stage('db_execute', rows=len(batch), bytes=counts['bytes']):
+        cursor.execute(f"CREATE TEMP TABLE {staging_table} ({columns_definition}) ON COMMIT DROP;")
+        cursor.copy_expert(f"COPY {staging_table} ({columns_list}) FROM STDIN WITH (FORMAT csv, FORCE_NOT_NULL ({columns_list}))", buffer)
 
+#This function load the hired_employees batch with COPY and a single set-based INSERT from the temporary table
+def copy_hired_employees(cursor,batch,metrics):
+    copy_batch_to_staging_table(cursor,batch,'staging_hired_employees',['id','name','datetime','department_id','job_id'],metrics)
+    insert_query =  """
+                        INSERT INTO migration.hired_employees (id, name, datetime, department_id, job_id)
+                        SELECT cast(q.id as INT) as id, q.name, cast(q.datetime as timestamptz) as datetime, cast(q.department_id as INT) as department_id, cast(q.job_id as INT) as job_id
+                        FROM staging_hired_employees q
+                        ON CONFLICT (id) DO NOTHING;
+                    """
+    with metrics.stage('db_execute'):
+        cursor.execute(insert_query)
+    # Get the number of rows affected, it is the same count of the INSERT mode
+    return cursor.rowcount
+
+#This function load the departments or jobs batch with COPY and a single set-based INSERT from the temporary table
+def copy_departments_or_jobs(cursor,batch,table_name,column,metrics):
+    staging_table = f"staging_{table_name}"
+    copy_batch_to_staging_table(cursor,batch,staging_table,['id','name'],metrics)
+    insert_query =  """
+                        INSERT INTO migration.{} (id, {})
+                        SELECT cast(q.id as INT) as id, q.name
+                        FROM {} q
+                        ON CONFLICT (id) DO NOTHING;
+                    """.format(table_name,column,staging_table)
+    with metrics.stage('db_execute'):
+        cursor.execute(insert_query)
+    return cursor.rowcount
+
+#This function help us to get the load mode of the table: insert (default) or copy
+def get_load_mode(table_name):
+    return os.environ.get(f'LOAD_MODE_{table_name.upper()}', default_load_mode)
+    
+#This function validate and load a batch, it returns the response of the batch
+def migrate_batch(event, context):
     
-    # Connect to the RDS instance
-    conn = psycopg2.connect(
-        host=endpoint,
-        port=port,
-        database=database_name,
-        user=master_username,
-        password=master_password
-    )
+    # Get the connection to the RDS instance
+    # The configuration and the connection are cached by the layer, so they are reused while the lambda is warm
+    conn = get_connection()
     # Let's create the cursor
     cursor = conn.cursor()
 
@@ -181,9 +209,14 @@ def lambda_handler(event, context):
     key=event[1]
     batch = event[2]
     batch_id=event[3]
+    # Optional options of the generator: run_id (folder of the error logs) and errors ('return' to send the errors of the
+    # batch back in the response, so the generator writes the errors of all the batches together, or 'write')
+    options = event[4] if len(event) > 4 and isinstance(event[4], dict) else {}
     start_char = "/"
     end_char = "."
     table_name = key[key.index(start_char) + 1 : key.index(end_char)]
+    # Time, rows and bytes of each stage of the batch, they are logged and returned to the generator
+    metrics = StageMetrics('migration', table=table_name, batch_id=batch_id)
     
     
     if table_name=='hired_employees':
@@ -196,91 +229,91 @@ def lambda_handler(event, context):
         column='job'
     else:
         validation=0
+    if validation==1:
+        column=None
         
 
     if validation != 0:
-    
         
-        if validation==1:
-            result=validation_hired_employees(batch,batch_id)
-            if result==1:
-                
-                # Prepare the INSERT statement with ON CONFLICT DO NOTHING
-                # This will allow me to don't have any error when migration happens
-                insert_query =  """
-                                    INSERT INTO migration.hired_employees (id, name, datetime, department_id, job_id)
-                                    SELECT cast(q.id as INT) as id, q.name, q.datetime, cast(q.department_id as INT) as department_id, cast(q.job_id as INT) as job_id FROM (
-                                      VALUES %s
-                                    ) AS q (id, name, datetime, department_id, job_id)
-                                    LEFT JOIN migration.departments d ON d.id = cast(q.department_id as INT)
-                                    LEFT JOIN migration.jobs j ON j.id = cast(q.job_id as INT)
-                                    WHERE d.id IS NOT NULL and j.id IS NOT NULL
-                                    ON CONFLICT (id) DO NOTHING;
-                                """
-                
-                # SINGLE INSERT
-                # Convert list of lists to values inside the query
-                values = ','.join(cursor.mogrify("(%s,%s,%s,%s,%s)", row).decode() for row in batch)
-                # Format the insert statement with the values
-                formatted_statement = insert_query % values
-                cursor.execute(formatted_statement)
-                # Get the number of rows affected
-                status_message = cursor.statusmessage
-                affected_rows = int(status_message.split(" ")[-1])
-                
-                # MULTIPLE INSERTS
-                #cursor.executemany(formatted_statement, batch)
-                
-                # Execute the single insert statement
-                # As we know that we have a maximum batch size of 1000, we can execute each query in a single query
-                # If the batch size increases, we could use executemany function, creating batches inside each batch to perform smaller queries
-                cursor.close()
-                conn.commit()
-                conn.close()
-                return [batch_id,'Pass_Payload',f"Rows affected: {affected_rows}"]
-  
-            else:
-                # Transform list of lists to CSV
-                csv_file_path = transform_list_to_csv(result)
-                # Write CSV file to S3
-                timestamp=datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
-                batch_id_str=str(batch_id)
-                file_key = f"logs/errors_table_{table_name}_batch-{batch_id_str}_{timestamp}.csv"
-                write_csv_to_s3(s3_bucket_name, file_key, csv_file_path)
-                return [batch_id,'Failed_Payload']
+        # The schema of the table is compiled once, the whole batch is validated column by column
+        with metrics.stage('validation', rows=len(batch)):
+            result=validators[table_name](batch)
+        
+        # In the partial accept mode the valid rows are loaded even if other rows of the batch failed
+        if result.passed or (partial_accept and result.valid_rows):
+            accepted_rows=result.valid_rows
         else:
-            result=validation_departments_or_jobs(batch,batch_id)
-            if result==1:
-                
-                insert_query =  """
-                                    INSERT INTO migration.{} (id, {})
-                                    SELECT cast(q.id as INT) as id, q.name FROM (
-                                      VALUES %s
-                                    ) AS q (id,name)
-                                    ON CONFLICT (id) DO NOTHING;
-                                """.format(table_name,column)
-                                
-                # Convert list of lists to values inside the query
-                values = ','.join(cursor.mogrify("(%s,%s)", row).decode() for row in batch)
-                # Format the insert statement with the values
-                formatted_statement = insert_query % values
-                cursor.execute(formatted_statement)
-                # Get the number of rows affected
-                status_message = cursor.statusmessage
-                affected_rows = int(status_message.split(" ")[-1])
-                
-                cursor.close()
+            accepted_rows=[]
+        
+        # The hires whose department or job doesn't exist are reported as orphan rows instead of being skipped by the insert
+        orphan_rows=[]
+        if validation==1 and accepted_rows:
+            with metrics.stage('reference_check', rows=len(accepted_rows)):
+                accepted_rows,orphan_rows=split_orphan_rows(cursor,accepted_rows)
+        
+        affected_rows=0
+        if accepted_rows:
+            try:
+                affected_rows=load_batch(cursor,table_name,validation,column,accepted_rows,metrics)
+            except ForeignKeyViolation:
+                # An id of the cache doesn't exist anymore (e.g. the tables were restored), the ids are loaded again,
+                # the rows that became orphans are kept apart and the load is retried once
+                conn.rollback()
+                reference_ids.clear()
+                with metrics.stage('reference_check', rows=len(accepted_rows)):
+                    accepted_rows,new_orphan_rows=split_orphan_rows(cursor,accepted_rows)
+                orphan_rows=orphan_rows+new_orphan_rows
+                if accepted_rows:
+                    affected_rows=load_batch(cursor,table_name,validation,column,accepted_rows,metrics)
+            with metrics.stage('commit', rows=affected_rows):
                 conn.commit()
-                conn.close()
-                return [batch_id,'Pass_Payload',f"Rows affected: {affected_rows} on table {table_name}"]
+                if affected_rows:
+                    # The cached reports are refreshed when the version of the data changes
+                    bump_data_version_after_commit(conn)
+            if validation!=1:
+                remember_reference_ids(table_name,accepted_rows)
+        cursor.close()
+        rejected_rows=len(batch)-len(accepted_rows)
+        
+        counts={'rows':len(batch),'accepted':len(accepted_rows),'rejected':rejected_rows,'orphans':len(orphan_rows),'affected_rows':affected_rows}
+        
+        if result.passed and not orphan_rows:
+            # The stages are the 5th element of the response, the generator adds them to the metrics of the migration
+            metrics.log(status='Pass_Payload', **counts)
+            if validation==1:
+                return [batch_id,'Pass_Payload',f"Rows affected: {affected_rows}",counts,metrics.summary()]
             else:
-                # Transform list of lists to CSV
-                csv_file_path = transform_list_to_csv(result)
-                # Write CSV file to S3
-                timestamp=datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
-                batch_id_str=str(batch_id)
-                file_key = f"logs/errors_table_{table_name}_batch-{batch_id_str}_{timestamp}.csv"
-                write_csv_to_s3(s3_bucket_name, file_key, csv_file_path)
-                return [batch_id,'Failed_Payload']
+                return [batch_id,'Pass_Payload',f"Rows affected: {affected_rows} on table {table_name}",counts,metrics.summary()]
+        
+        # Only the rows with errors are in the log, they are never written to disk
+        error_rows = result.logs(batch_id)[1:] + [[batch_id, str(row), errors] for row, errors in orphan_rows]
+        timestamp=datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
+        # The rows with errors are kept apart, so only them have to be fixed and migrated again
+        # The orphan rows are valid, they are always kept apart so they can be migrated again after their department or job
+        quarantine_rows = result.invalid_rows + orphan_rows if partial_accept else orphan_rows
+        # The errors and the quarantine rows are the 6th and 7th elements of the response when they are returned,
+        # the generator adds them to the error logs and the quarantine of the run
+        returned_errors = [error_rows, [row for row, errors in quarantine_rows]] if options.get('errors') == 'return' else []
+        if not returned_errors:
+            with metrics.stage('error_log_upload', rows=rejected_rows):
+                # A compressed CSV for the batch in the folder of the run
+                write_batch_errors(s3_bucket_name, get_error_log_folder(table_name, options.get('run_id', timestamp)), batch_id, error_rows)
+            if quarantine_rows:
+                with metrics.stage('quarantine_upload', rows=len(quarantine_rows)):
+                    write_quarantine_to_s3(s3_bucket_name,table_name,batch_id,timestamp,quarantine_rows)
+        # The valid rows were loaded in the partial accept mode, or the batch only had orphan rows
+        if accepted_rows:
+            metrics.log(status='Partial_Payload', **counts)
+            return [batch_id,'Partial_Payload',f"Rows affected: {affected_rows}, accepted: {len(accepted_rows)}, rejected: {rejected_rows}, orphans: {len(orphan_rows)}",counts,metrics.summary()]+returned_errors
+        metrics.log(status='Failed_Payload', **counts)
+        return [batch_id,'Failed_Payload',f"Rejected: {rejected_rows}",counts,metrics.summary()]+returned_errors
     else:
         return [batch_id,'Failed_Payload - File name not matching']
+
+def lambda_handler(event, context):
+    response = migrate_batch(event, context)
+    # With the Event invocation type the generator doesn't get the response, the marker confirms that the batch was processed
+    options = event[4] if len(event) > 4 and isinstance(event[4], dict) else {}
+    if options.get('commit_marker'):
+        boto3.client('s3').put_object(Bucket=event[0], Key=options['commit_marker'], Body=b'')
+    return response
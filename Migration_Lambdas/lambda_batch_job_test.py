@@ -1,56 +1,496 @@
 #The lambda will be triggered once the files are uploaded
 import csv
 import json
+import os
+import time
+import random
+import threading
 import boto3
-import tempfile
-from datetime import datetime
+from collections import deque
+from botocore.exceptions import ClientError
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from datetime import datetime, timezone
+from stage_metrics import StageMetrics
+from error_sink import ErrorSink, QuarantineSink, get_error_log_folder
+from s3_multipart_writer import S3MultipartWriter
 
 
+# Maximum number of batches that are being processed by the API at the same time
+max_concurrency = int(os.environ.get('MAX_CONCURRENCY', 8))
+# Retries for the transient errors of the API (throttling or server errors) and the base delay of the backoff
+max_retries = int(os.environ.get('MAX_RETRIES', 5))
+retry_base_delay = float(os.environ.get('RETRY_BASE_DELAY', 0.5))
+# Transport used to send the batches to the migration lambda: apigateway, lambda (direct invoke) or local (same process)
+transport_name = os.environ.get('TRANSPORT', 'apigateway')
+# Migration lambda used by the direct invoke transport and its invocation type (RequestResponse or Event)
+migration_function_name = os.environ.get('MIGRATION_FUNCTION_NAME', 'Lambda_migration_test')
+invocation_type = os.environ.get('INVOCATION_TYPE', 'RequestResponse')
+# Batch size used for every table, it can be changed per table with BATCH_SIZE_<TABLE> (e.g. BATCH_SIZE_JOBS)
+default_batch_size = int(os.environ.get('BATCH_SIZE', 50))
+# The API supports batches from 1 to 1000 rows
+min_batch_size = 1
+max_batch_size = 1000
+# Batch size mode: fixed (the configured size) or adaptive (the size changes with the latency and errors of the batches)
+batch_size_mode = os.environ.get('BATCH_SIZE_MODE', 'fixed')
+# Expected latency of one batch in the adaptive mode (seconds) and error rate that makes the batches smaller
+adaptive_target_latency = float(os.environ.get('ADAPTIVE_TARGET_LATENCY', 2.0))
+adaptive_max_error_rate = float(os.environ.get('ADAPTIVE_MAX_ERROR_RATE', 0.1))
+# Error codes returned by AWS when the API calls are throttled
+throttling_error_codes = ('TooManyRequestsException', 'ThrottlingException')
+
+# Folder of the checkpoint manifests, there is one manifest per source file and version (ETag)
+checkpoint_prefix = 'migration_checkpoints/'
+# Seconds between two saves of the checkpoint manifest
+checkpoint_interval = float(os.environ.get('CHECKPOINT_INTERVAL', 10))
+# Milliseconds before the lambda timeout when no more batches are sent, the migration continues in a new invocation
+timeout_margin_ms = int(os.environ.get('TIMEOUT_MARGIN_MS', 60000))
+# With the Event invocation type the batches are only queued, the migration lambda confirms each batch with a marker
+# Seconds that the generator waits for the confirmations at the end of the run and seconds between two checks
+queued_wait_seconds = float(os.environ.get('QUEUED_WAIT_SECONDS', 300))
+queued_poll_seconds = float(os.environ.get('QUEUED_POLL_SECONDS', 2))
+
+# Files bigger than this size are split in byte ranges, each range is migrated by its own invocation (0 disables it)
+split_threshold_bytes = int(os.environ.get('SPLIT_THRESHOLD_BYTES', 1024**3))
+# Size of each range of a split file
+split_range_bytes = int(os.environ.get('SPLIT_RANGE_BYTES', 256*1024**2))
+# The batch ids of each range start at part*batch_id_stride+1, so they are unique in the whole file
+batch_id_stride = 1000000
+# Folder where the ranges of a split file write their logs before they are merged
+split_log_prefix = 'migration_log/parts/'
+# Folder of the migration history logs, a JSON line per batch and a last line with the summary of the run
+history_log_prefix = 'migration_log/'
+
+# Tables referenced by the foreign keys of each table, a file waits until the files of these tables are migrated
+table_dependencies = {'hired_employees': ['departments', 'jobs']}
+# Seconds that an invocation waits for the files of the referenced tables and seconds between two checks
+dependency_wait_seconds = float(os.environ.get('DEPENDENCY_WAIT_SECONDS', 60))
+dependency_poll_seconds = float(os.environ.get('DEPENDENCY_POLL_SECONDS', 5))
+# Times the migration is deferred to a new invocation, after them the file is migrated and the orphan rows are reported
+max_deferrals = int(os.environ.get('MAX_DEFERRALS', 10))
+# Time when the migrations started to write checkpoints (ISO 8601, e.g. 2024-05-01T00:00:00+00:00), the files of the
+# referenced tables uploaded before it have no manifest because they were migrated before, so they are not waited for
+checkpoints_since = os.environ.get('CHECKPOINTS_SINCE')
+if checkpoints_since:
+    checkpoints_since = datetime.fromisoformat(checkpoints_since)
+    if checkpoints_since.tzinfo is None:
+        checkpoints_since = checkpoints_since.replace(tzinfo=timezone.utc)
+
+# Size of each chunk read from the S3 body, the file is never loaded completely in memory
+read_chunk_size = 1024*1024
+
+#This function help us to iterate the lines of the S3 body chunk by chunk
+#The line endings are kept, so the csv reader can handle CRLF and quoted values
+#position[0] is moved to the end of each line before it is yielded, so the reader knows the byte offset of each row
+#With metrics the time and bytes of the reads from S3 are measured (s3_read stage)
+def iter_lines_from_s3_body(body, position, chunk_size=read_chunk_size, metrics=None):
+    # The first line is decoded with utf-8-sig to remove the BOM (if the file has one)
+    encoding = 'utf-8-sig'
+    pending = b''
+    chunks = body.iter_chunks(chunk_size)
+    if metrics is not None:
+        chunks = metrics.timed_iter('s3_read', chunks, bytes_of=len)
+    try:
+        for chunk in chunks:
+            pending += chunk
+            start = 0
+            end = pending.find(b'\n')
+            while end != -1:
+                position[0] += end+1-start
+                yield pending[start:end+1].decode(encoding)
+                encoding = 'utf-8'
+                start = end+1
+                end = pending.find(b'\n', start)
+            pending = pending[start:]
+    finally:
+        # When the lines are not read until the end, the reads from S3 are added to the metrics when they are closed
+        if metrics is not None:
+            chunks.close()
+    # The last line could come without line ending
+    if pending:
+        position[0] += len(pending)
+        yield pending.decode(encoding)
+
 #This function help us to read the csv file from s3
-def read_csv_from_s3(s3_bucket_name,key):
+#The rows are yielded lazily with the byte offset where each row ends, so the memory doesn't depend on the file size
+#The file can be read from a byte offset (e.g. to resume a migration) until another offset (e.g. a range of a split file),
+#with the version (ETag) that was migrated before
+#With metrics the reads from S3 (s3_read) and the parse of the rows (csv_parse) are measured
+def read_csv_from_s3(s3_bucket_name,key,start_offset=0,etag=None,end_offset=None,metrics=None):
     s3 = boto3.client('s3')
     # Read the CSV file from S3
-    s3_object = s3.get_object(Bucket=s3_bucket_name, Key=key)
-    rows = s3_object['Body'].read().decode('utf-8-sig').replace('\r','').split('\n')
-    csv_content=[row.split(',') for row in rows]
-    return csv_content
-
-def transform_list_to_csv(list_of_lists):
-    # Create a temporary file to store the CSV data
-    temp_file = tempfile.NamedTemporaryFile(mode='w', delete=False)
-    
-    # Write the CSV data to the temporary file
-    with open(temp_file.name, 'w', newline='') as csvfile:
-        writer = csv.writer(csvfile)
-        writer.writerows(list_of_lists)
-    return temp_file.name
-    
-def write_csv_to_s3(bucket_name, file_key, file_path):
-    s3 = boto3.client('s3')
-    s3.upload_file(file_path, bucket_name, file_key)
+    arguments = {'Bucket': s3_bucket_name, 'Key': key}
+    if end_offset is not None:
+        if start_offset >= end_offset:
+            return
+        arguments['Range'] = f'bytes={start_offset}-{end_offset-1}'
+    elif start_offset:
+        arguments['Range'] = f'bytes={start_offset}-'
+    if etag:
+        arguments['IfMatch'] = etag
+    s3_object = s3.get_object(**arguments)
+    position = [start_offset]
+    lines = iter_lines_from_s3_body(s3_object['Body'], position, metrics=metrics)
+    rows = csv.reader(lines)
+    if metrics is not None:
+        rows = metrics.timed_iter('csv_parse', rows)
+    try:
+        for row in rows:
+            # Empty lines (like the last line break of the file) are not sent as rows
+            if row:
+                yield row, position[0]
+    finally:
+        # The reader can be closed before the end of the file (e.g. near the timeout), the stages of the reads and the
+        # parse are added to the metrics and the connection of the body is released
+        if metrics is not None:
+            rows.close()
+        lines.close()
+        s3_object['Body'].close()
+
+#This function help us to group the rows in batches without reading the whole file
+#The size of each batch is asked to next_batch_size when the batch starts, so it can change during the migration
+#The rows of the committed batches (first_row, rows) are skipped, and the new batches are cut before them
+#It yields the number of the first row of the batch, the rows and the byte offset where the batch ends
+def iter_batches(rows, next_batch_size, first_row=0, committed_batches=()):
+    committed = iter(sorted(committed_batches))
+    next_committed = next(committed, None)
+    rows_to_skip = 0
+    row_number = first_row
+    batch = []
+    for row, end_offset in rows:
+        if next_committed is not None and row_number == next_committed[0]:
+            rows_to_skip = next_committed[1]
+            next_committed = next(committed, None)
+        if rows_to_skip:
+            rows_to_skip -= 1
+            row_number += 1
+            continue
+        if not batch:
+            batch_first_row = row_number
+            batch_size = next_batch_size()
+        batch.append(row)
+        row_number += 1
+        if len(batch) >= batch_size or (next_committed is not None and row_number == next_committed[0]):
+            yield batch_first_row, batch, end_offset
+            batch = []
+    if batch:
+        yield batch_first_row, batch, end_offset
+
+#This function help us to get the configured batch size of a table, between 1 and 1000 rows
+def get_table_batch_size(table_name):
+    batch_size = int(os.environ.get(f'BATCH_SIZE_{table_name.upper()}', default_batch_size))
+    return min(max(batch_size, min_batch_size), max_batch_size)
+
+#This class keeps the same batch size during the whole migration
+class FixedBatchSize:
+    def __init__(self, batch_size):
+        self.batch_size = batch_size
     
-def lambda_handler(event, context):
-    # Extract the file name from the event
-    s3_bucket_name=event['Records'][0]['s3']['bucket']['name']
-    key = event['Records'][0]['s3']['object']['key']
+    def next_size(self):
+        return self.batch_size
+    
+    def record(self, batch_size, latency, failed):
+        pass
 
-    apigateway_client = boto3.client('apigateway')
-    # API Gateway information
-    rest_api_id = 'dv6rqvmho7'
-    resource_id = 'hfbug9'
+#This class changes the batch size with the results of the batches that were already sent
+#It starts with a small batch, grows while the latency is under the target and shrinks on slow batches or errors
+class AdaptiveBatchSize:
+    def __init__(self, initial_size, target_latency, max_error_rate):
+        self.batch_size = initial_size
+        self.target_latency = target_latency
+        self.max_error_rate = max_error_rate
+        # Moving average of the failed batches, the last batches weigh more
+        self.error_rate = 0.0
+        self.lock = threading.Lock()
+    
+    def next_size(self):
+        with self.lock:
+            return self.batch_size
+    
+    def record(self, batch_size, latency, failed):
+        with self.lock:
+            self.error_rate = 0.8*self.error_rate + 0.2*(1.0 if failed else 0.0)
+            if failed or self.error_rate > self.max_error_rate:
+                new_size = self.batch_size // 2
+            elif latency > 0:
+                # Size that would take the target latency with the speed of this batch, growing at most x2 each time
+                new_size = min(int(batch_size*self.target_latency/latency), 2*self.batch_size)
+            else:
+                new_size = 2*self.batch_size
+            self.batch_size = min(max(new_size, min_batch_size), max_batch_size)
+
+#This class keeps the batches of a file that were already processed, in a manifest in S3
+#The manifest is keyed by the object key and ETag, so a new version of the file starts from zero
+#It saves the point where all the previous batches are done (row and byte offset) and the done batches after that point
+#The ranges of a split file have their own manifest (part), starting at the offset and batch id of the range
+#The batches sent with the Event invocation type are only queued, they are done when the migration lambda writes their
+#commit marker, the queued batches that are never confirmed are sent again
+class MigrationCheckpoint:
+    def __init__(self, bucket, key, etag, part=None, start_offset=0, first_batch_id=1):
+        self.bucket = bucket
+        part_suffix = '' if part is None else f'.part-{part:04d}'
+        self.manifest_key = checkpoint_prefix + key + '/' + etag.strip('"') + part_suffix + '.json'
+        self.commit_prefix = checkpoint_prefix + key + '/' + etag.strip('"') + part_suffix + '/committed/'
+        self.resume_row = 0
+        self.resume_offset = start_offset
+        self.next_batch_id = first_batch_id
+        self.finished = False
+        # batch_id -> [first_row, rows, end_offset] of the done batches after the resume point
+        self.batches = {}
+        # batch_id -> [first_row, rows, end_offset] of the queued batches that were not confirmed yet
+        self.queued = {}
+        self.saved_at = time.monotonic()
+        self.lock = threading.Lock()
+        self.s3 = boto3.client('s3')
+        # Function called before each save, it writes what the done batches left in memory (e.g. their error rows)
+        self.before_save = None
+    
+    def load(self):
+        try:
+            response = self.s3.get_object(Bucket=self.bucket, Key=self.manifest_key)
+        except ClientError as error:
+            # There is no manifest the first time the file is migrated
+            if error.response['Error']['Code'] in ('NoSuchKey', '404'):
+                return False
+            raise
+        manifest = json.loads(response['Body'].read())
+        self.resume_row = manifest['resume_row']
+        self.resume_offset = manifest['resume_offset']
+        self.next_batch_id = manifest['next_batch_id']
+        self.finished = manifest['finished']
+        self.batches = {int(batch_id): batch for batch_id, batch in manifest['batches'].items()}
+        self.queued = {int(batch_id): batch for batch_id, batch in manifest.get('queued', {}).items()}
+        return True
+    
+    def record(self, batch_id, first_row, rows, end_offset):
+        with self.lock:
+            self.batches[batch_id] = [first_row, rows, end_offset]
+            if time.monotonic() - self.saved_at > checkpoint_interval:
+                self._save()
     
-    #Read the data
-    rows=read_csv_from_s3(s3_bucket_name,key)
+    def record_queued(self, batch_id, first_row, rows, end_offset):
+        with self.lock:
+            self.queued[batch_id] = [first_row, rows, end_offset]
     
-    #Let's create the batches
-    batch_size = 50
-    batches = [[s3_bucket_name,key,rows[i:i+batch_size]] for i in range(0, len(rows), batch_size)]
+    #This function help us to get the key of the marker that the migration lambda writes when it processed the batch
+    def commit_marker_key(self, batch_id):
+        return f"{self.commit_prefix}batch-{batch_id:012d}"
     
-    total_responses=[]
-    # Write batches to API Gateway
-    for batch_id,batch in enumerate(batches):
-        batch_id+=1
-        batch.append(batch_id)
+    #This function move the queued batches that have their commit marker to the done batches, it returns the batches
+    #that are still queued, which are forgotten with drop_unconfirmed so they are sent again
+    def confirm_queued(self, drop_unconfirmed=False):
+        with self.lock:
+            if self.queued:
+                paginator = self.s3.get_paginator('list_objects_v2')
+                # The markers are listed from the first queued batch, the markers of the older batches are skipped
+                start_after = self.commit_marker_key(min(self.queued) - 1)
+                for page in paginator.paginate(Bucket=self.bucket, Prefix=self.commit_prefix, StartAfter=start_after):
+                    for s3_object in page.get('Contents', []):
+                        batch_id = int(s3_object['Key'][len(self.commit_prefix) + len('batch-'):])
+                        if batch_id in self.queued:
+                            self.batches[batch_id] = self.queued.pop(batch_id)
+            if drop_unconfirmed:
+                self.queued = {}
+            return len(self.queued)
+    
+    def save(self, total_rows=None):
+        with self.lock:
+            self._save(total_rows)
+    
+    def _save(self, total_rows=None):
+        # The done batches right after the resume point move it forward, they don't need to be kept
+        for batch_id, (first_row, rows, end_offset) in sorted(self.batches.items(), key=lambda item: item[1]):
+            if first_row != self.resume_row:
+                break
+            self.resume_row = first_row + rows
+            self.resume_offset = end_offset
+            del self.batches[batch_id]
+        if self.before_save is not None:
+            self.before_save()
+        if total_rows is not None:
+            self.finished = self.resume_row >= total_rows
+        manifest = {
+            'resume_row': self.resume_row,
+            'resume_offset': self.resume_offset,
+            'next_batch_id': self.next_batch_id,
+            'finished': self.finished,
+            'batches': self.batches,
+            'queued': self.queued
+        }
+        self.s3.put_object(Bucket=self.bucket, Key=self.manifest_key, Body=json.dumps(manifest).encode('utf-8'))
+        self.saved_at = time.monotonic()
+
+#This function help us to know which referenced tables of the file are still being migrated
+#A referenced table is pending when its file is in the same folder and the checkpoint of that version (ETag) is not
+#finished (a split file has its checkpoint when all its ranges are finished), the tables without a file and the files
+#without checkpoint uploaded before checkpoints_since (e.g. loaded before) are not waited for
+def pending_dependencies(s3_bucket_name, key, table_name):
+    s3 = boto3.client('s3')
+    pending = []
+    for dependency in table_dependencies.get(table_name, []):
+        dependency_key = key[:key.index('/') + 1] + dependency + key[key.index('.'):]
+        try:
+            head = s3.head_object(Bucket=s3_bucket_name, Key=dependency_key)
+        except ClientError as error:
+            if error.response['Error']['Code'] in ('NoSuchKey', 'NotFound', '404'):
+                continue
+            raise
+        checkpoint = MigrationCheckpoint(s3_bucket_name, dependency_key, head['ETag'])
+        if not checkpoint.load() and checkpoints_since is not None and head['LastModified'] < checkpoints_since:
+            continue
+        if not checkpoint.finished:
+            pending.append(dependency)
+    return pending
+
+#This function wait until the referenced tables of the file are migrated, it returns the tables that are still pending
+#It never waits longer than dependency_wait_seconds or beyond the timeout margin of the lambda
+def wait_for_dependencies(s3_bucket_name, key, table_name, context):
+    deadline = time.monotonic() + dependency_wait_seconds
+    pending = pending_dependencies(s3_bucket_name, key, table_name)
+    while pending and time.monotonic() + dependency_poll_seconds < deadline:
+        if context is not None and context.get_remaining_time_in_millis() - dependency_poll_seconds*1000 < timeout_margin_ms:
+            break
+        time.sleep(dependency_poll_seconds)
+        pending = pending_dependencies(s3_bucket_name, key, table_name)
+    return pending
+
+#This function help us to know if a batch was processed by the migration lambda and must not be sent again
+#The batches rejected by the validations are done too, sending them again would give the same result
+#The batches queued with the Event invocation type (status 202) are not done until the migration lambda confirms them
+def is_done_response(response):
+    return response['status'] == 200
+
+#This function wait until the migration lambda confirms the queued batches, it returns the batches that are not confirmed
+#It never waits longer than queued_wait_seconds or beyond the timeout margin of the lambda
+def wait_for_queued_batches(checkpoint, context):
+    deadline = time.monotonic() + queued_wait_seconds
+    unconfirmed = checkpoint.confirm_queued()
+    while unconfirmed and time.monotonic() + queued_poll_seconds < deadline:
+        if context is not None and context.get_remaining_time_in_millis() - queued_poll_seconds*1000 < timeout_margin_ms:
+            break
+        time.sleep(queued_poll_seconds)
+        unconfirmed = checkpoint.confirm_queued()
+    return unconfirmed
+
+#This function help us to know if a batch failed, to make the next batches smaller in the adaptive mode
+def is_failed_response(response):
+    return response['status'] != 200 and response['status'] != 202 or 'Failed_Payload' in response['body']
+
+#This function help us to get the key of the migration history log of a run
+def get_history_log_key(table_name, run_id):
+    return f"{history_log_prefix}log_migration_history_table_{table_name}_{run_id}.jsonl"
+
+#This function build the line of the history log of a batch from its response, with typed fields
+#The body of the migration lambda is [batch_id, status, message, counts], the other bodies (errors of the transport,
+#Event invocations) are kept as the message
+def history_record(batch_id, response):
+    http_status = response['status'] if isinstance(response['status'], int) else None
+    try:
+        result = json.loads(response['body'])
+    except (TypeError, ValueError):
+        result = None
+    counts = {}
+    if isinstance(result, list) and len(result) > 1:
+        status = result[1]
+        message = result[2] if len(result) > 2 else None
+        if len(result) > 3 and isinstance(result[3], dict):
+            counts = result[3]
+    else:
+        if http_status == 202:
+            # With the Event invocation type the batch was only queued
+            status = 'Queued'
+        else:
+            status = 'Error' if http_status is None or http_status >= 300 else 'Unknown'
+        message = response['body'] or None
+    latency = response.get('latency')
+    return {
+        'record': 'batch',
+        'batch_id': batch_id,
+        'rows': response.get('batch_size'),
+        'status': status,
+        'http_status': http_status,
+        'affected_rows': counts.get('affected_rows'),
+        'accepted_rows': counts.get('accepted'),
+        'error_rows': counts.get('rejected'),
+        'latency_ms': round(latency*1000, 2) if latency is not None else None,
+        'message': message
+    }
+
+#This class writes the migration history log while the batches are answered, a JSON line per batch, so the log is
+#never kept in memory and it can be queried (e.g. with Athena or S3 Select)
+#The last line is the summary of the run: totals, statuses, latency, throughput and the stages of stage_metrics.py
+class MigrationHistoryLog:
+    def __init__(self, bucket, key, metrics=None):
+        self.key = key
+        self.writer = S3MultipartWriter(bucket, key, metrics=metrics)
+        self.started_at = time.time()
+        self.totals = {'batches': 0, 'rows': 0, 'affected_rows': 0, 'error_rows': 0}
+        self.statuses = {}
+        self.latency_ms_sum = 0.0
+        self.latency_ms_max = None
+    
+    def write(self, record):
+        self.writer.write((json.dumps(record, default=str) + '\n').encode('utf-8'))
+    
+    def add_batch(self, batch_id, response):
+        record = history_record(batch_id, response)
+        self.write(record)
+        self.totals['batches'] += 1
+        for field in ('rows', 'affected_rows', 'error_rows'):
+            self.totals[field] += record[field] or 0
+        self.statuses[record['status']] = self.statuses.get(record['status'], 0) + 1
+        if record['latency_ms'] is not None:
+            self.latency_ms_sum += record['latency_ms']
+            self.latency_ms_max = max(self.latency_ms_max or 0.0, record['latency_ms'])
+    
+    #This function write the summary line and complete the upload, it returns the summary
+    def close(self, **fields):
+        finished_at = time.time()
+        elapsed = finished_at - self.started_at
+        summary = {'record': 'summary', 'log_key': self.key}
+        summary.update(fields)
+        summary.update(self.totals)
+        summary['statuses'] = self.statuses
+        summary['latency_ms'] = {
+            'mean': round(self.latency_ms_sum / self.totals['batches'], 2) if self.totals['batches'] else None,
+            'max': self.latency_ms_max
+        }
+        summary['started_at'] = round(self.started_at, 3)
+        summary['finished_at'] = round(finished_at, 3)
+        summary['elapsed_seconds'] = round(elapsed, 3)
+        summary['rows_per_second'] = round(self.totals['rows'] / elapsed, 1) if elapsed > 0 else None
+        self.write(summary)
+        self.writer.close()
+        return summary
+    
+    def abort(self):
+        self.writer.abort()
+
+#This function help us to read the stages measured by the migration lambda (5th element of its response) and the rows
+#with errors of the batch (6th element, only when the batch failed)
+#They are removed from the body, so the history log keeps a short line per batch
+def pop_worker_details(response):
+    try:
+        result = json.loads(response['body'])
+    except (TypeError, ValueError):
+        return None, None, None
+    if not isinstance(result, list) or len(result) < 5 or not isinstance(result[4], dict):
+        return None, None, None
+    response['body'] = json.dumps(result[:4])
+    return result[4], result[5] if len(result) > 5 else None, result[6] if len(result) > 6 else None
+
+#This function help us to know if a status code can be retried
+def is_transient_status(status):
+    return status == 429 or 500 <= status <= 599
+
+#This function help us to wait before a retry, using exponential backoff with jitter
+def backoff(attempt):
+    time.sleep(random.uniform(0, retry_base_delay * 2**attempt))
+
+#This function create the transport that sends the batches through the API Gateway
+def apigateway_transport(rest_api_id, resource_id):
+    apigateway_client = boto3.client('apigateway')
+    
+    def send(batch):
         # Invoke the REST API Gateway
         response = apigateway_client.test_invoke_method(
             restApiId=rest_api_id,
@@ -58,17 +498,486 @@ def lambda_handler(event, context):
             httpMethod='POST',
             body=json.dumps(batch)
         )
-        total_responses.append(['Batch_Id:'+str(batch_id)+',Batch_Size:'+str(batch_size)+',status:'+str(response['status'])+',body:'+response['body']])
-       
+        return {'status': response['status'], 'body': response['body']}
+    return send
+
+#This function create the transport that invokes the migration lambda directly, without the API Gateway
+def lambda_transport(function_name, invocation_type):
+    lambda_client = boto3.client('lambda')
+    
+    def send(batch):
+        response = lambda_client.invoke(
+            FunctionName=function_name,
+            InvocationType=invocation_type,
+            Payload=json.dumps(batch)
+        )
+        status = response['StatusCode']
+        # The unhandled errors of the migration lambda come with status 200, so they are reported as server errors
+        if 'FunctionError' in response:
+            status = 500
+        # With the Event invocation type the lambda only queues the batch (status 202) and the body is empty
+        return {'status': status, 'body': response['Payload'].read().decode('utf-8')}
+    return send
+
+#This function create the transport that runs the migration lambda in the same process, for local runs
+#Another handler can be given to run the generator without network (e.g. a stand-in of the migration lambda)
+def local_transport(handler=None):
+    if handler is None:
+        # The migration lambda is in the same folder, it is only imported when this transport is used
+        import Lambda_migration_test
+        handler = Lambda_migration_test.lambda_handler
+    
+    def send(batch):
+        result = handler(batch, None)
+        return {'status': 200, 'body': json.dumps(result)}
+    return send
+
+#This function help us to choose the transport used to send the batches
+def create_transport(name, rest_api_id, resource_id):
+    if name == 'apigateway':
+        return apigateway_transport(rest_api_id, resource_id)
+    elif name == 'lambda':
+        return lambda_transport(migration_function_name, invocation_type)
+    elif name == 'local':
+        return local_transport()
+    else:
+        raise ValueError(f"Transport not supported: {name}")
+
+#This function send one batch with the transport, retrying the transient errors
+def send_batch(transport, batch):
+    for attempt in range(max_retries+1):
+        last_attempt = attempt == max_retries
+        try:
+            response = transport(batch)
+        except ClientError as error:
+            error_code = error.response['Error']['Code']
+            http_status = error.response['ResponseMetadata'].get('HTTPStatusCode', 0)
+            if last_attempt or not (error_code in throttling_error_codes or is_transient_status(http_status)):
+                raise
+        else:
+            if last_attempt or not is_transient_status(response['status']):
+                return response
+        backoff(attempt)
+
+#This function send the batches concurrently, keeping at most max_workers batches in flight
+#The responses are given to on_response in batch_id order, so the history log keeps the order of the file
+#Only the responses that arrived before the response of an earlier batch are kept, not the responses of the whole file
+def dispatch_batches(batches, send, max_workers, on_response):
+    results = {}
+    in_flight = {}
+    # Batch ids in the order they were sent, the first one is the next response to give
+    sent = deque()
+    
+    def collect(futures):
+        for future in futures:
+            batch_id = in_flight.pop(future)
+            try:
+                results[batch_id] = future.result()
+            except Exception as error:
+                # A batch that couldn't be sent must not stop the rest of the migration
+                results[batch_id] = {'status': 'Error', 'body': str(error)}
+        while sent and sent[0] in results:
+            batch_id = sent.popleft()
+            on_response(batch_id, results.pop(batch_id))
+    
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for batch in batches:
+            # The next batch is read from the file only when there is a free slot
+            if len(in_flight) >= max_workers:
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                collect(done)
+            in_flight[executor.submit(send, batch)] = batch[3]
+            sent.append(batch[3])
+        done, _ = wait(in_flight)
+        collect(done)
+    
+#This function split the file in byte ranges that end at a line break outside the quoted values
+#A quoted value can have line breaks (e.g. "x\r\ny"), so the quotes are counted from the start of the file: a line break
+#is inside a quoted value when the number of quotes before it is odd (an escaped quote "" doesn't change it)
+#The file is read chunk by chunk, only the quotes are counted, and the range ends at the first line break outside
+#quotes after range_bytes
+#The read stops near the timeout of the lambda: it returns None and the state of the split (offset of the next chunk,
+#quotes, next cut and boundaries found), and a new invocation continues from that state
+def split_object_in_ranges(s3_bucket_name, key, etag, size, range_bytes, context=None, state=None):
+    state = state or {'offset': 0, 'quotes_open': False, 'cut': range_bytes - 1, 'boundaries': [0]}
+    boundaries = state['boundaries']
+    # Offset where the line break that ends the current range is looked for
+    cut = state['cut']
+    quotes_open = state['quotes_open']
+    chunk_start = state['offset']
+    if cut < size:
+        s3 = boto3.client('s3')
+        body = s3.get_object(Bucket=s3_bucket_name, Key=key, Range=f'bytes={chunk_start}-', IfMatch=etag)['Body']
+        try:
+            for chunk in body.iter_chunks(read_chunk_size):
+                if cut >= size:
+                    break
+                if context is not None and context.get_remaining_time_in_millis() < timeout_margin_ms:
+                    # The chunk is read again by the next invocation
+                    return None, {'offset': chunk_start, 'quotes_open': quotes_open, 'cut': cut, 'boundaries': boundaries}
+                # Bytes of the chunk whose quotes were already counted
+                counted = 0
+                while cut < chunk_start + len(chunk):
+                    newline = chunk.find(b'\n', max(cut - chunk_start, counted))
+                    if newline == -1:
+                        break
+                    quotes_open ^= chunk.count(b'"', counted, newline) % 2 == 1
+                    counted = newline + 1
+                    if quotes_open:
+                        # The line break is inside a quoted value, the row continues in the next line
+                        continue
+                    boundary = chunk_start + newline + 1
+                    if boundary < size:
+                        boundaries.append(boundary)
+                    cut = boundary + range_bytes - 1
+                quotes_open ^= chunk.count(b'"', counted) % 2 == 1
+                chunk_start += len(chunk)
+        finally:
+            body.close()
+    boundaries.append(size)
+    return list(zip(boundaries[:-1], boundaries[1:])), None
+
+#This function send each range of the file to a new invocation of this lambda
+#If the file can't be split before the timeout, the split continues in a new invocation with the state in the event
+def fan_out_ranges(event, context, s3_bucket_name, key, etag, size, table_name):
+    split_state = event.get('split_state')
+    run_id = split_state['run_id'] if split_state else datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
+    ranges, state = split_object_in_ranges(s3_bucket_name, key, etag, size, split_range_bytes, context, split_state)
+    lambda_client = boto3.client('lambda')
+    if ranges is None:
+        state['run_id'] = run_id
+        event['split_state'] = state
+        lambda_client.invoke(FunctionName=context.invoked_function_arn, InvocationType='Event', Payload=json.dumps(event))
+        return [f'Split of {key} continues in a new invocation from byte {state["offset"]}, run {run_id}']
+    for part, (start_offset, end_offset) in enumerate(ranges):
+        range_event = {'range_worker': {
+            'bucket': s3_bucket_name,
+            'key': key,
+            'etag': etag,
+            'table_name': table_name,
+            'run_id': run_id,
+            'part': part,
+            'parts': len(ranges),
+            'start_offset': start_offset,
+            'end_offset': end_offset
+        }}
+        lambda_client.invoke(FunctionName=context.invoked_function_arn, InvocationType='Event', Payload=json.dumps(range_event))
+    return [f'File {key} split in {len(ranges)} ranges, run {run_id}']
+
+#This function migrate the rows of the file (or of a range of the file), sending the batches to the migration lambda
+#The responses of the batches are written in the history log (history_key) in batch_id order, it returns the summary
+#The rows with errors of all the batches of the run are written together in the folder of the run (error_sink.py)
+def migrate_object(event, context, s3_bucket_name, key, etag, table_name, checkpoint, run_id, history_key, end_offset=None):
+    # API Gateway information
+    rest_api_id = 'dv6rqvmho7'
+    resource_id = 'hfbug9'
+    
+    # Time, rows and bytes of each stage: the ones of this lambda and the ones returned by the migration lambda
+    metrics = StageMetrics('migration_generator', key=key, table=table_name)
+    
+    # The batches queued by a previous invocation are done if the migration lambda confirmed them, if not they are sent again
+    checkpoint.confirm_queued(drop_unconfirmed=True)
+    
+    #Read the data, the rows are streamed from S3 starting where all the previous batches were done
+    rows=read_csv_from_s3(s3_bucket_name,key,checkpoint.resume_offset,etag,end_offset,metrics)
+    
+    # The migration lambda returns the errors of each batch, they are compressed in memory and written in a few parts
+    # With the Event invocation type there are no responses, so the migration lambda writes them
+    error_sink = ErrorSink(s3_bucket_name, get_error_log_folder(table_name, run_id), checkpoint.next_batch_id, metrics=metrics)
+    # The quarantine rows returned by the migration lambda are written in a few parts too
+    quarantine_sink = QuarantineSink(s3_bucket_name, table_name, run_id, checkpoint.next_batch_id, metrics=metrics)
+    
+    def flush_sinks():
+        error_sink.flush()
+        quarantine_sink.flush()
+    # The checkpoint only says a batch is done when its error and quarantine rows are already in S3
+    checkpoint.before_save = flush_sinks
+    errors_mode = 'write' if transport_name == 'lambda' and invocation_type == 'Event' else 'return'
+    
+    #Let's create the batches, each batch is built only when it is going to be sent
+    batch_size = get_table_batch_size(table_name)
+    if batch_size_mode == 'adaptive':
+        # In the adaptive mode the configured size of the table is the initial size
+        batch_sizer = AdaptiveBatchSize(batch_size, adaptive_target_latency, adaptive_max_error_rate)
+    else:
+        batch_sizer = FixedBatchSize(batch_size)
+    
+    # Row number, byte offset and rows of each batch that is being sent, to record it in the checkpoint
+    batches_info = {}
+    read_state = {'rows_read': checkpoint.resume_row, 'stopped': False}
+    
+    def count_rows(rows):
+        for row in rows:
+            read_state['rows_read'] += 1
+            yield row
+    
+    def generate_batches():
+        pending_batches = iter_batches(count_rows(rows), batch_sizer.next_size, checkpoint.resume_row, checkpoint.batches.values())
+        for first_row, batch, end_offset in pending_batches:
+            # No more batches are sent when the lambda is close to its timeout
+            if context is not None and context.get_remaining_time_in_millis() < timeout_margin_ms:
+                read_state['stopped'] = True
+                return
+            batch_id = checkpoint.next_batch_id
+            checkpoint.next_batch_id += 1
+            batches_info[batch_id] = (first_row, len(batch), end_offset)
+            options = {'run_id': run_id, 'errors': errors_mode}
+            if errors_mode == 'write':
+                # There is no response with the Event invocation type, the migration lambda confirms the batch with a marker
+                options['commit_marker'] = checkpoint.commit_marker_key(batch_id)
+            yield [s3_bucket_name,key,batch,batch_id,options]
+    
+    # Write batches to the migration lambda (through the API Gateway, direct invoke or locally)
+    transport = create_transport(transport_name, rest_api_id, resource_id)
+    
+    def send(batch):
+        started = time.monotonic()
+        try:
+            response = send_batch(transport, batch)
+        except Exception as error:
+            response = {'status': 'Error', 'body': str(error)}
+        latency = time.monotonic() - started
+        response['latency'] = latency
+        # The batches are sent by several threads, so the time of this stage can be longer than the migration
+        metrics.add('batch_round_trip', latency, rows=len(batch[2]))
+        worker_stages, error_rows, quarantine_rows = pop_worker_details(response)
+        metrics.merge(worker_stages)
+        error_sink.add(batch[3], error_rows)
+        quarantine_sink.add(quarantine_rows)
+        batch_sizer.record(len(batch[2]), latency, is_failed_response(response))
+        response['batch_size'] = len(batch[2])
+        if is_done_response(response):
+            checkpoint.record(batch[3], *batches_info.pop(batch[3]))
+        elif response['status'] == 202:
+            checkpoint.record_queued(batch[3], *batches_info.pop(batch[3]))
+        return response
+    
+    # The history log is written while the responses arrive
+    history_log = MigrationHistoryLog(s3_bucket_name, history_key, metrics)
+    try:
+        dispatch_batches(generate_batches(), send, max_concurrency, history_log.add_batch)
+    except Exception:
+        history_log.abort()
+        raise
+    finally:
+        # The rows of the batches that were done are written even if the run fails, a resumed run doesn't send them again
+        errors_summary = error_sink.close()
+        quarantine_summary = quarantine_sink.close()
+    # The reader is closed before the metrics are logged, if the run stopped near the timeout it was not read until the end
+    rows.close()
+    # The queued batches are done when the migration lambda confirms them
+    unconfirmed_batches = wait_for_queued_batches(checkpoint, context) if checkpoint.queued else 0
+    # When the whole file was read, the checkpoint is finished if all the rows were done
+    checkpoint.save(None if read_state['stopped'] else read_state['rows_read'])
+    
+    continue_migration = read_state['stopped']
+    if unconfirmed_batches and not read_state['stopped'] and context is not None:
+        # The batches that were never confirmed are sent again by a new invocation, at most max_retries times
+        event['resends'] = event.get('resends', 0) + 1
+        continue_migration = event['resends'] <= max_retries
+        if not continue_migration:
+            print(f'{unconfirmed_batches} batches of {key} were not confirmed by the migration lambda, the checkpoint is not finished')
+    if continue_migration:
+        # The migration continues in a new invocation, that starts from the checkpoint
+        boto3.client('lambda').invoke(FunctionName=context.invoked_function_arn, InvocationType='Event', Payload=json.dumps(event))
+    
+    # The last line of the history log has the totals and the stages of the whole run, so the runs can be compared
+    metrics_line = metrics.log(batches=history_log.totals['batches'], rows=history_log.totals['rows'],
+                               error_rows=errors_summary['rows'], error_parts=errors_summary['parts'])
+    return history_log.close(key=key, table=table_name, run_id=run_id, stopped=read_state['stopped'], continued=continue_migration,
+                             error_logs=errors_summary, quarantine=quarantine_summary, stages=metrics_line['stages'])
+
+#This function add the summaries of the logs of the invocations of a run (the ranges of a split file or the invocations
+#that continued the migration after a timeout), the result is the summary of the whole file
+def merge_history_summaries(summaries, log_key):
+    merged = {'record': 'summary', 'log_key': log_key}
+    for field in ('key', 'table', 'run_id'):
+        merged[field] = summaries[0].get(field) if summaries else None
+    merged['invocations'] = len(summaries)
+    for field in ('batches', 'rows', 'affected_rows', 'error_rows'):
+        merged[field] = sum(summary[field] for summary in summaries)
+    error_logs = [summary['error_logs'] for summary in summaries if summary.get('error_logs')]
+    merged['error_logs'] = {
+        'folder': error_logs[0]['folder'] if error_logs else None,
+        'batches': sum(errors['batches'] for errors in error_logs),
+        'rows': sum(errors['rows'] for errors in error_logs),
+        'parts': sum(errors['parts'] for errors in error_logs)
+    }
+    quarantines = [summary['quarantine'] for summary in summaries if summary.get('quarantine')]
+    merged['quarantine'] = {
+        'rows': sum(quarantine['rows'] for quarantine in quarantines),
+        'parts': [part for quarantine in quarantines for part in quarantine['parts']]
+    }
+    merged['statuses'] = {}
+    stages = StageMetrics('migration_generator')
+    latency_ms_sum = 0.0
+    for summary in summaries:
+        for status, batches in summary['statuses'].items():
+            merged['statuses'][status] = merged['statuses'].get(status, 0) + batches
+        if summary['latency_ms']['mean'] is not None:
+            latency_ms_sum += summary['latency_ms']['mean'] * summary['batches']
+        stages.merge(summary.get('stages'))
+    latencies_max = [summary['latency_ms']['max'] for summary in summaries if summary['latency_ms']['max'] is not None]
+    merged['latency_ms'] = {
+        'mean': round(latency_ms_sum / merged['batches'], 2) if merged['batches'] else None,
+        'max': max(latencies_max) if latencies_max else None
+    }
+    # The ranges run at the same time, the time of the file goes from the first invocation that started to the last that finished
+    merged['started_at'] = min(summary['started_at'] for summary in summaries) if summaries else None
+    merged['finished_at'] = max(summary['finished_at'] for summary in summaries) if summaries else None
+    elapsed = merged['finished_at'] - merged['started_at'] if summaries else 0
+    merged['elapsed_seconds'] = round(elapsed, 3)
+    merged['rows_per_second'] = round(merged['rows'] / elapsed, 1) if elapsed > 0 else None
+    merged['stages'] = stages.summary()
+    return merged
+
+#This function help us to get the folder where the invocations of a run write their logs before they are merged
+def get_run_log_prefix(table_name, run_id):
+    return f"{split_log_prefix}{table_name}_{run_id}/"
+
+#This function list the logs of the invocations of a run and the ranges of a split file that are done
+def list_run_logs(s3, s3_bucket_name, run_prefix):
+    done_parts = 0
+    log_keys = []
+    paginator = s3.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=s3_bucket_name, Prefix=run_prefix):
+        for s3_object in page.get('Contents', []):
+            if s3_object['Key'].startswith(run_prefix + 'done/'):
+                done_parts += 1
+            else:
+                log_keys.append(s3_object['Key'])
+    return log_keys, done_parts
+
+#This function merge the logs of all the invocations of a run into a single migration history log, it returns its summary
+#The lines of the batches are copied as they are read and the summaries of the invocations become a single summary line
+def merge_run_logs(s3, s3_bucket_name, table_name, run_id, log_keys):
+    # The name of the merged log is fixed by the run, so if two ranges merge at the same time the result is the same
+    file_key = get_history_log_key(table_name, run_id)
+    summaries = []
+    with S3MultipartWriter(s3_bucket_name, file_key, s3) as merged_log:
+        # The names of the logs keep the order of the parts and batches
+        for log_key in sorted(log_keys):
+            body = s3.get_object(Bucket=s3_bucket_name, Key=log_key)['Body']
+            for line in iter_lines_from_s3_body(body, [0]):
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                if record.get('record') == 'summary':
+                    summaries.append(record)
+                else:
+                    merged_log.write(line.encode('utf-8'))
+        merged_summary = merge_history_summaries(summaries, file_key)
+        merged_log.write((json.dumps(merged_summary, default=str) + '\n').encode('utf-8'))
+    return merged_summary
+
+#This function merge the logs of all the ranges of a split file into a single migration history log
+#It runs when a range ends (finished, already finished by a previous run or with batches that failed after all the
+#retries), and only the last range finds all the ranges ended and returns the summary of the file
+def merge_range_logs(s3_bucket_name, table_name, run_id, parts):
+    s3 = boto3.client('s3')
+    log_keys, done_parts = list_run_logs(s3, s3_bucket_name, get_run_log_prefix(table_name, run_id))
+    if done_parts < parts:
+        return None
+    return merge_run_logs(s3, s3_bucket_name, table_name, run_id, log_keys)
+
+#This function save the checkpoint of a split file as finished when all its ranges are finished
+#The files that reference the table (e.g. the hires) wait for this checkpoint, like the one of a file that is not split
+def save_split_file_checkpoint(s3_bucket_name, key, etag, parts):
+    for part in range(parts):
+        part_checkpoint = MigrationCheckpoint(s3_bucket_name, key, etag, part)
+        part_checkpoint.load()
+        if not part_checkpoint.finished:
+            return False
+    file_checkpoint = MigrationCheckpoint(s3_bucket_name, key, etag)
+    file_checkpoint.finished = True
+    file_checkpoint.save()
+    return True
+
+#This function migrate one range of a split file, it is invoked by the lambda that split the file
+def migrate_range(event, context):
+    worker = event['range_worker']
+    s3_bucket_name = worker['bucket']
+    key = worker['key']
+    table_name = worker['table_name']
+    part = worker['part']
+    first_batch_id = part*batch_id_stride + 1
+    
+    checkpoint = MigrationCheckpoint(s3_bucket_name, key, worker['etag'], part, worker['start_offset'], first_batch_id)
+    checkpoint.load()
+    run_prefix = get_run_log_prefix(table_name, worker['run_id'])
+    if checkpoint.finished:
+        summary = [f'Range {part} of {key} already finished, there are no batches to send']
+    else:
+        # First batch id sent by this invocation, a range can be migrated by several invocations if it is resumed
+        first_sent_batch_id = checkpoint.next_batch_id
+        #the log of this invocation of the range is written while the batches are sent, the name keeps the order of the batches
+        history_key = f"{run_prefix}part-{part:04d}_batch-{first_sent_batch_id:012d}.jsonl"
+        summary = migrate_object(event, context, s3_bucket_name, key, worker['etag'], table_name, checkpoint, worker['run_id'], history_key, worker['end_offset'])
+        if summary['continued']:
+            # The range is migrated by a new invocation, that one writes the marker
+            return summary
+    
+    # The range ended in this run, the marker is written even if some batches failed (like the logs of a file that is not split)
+    boto3.client('s3').put_object(Bucket=s3_bucket_name, Key=f"{run_prefix}done/part-{part:04d}", Body=b'')
+    merged_summary = merge_range_logs(s3_bucket_name, table_name, worker['run_id'], worker['parts'])
+    if merged_summary is None:
+        return summary
+    # The last range returns the summary of the whole file
+    save_split_file_checkpoint(s3_bucket_name, key, worker['etag'], worker['parts'])
+    return merged_summary
+    
+def lambda_handler(event, context):
+    # The ranges of a split file come from this same lambda
+    if 'range_worker' in event:
+        return migrate_range(event, context)
+    
+    # Extract the file name from the event
+    s3_bucket_name=event['Records'][0]['s3']['bucket']['name']
+    key = event['Records'][0]['s3']['object']['key']
     
-    #write migration log into s3  
-    csv_file_path = transform_list_to_csv(total_responses)
-    timestamp=datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
     #Extract table name
     start_char = "/"
     end_char = "."
     table_name = key[key.index(start_char) + 1 : key.index(end_char)]
-    file_key=f"migration_log/log_migration_history_table_{table_name}_{timestamp}.csv"
-    write_csv_to_s3(s3_bucket_name, file_key, csv_file_path)
     
-    return total_responses
+    # The checkpoint of this version of the file says which batches were already done by a previous run
+    s3_object = event['Records'][0]['s3']['object']
+    if s3_object.get('eTag') and 'size' in s3_object:
+        etag, size = s3_object['eTag'], s3_object['size']
+    else:
+        head = boto3.client('s3').head_object(Bucket=s3_bucket_name, Key=key)
+        etag, size = head['ETag'], head['ContentLength']
+    
+    # The hires are migrated after the departments and jobs uploaded with them, so their rows are not orphans
+    pending = wait_for_dependencies(s3_bucket_name, key, table_name, context)
+    if pending:
+        deferrals = event.get('deferrals', 0)
+        if context is not None and deferrals < max_deferrals:
+            # The migration is deferred to a new invocation, the event counts the deferrals
+            event['deferrals'] = deferrals + 1
+            boto3.client('lambda').invoke(FunctionName=context.invoked_function_arn, InvocationType='Event', Payload=json.dumps(event))
+            return [f'Migration of {key} deferred ({deferrals + 1}/{max_deferrals}), waiting for {", ".join(pending)}']
+        print(f'Migration of {key} started without waiting for {", ".join(pending)}, the missing references are reported as orphan rows')
+    
+    # The big files are split in ranges that are migrated in parallel by other invocations
+    if split_threshold_bytes and size > split_threshold_bytes:
+        return fan_out_ranges(event, context, s3_bucket_name, key, etag, size, table_name)
+    
+    checkpoint = MigrationCheckpoint(s3_bucket_name, key, etag)
+    checkpoint.load()
+    if checkpoint.finished:
+        return [f'Migration of {key} already finished, there are no batches to send']
+    
+    # The history log and the folder of the error logs have the same run id
+    # The invocations that continue the migration (near the timeout) get the run id in the event and keep it
+    run_id = event.get('run_id') or datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
+    event['run_id'] = run_id
+    #the log of this invocation is written into s3 while the batches are sent, the name keeps the order of the batches
+    history_key = f"{get_run_log_prefix(table_name, run_id)}batch-{checkpoint.next_batch_id:012d}.jsonl"
+    summary = migrate_object(event, context, s3_bucket_name, key, etag, table_name, checkpoint, run_id, history_key)
+    if summary['continued']:
+        return summary
+    # The last invocation of the run merges the logs of all the invocations in the migration history log
+    s3 = boto3.client('s3')
+    log_keys, _ = list_run_logs(s3, s3_bucket_name, get_run_log_prefix(table_name, run_id))
+    return merge_run_logs(s3, s3_bucket_name, table_name, run_id, log_keys)
@@ -0,0 +1,166 @@
+#This module compiles the schema of each table into a validator that checks the whole batch at once
+#The columns are checked with precompiled regular expressions over all the values of the column,
+#and the error messages are only built for the rows that failed
+import re
+from datetime import datetime
+from functools import lru_cache
+
+
+# Values accepted by int(): optional whitespace and sign, and digits with optional underscores
+integer_pattern = r'\s*[+-]?\d+(?:_\d+)*\s*'
+# Values accepted by datetime.strptime(value, '%Y-%m-%dT%H:%M:%SZ'), the day of the month is checked after the regex
+iso_datetime_pattern = (r'(\d\d\d\d)-(1[0-2]|0[1-9]|[1-9])-(3[0-1]|[1-2]\d|0[1-9]|[1-9]| [1-9])'
+                        r'T(?:2[0-3]|[0-1]\d|\d):(?:[0-5]\d|\d):(?:[0-5]\d|\d)Z')
+# Separator used to join the values of a column, it can't be matched by the patterns
+separator = '\x00'
+
+# Schemas of the tables: column name, type of the value and error message of the column
+# Types: integer, string, non_empty_string and iso_datetime
+hired_employees_schema = [
+    ('id', 'integer', "Validation Error: First value should be an integer"),
+    ('name', 'non_empty_string', "Validation Error: Second value should be a string and must not be empty"),
+    ('datetime', 'iso_datetime', "Validation Error: Third value should be a datetime in ISO format"),
+    ('department_id', 'integer', "Validation Error: Fourth value should be an integer"),
+    ('job_id', 'integer', "Validation Error: Fifth value should be an integer")
+]
+
+departments_schema = [
+    ('id', 'integer', "Validation Error: First value should be an integer"),
+    ('department', 'string', "Validation Error: Second value should be a string")
+]
+
+jobs_schema = [
+    ('id', 'integer', "Validation Error: First value should be an integer"),
+    ('job', 'string', "Validation Error: Second value should be a string")
+]
+
+malformed_row_error = "Validation Error: Data malformed, more or less than the fields expected"
+
+
+#This class has the result of the validation of a batch
+class ValidationResult:
+    def __init__(self, valid_rows, invalid_rows):
+        # Rows that passed all the validations, in the order of the batch
+        self.valid_rows = valid_rows
+        # List of (row, errors) only for the rows that failed
+        self.invalid_rows = invalid_rows
+
+    @property
+    def passed(self):
+        return not self.invalid_rows
+
+    #This function build the error log of the batch with the same columns of the error files
+    def logs(self, batch_id):
+        return [['Batch_Id','Row','Errors']] + [[batch_id, str(row), errors] for row, errors in self.invalid_rows]
+
+
+@lru_cache(maxsize=4096)
+def is_valid_date(year, month, day):
+    try:
+        datetime(int(year), int(month), int(day))
+        return True
+    except ValueError:
+        return False
+
+#This function help us to check a single value, it is used only when the column check fails
+def check_integer(value, regex=re.compile(integer_pattern)):
+    if isinstance(value, str):
+        return regex.fullmatch(value) is not None
+    # Values that are not strings (e.g. numbers in the JSON payload) are checked like the old validation
+    try:
+        int(value)
+        return True
+    except (TypeError, ValueError):
+        return False
+
+def check_string(value):
+    return isinstance(value, str)
+
+def check_non_empty_string(value):
+    return isinstance(value, str) and value != ''
+
+def check_iso_datetime(value, regex=re.compile(iso_datetime_pattern, re.IGNORECASE)):
+    if not isinstance(value, str):
+        return False
+    match = regex.fullmatch(value)
+    return match is not None and is_valid_date(*match.groups())
+
+value_checks = {
+    'integer': check_integer,
+    'string': check_string,
+    'non_empty_string': check_non_empty_string,
+    'iso_datetime': check_iso_datetime
+}
+
+#This function build the check of a whole column, it returns True when all the values are valid
+def compile_column_check(value_type):
+    if value_type == 'string':
+        return lambda column: all(isinstance(value, str) for value in column)
+    if value_type == 'non_empty_string':
+        return lambda column: '' not in column and all(isinstance(value, str) for value in column)
+
+    if value_type == 'integer':
+        pattern = integer_pattern
+        flags = 0
+    elif value_type == 'iso_datetime':
+        pattern = iso_datetime_pattern
+        flags = re.IGNORECASE
+    else:
+        raise ValueError(f"Type not supported: {value_type}")
+
+    # All the values of the column are joined and matched with a single regex
+    column_regex = re.compile(f'(?:{pattern})(?:{separator}(?:{pattern}))*', flags)
+    dates_regex = re.compile(pattern, flags)
+
+    def check(column):
+        try:
+            joined = separator.join(column)
+        except TypeError:
+            # There are values that are not strings
+            return False
+        if joined.count(separator) != len(column) - 1 or column_regex.fullmatch(joined) is None:
+            return False
+        if value_type == 'iso_datetime':
+            # The regex doesn't know the days of each month, each distinct date is checked once
+            return all(is_valid_date(*date) for date in set(dates_regex.findall(joined)))
+        return True
+    return check
+
+#This function compiles the schema of a table into a function that validates a batch of rows
+def compile_schema(schema):
+    columns_count = len(schema)
+    column_checks = [compile_column_check(value_type) for _, value_type, _ in schema]
+    single_checks = [value_checks[value_type] for _, value_type, _ in schema]
+    messages = [message for _, _, message in schema]
+
+    def validate(rows):
+        # Rows with more or less fields are errors, the rest is checked column by column
+        well_formed = [row for row in rows if len(row) == columns_count]
+        if len(well_formed) == len(rows):
+            failed_columns = [index for index, column in enumerate(zip(*rows)) if not column_checks[index](column)]
+            if not failed_columns:
+                return ValidationResult(rows, [])
+        else:
+            failed_columns = list(range(columns_count))
+
+        # Slow path: only the failed columns are checked value by value to find the rows with errors
+        valid_rows = []
+        invalid_rows = []
+        for row in rows:
+            if len(row) != columns_count:
+                invalid_rows.append((row, [malformed_row_error]))
+                continue
+            errors = [messages[index] for index in failed_columns if not single_checks[index](row[index])]
+            if errors:
+                invalid_rows.append((row, errors))
+            else:
+                valid_rows.append(row)
+        return ValidationResult(valid_rows, invalid_rows)
+    return validate
+
+# The validators are compiled once per container
+validators = {
+    'hired_employees': compile_schema(hired_employees_schema),
+    'departments': compile_schema(departments_schema),
+    'jobs': compile_schema(jobs_schema)
+}